@@ -9,8 +9,25 @@ https://docs.djangoproject.com/en/4.0/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
+from django.conf import settings
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'PrimosCheckIn.settings')
 
-application = get_asgi_application()
+# Igual que get_asgi_application, pero las respuestas en streaming se leen fuera del
+# event loop, y el stream de eventos en vivo (/api/stream) se atiende fuera de Django,
+# véase tracks/stream.py
+django.setup(set_prefix=False)
+
+# Bajo ASGI cada petición corre en un hilo propio, así que una conexión persistente
+# nunca se reutiliza y las de los hilos que terminan quedan abiertas (ticket #33497 de
+# Django). Se cierran al terminar cada petición sin importar POSTGRES_CONN_MAX_AGE;
+# para no pagar el costo de abrirlas POSTGRES_HOST debe apuntar a un pooler.
+for database in settings.DATABASES.values():
+    database['CONN_MAX_AGE'] = 0
+
+from tracks.stream import StreamingASGIHandler, streaming
+
+django_application = StreamingASGIHandler()
+
+application = streaming(django_application)
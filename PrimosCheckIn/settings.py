@@ -31,6 +31,8 @@ ALLOWED_HOSTS = ['*']
 # Application definition
 
 INSTALLED_APPS = [
+    # Reemplaza runserver por un servidor ASGI, necesario para /api/stream
+    'daphne',
     'django.contrib.admin',
     'django.contrib.auth',
     'django.contrib.contenttypes',
@@ -45,6 +47,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Primero, para medir todo lo que tarda cada petición
+    'tracks.metrics.MetricsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -74,20 +78,36 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'PrimosCheckIn.wsgi.application'
+ASGI_APPLICATION = 'PrimosCheckIn.asgi.application'
 
 
 # Database
 # https://docs.djangoproject.com/en/4.0/ref/settings/#databases
 
 
+def env_flag(name: str) -> bool:
+    return os.environ.get(name, '').lower() in ('1', 'true', 'yes')
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.postgresql',
         'NAME': os.environ.get('POSTGRES_NAME'),
         'USER': os.environ.get('POSTGRES_USER'),
         'PASSWORD': os.environ.get('POSTGRES_PASSWORD'),
-        'HOST': 'db',
-        'PORT': 5432,
+        'HOST': os.environ.get('POSTGRES_HOST', 'db'),
+        'PORT': int(os.environ.get('POSTGRES_PORT', 5432)),
+        # Segundos que se reutiliza una conexión entre peticiones. Con 0 se abre una
+        # conexión nueva por cada petición.
+        # NOTA: Sólo sirve bajo un servidor WSGI (gunicorn, etc.), cuyos hilos atienden
+        # una petición tras otra. Bajo ASGI (daphne, runserver) cada petición corre en
+        # un hilo nuevo y la conexión nunca se reutiliza, así que PrimosCheckIn/asgi.py
+        # la deja en 0 y se usa un pooler (véase POSTGRES_POOLER y docker-compose.yml).
+        'CONN_MAX_AGE': int(os.environ.get('POSTGRES_CONN_MAX_AGE', 0)),
+        # Antes de reutilizar una conexión se comprueba que siga viva (véase tracks/db.py)
+        'CONN_HEALTH_CHECKS': env_flag('POSTGRES_CONN_HEALTH_CHECKS'),
+        # Si POSTGRES_HOST apunta a un pooler en modo transaction (pgbouncer), los
+        # cursores del lado del servidor que usa QuerySet.iterator() no funcionan
+        'DISABLE_SERVER_SIDE_CURSORS': env_flag('POSTGRES_POOLER'),
     }
 }
 
@@ -123,6 +143,11 @@ USE_I18N = True
 # Esto se pone falso para que el tiempo sea relativo a TIME_ZONE, de lo contrario será el tiempo en GTM
 USE_TZ = False
 
+# Mantiene todos los turnos perdonados en memoria (véase tracks/caches.py). Sólo
+# conviene activarlo si hay un único proceso atendiendo la api, ya que cada proceso
+# invalida únicamente su propia copia.
+PARDON_CACHE = env_flag('PARDON_CACHE')
+
 CORS_ORIGIN_ALLOW_ALL=True
 #SECURE_PROXY_SSL_HEADER = ('HTTP_X_FORWARDED_PROTO', 'https')
 #SESSION_COOKIE_SECURE = True
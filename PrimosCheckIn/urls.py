@@ -16,9 +16,11 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path
 from tracks.api import api
+from tracks import asyncapi
 
 
 urlpatterns = [
     path("admin/", admin.site.urls),
+    path("api/async/", asyncapi.api.urls),
     path("api/", api.urls),
 ]
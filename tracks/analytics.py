@@ -0,0 +1,360 @@
+from datetime import date, datetime, time, timedelta
+from typing import List, NamedTuple
+
+import numpy as np
+from django.db.models.functions import ExtractDay, ExtractHour, ExtractIsoWeekDay, ExtractMinute, ExtractMonth, ExtractYear, TruncDate
+
+from tracks.models import *
+from tracks import utils
+from tracks import parameters
+from tracks import caches
+
+# Motor de estadísticas de puntualidad. En lugar de recorrer los turnos uno por uno,
+# carga los turnos registrados y los turnos esperados en arreglos de NumPy (instantes
+# en microsegundos desde epoch, días desde epoch e índices de bloque) y calcula todo
+# de una vez con operaciones sobre los arreglos.
+# NOTA: Los días se cuentan desde 1970-01-01, que fue jueves, por eso el día de la
+# semana es (día + 3) % 7.
+
+blockStarts = np.array(parameters.blockStarts, dtype='timedelta64[us]')
+blockEnds = np.array(parameters.blockEnds, dtype='timedelta64[us]')
+# Minuto del día en que comienza cada bloque, para calcular los datapoints
+blockStartMinutes = blockStarts // np.timedelta64(1, 'm')
+
+beforeStartTolerance = np.timedelta64(parameters.beforeStartTolerance, 'us')
+afterStartTolerance = np.timedelta64(parameters.afterStartTolerance, 'us')
+afterEndTolerance = np.timedelta64(parameters.afterEndTolerance, 'us')
+
+def weekdays(days: np.ndarray) -> np.ndarray:
+    return (days.astype(np.int64) + 3) % 7
+
+# Llave única de un turno (día, bloque) que cabe en un entero
+def keys(days, blocks):
+    return np.asarray(days).astype(np.int64)*len(parameters.Block) + blocks
+
+# Columnas de los turnos registrados de un primo, ordenados por checkin
+class Stamps(NamedTuple):
+    id: np.ndarray # int64
+    checkin: np.ndarray # datetime64[us]
+    checkout: np.ndarray # datetime64[us], NaT si el turno no se ha cerrado
+
+    @classmethod
+    def fromRows(cls, rows: List[tuple]) -> 'Stamps':
+        # <rows>: Tuplas (id, checkin, checkout), como las de values_list
+        return cls(
+            np.array([row[0] for row in rows], dtype=np.int64),
+            np.array([row[1] for row in rows], dtype='datetime64[us]'),
+            np.array([row[2] for row in rows], dtype='datetime64[us]'),
+        )
+
+# Turnos registrados ya clasificados, cada arreglo tiene un elemento por turno
+class Classification(NamedTuple):
+    day: np.ndarray # datetime64[D], día del bloque al que se aproximó el turno
+    block: np.ndarray # Índice del bloque al que se aproximó el turno
+    inSchedule: np.ndarray # bool, entrada y salida dentro de las tolerancias
+    datapoint: np.ndarray # Minutos de anticipación con los que se inició el turno
+
+# Equivalente a aplicar utils.aproximateToShift (en modo estricto) a cada turno
+# registrado y luego comprobar las tolerancias de entrada y salida del bloque. Si no
+# es <strict>, los turnos que no se aproximan a ningún bloque quedan con el bloque -1
+# (y fuera del horario) en lugar de lanzar un error.
+def classify(stamps: Stamps, strict: bool = True) -> Classification:
+    day = stamps.checkin.astype('datetime64[D]')
+    moment = stamps.checkin - day
+
+    # Igual que en aproximateToShift, el único candidato es el primer bloque que
+    # aún no termina
+    block = np.searchsorted(blockEnds, moment, side='left')
+    valid = (weekdays(day) < 5) & (block < len(parameters.Block))
+    block = np.minimum(block, len(parameters.Block) - 1)
+    start = blockStarts[block]
+    valid &= (start <= moment) | (start - beforeStartTolerance < moment)
+    if strict and not valid.all():
+        # Lanza el mismo error que aproximateToShift
+        utils.aproximateToShift(stamps.checkin[np.argmin(valid)].item())
+
+    shiftCheckin = day + start
+    shiftCheckout = day + blockEnds[block]
+    rightCheckin = (shiftCheckin - beforeStartTolerance < stamps.checkin) & (stamps.checkin < shiftCheckin + afterStartTolerance)
+    # Las comparaciones con NaT (turnos sin cerrar) siempre son falsas
+    rightCheckout = (shiftCheckout < stamps.checkout) & (stamps.checkout < shiftCheckout + afterEndTolerance)
+
+    datapoint = blockStartMinutes[block] - moment // np.timedelta64(1, 'm')
+    if not strict:
+        block = np.where(valid, block, -1)
+        return Classification(day, block, rightCheckin & rightCheckout & valid, datapoint)
+    return Classification(day, block, rightCheckin & rightCheckout, datapoint)
+
+# Días entre <start> y <end> (ambos incluidos) y los turnos perdonados <pardoned>
+# (pares fecha, índice del bloque) de ese rango. Se expande una sola vez y se
+# comparte entre todos los horarios que se evalúen en el mismo rango.
+class Calendar():
+    def __init__(self, start: date, end: date, pardoned: set = frozenset()):
+        self.start, self.end = start, end
+        self.days = np.arange(start, end + timedelta(days=1), dtype='datetime64[D]')
+        self.weekdays = weekdays(self.days)
+        self.pardonedKeys = np.array([keys(np.datetime64(day, 'D'), block) for day, block in pardoned], dtype=np.int64)
+
+    # Retorna los días y bloques de todos los turnos del horario <schedule> (pares día
+    # de la semana, índice del bloque) en el calendario, ordenados cronológicamente y
+    # sin los turnos perdonados. Cada turno del horario cae cada 7 días a partir del
+    # primer día del calendario con su día de la semana, así que se calculan todos de
+    # una vez sin recorrer el calendario.
+    def expectedShifts(self, schedule: List[tuple]):
+        scheduleWeekdays = np.array([weekday for weekday, _ in schedule], dtype=np.int64)
+        scheduleBlocks = np.array([block for _, block in schedule], dtype=np.int64)
+        if not len(self.days):
+            return self.days, scheduleBlocks[:0]
+
+        first = (scheduleWeekdays - self.weekdays[0]) % 7
+        counts = np.maximum((len(self.days) - first + 6) // 7, 0)
+        # El turno j del horario se repite counts[j] veces, en los días first[j] + 7*semana
+        scheduleIndex = np.repeat(np.arange(len(schedule)), counts)
+        week = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        dayIndex = first[scheduleIndex] + 7*week
+        # Los bloques se declaran en orden, así que su índice también es cronológico
+        order = np.lexsort((scheduleBlocks[scheduleIndex], dayIndex))
+        days, blocks = self.days[dayIndex[order]], scheduleBlocks[scheduleIndex[order]]
+
+        if len(self.pardonedKeys):
+            keep = ~np.isin(keys(days, blocks), self.pardonedKeys)
+            days, blocks = days[keep], blocks[keep]
+        return days, blocks
+
+# Días y bloques de todos los turnos del horario <schedule> (en el formato del regex)
+# entre <start> y <end>, ambos incluidos, como arreglos
+def expectedShifts(schedule: str, start: date, end: date):
+    return Calendar(start, end).expectedShifts(utils.scheduleShifts(schedule))
+
+# Arma la respuesta de /shifts a partir de los turnos registrados <stamps> de <primo>
+# (ya clasificados en <classification>) y de su horario <schedule>
+def resume(primo: Primo, stamps: Stamps, classification: Classification, schedule: List[tuple], calendar: Calendar) -> dict:
+    naturalPrimo = {
+        "mail": primo.mail,
+        "nick": primo.nick,
+    }
+
+    ids, blocks = stamps.id.tolist(), classification.block.tolist()
+    checkins, checkouts = stamps.checkin.tolist(), stamps.checkout.tolist()
+    shiftStarts = (classification.day + blockStarts[classification.block]).tolist()
+    shiftEnds = (classification.day + blockEnds[classification.block]).tolist()
+    registered = [{
+        "id": ids[i],
+        "primo": naturalPrimo,
+        "checkin": checkins[i],
+        "checkout": checkouts[i],
+        "block": parameters.Block[blocks[i]].name,
+        "start": shiftStarts[i],
+        "end": shiftEnds[i],
+    } for i in range(len(ids))]
+    # Los turnos que no se aproximan a ningún bloque (bloque -1, véase classify) se
+    # aproximan sin modo estricto, igual que en /shifts/history, y quedan como sospechosos
+    for i in np.flatnonzero(classification.block < 0).tolist():
+        shift = utils.aproximateToShift(checkins[i], False)
+        registered[i].update({
+            "block": shift.block.name,
+            "start": datetime.combine(shift.day, shift.block.start),
+            "end": datetime.combine(shift.day, shift.block.end),
+        })
+
+    # Cada turno esperado se empareja con el primer turno correctamente registrado
+    # en el mismo día y bloque
+    days, expectedBlocks = calendar.expectedShifts(schedule)
+    inSchedule = np.flatnonzero(classification.inSchedule)
+    stampKeys, first = np.unique(keys(classification.day[inSchedule], classification.block[inSchedule]), return_index=True)
+    expectedKeys = keys(days, expectedBlocks)
+    if len(stampKeys):
+        position = np.minimum(np.searchsorted(stampKeys, expectedKeys), len(stampKeys) - 1)
+        matched = stampKeys[position] == expectedKeys
+        match = inSchedule[first[position]]
+    else:
+        matched = np.zeros(len(expectedKeys), dtype=bool)
+        match = np.zeros(len(expectedKeys), dtype=np.int64)
+
+    datapoints, labels, shifts = [], [], []
+    for day, block, isMatched, j in zip(days.tolist(), expectedBlocks.tolist(), matched.tolist(), match.tolist()):
+        block = parameters.Block[block]
+        labels.append(f"{parameters.days['mid'][day.weekday()]} {block.name}")
+        if isMatched:
+            datapoints.append(int(classification.datapoint[j]))
+            shifts.append(registered[j])
+        else:
+            datapoints.append(None)
+            shifts.append({
+                "id": None,
+                "primo": None,
+
+                "checkin": None,
+                "checkout": None,
+
+                "block": block.name,
+                "start": datetime.combine(day, block.start),
+                "end": datetime.combine(day, block.end),
+            })
+
+    return {
+        "primo": naturalPrimo,
+        "start": calendar.start,
+        "end": calendar.end,
+
+        "shifts": shifts,
+        "suspicious": [registered[i] for i in np.flatnonzero(~classification.inSchedule).tolist()],
+
+        "datapoints": datapoints,
+        "labels": labels,
+    }
+
+# Horario de <primo> como pares (día de la semana, índice del bloque). Se lee de
+# Primo.schedule porque el primo ya está cargado, así no se consulta ScheduledShift.
+def primoSchedule(primo: Primo) -> List[tuple]:
+    return list(utils.scheduleShifts(primo.schedule))
+
+# Carga los turnos registrados de <primo> entre <start> y <end> y arma la respuesta de /shifts
+def primoResume(primo: Primo, start: date, end: date) -> dict:
+    stamps = Stamps.fromRows(StampedShift.objects.filter(checkin__gte=start, checkin__lte=end, primo=primo).values_list('id', 'checkin', 'checkout'))
+    calendar = Calendar(start, end, caches.pardonedShifts(start, end))
+    # Sin modo estricto, para que un turno que no se aproxima a ningún bloque no impida
+    # armar la respuesta
+    return resume(primo, stamps, classify(stamps, strict=False), primoSchedule(primo), calendar)
+
+# Primos con su horario (pares día de la semana, índice del bloque) leído desde
+# ScheduledShift, en una sola consulta
+def teamSchedules() -> List[tuple]:
+    primos = {}
+    for rol, mail, nick, weekday, block in Primo.objects.order_by('rol').values_list('rol', 'mail', 'nick', 'scheduledshift__weekday', 'scheduledshift__block'):
+        _, schedule = primos.setdefault(rol, (Primo(rol=rol, mail=mail, nick=nick), []))
+        # Los primos sin horario vienen con una sola fila sin turno (LEFT JOIN)
+        if weekday is not None:
+            schedule.append((weekday, block))
+    return list(primos.values())
+
+# Posiciones de los turnos del primo con rol <rol> en <primoIds>, el primo de cada
+# turno registrado. Los turnos deben venir ordenados por primo, así los de cada primo
+# quedan contiguos.
+def primoGroup(primoIds: np.ndarray, rol: int) -> slice:
+    return slice(np.searchsorted(primoIds, rol, 'left'), np.searchsorted(primoIds, rol, 'right'))
+
+# Arma la respuesta de /shifts para todos los primos a la vez. Hace una sola consulta
+# por los turnos registrados de todos los primos, una por los primos y sus horarios y
+# una por los turnos perdonados, y expande el calendario una sola vez.
+def teamResume(start: date, end: date) -> List[dict]:
+    rows = StampedShift.objects.filter(checkin__gte=start, checkin__lte=end).order_by('primo', 'checkin').values_list('primo', 'id', 'checkin', 'checkout')
+    primoIds = np.array([row[0] for row in rows], dtype=np.int64)
+    stamps = Stamps.fromRows([row[1:] for row in rows])
+    # Igual que en primoResume, un turno mal registrado de un primo no impide armar el
+    # reporte de todos los demás
+    classification = classify(stamps, strict=False)
+    calendar = Calendar(start, end, caches.pardonedShifts(start, end))
+
+    resumes = []
+    for primo, schedule in teamSchedules():
+        group = primoGroup(primoIds, primo.rol)
+        resumes.append(resume(
+            primo,
+            Stamps(*(column[group] for column in stamps)),
+            Classification(*(column[group] for column in classification)),
+            schedule,
+            calendar,
+        ))
+    return resumes
+
+# Estadísticas de puntualidad calculadas por la base de datos. Las mismas reglas de
+# classify se escriben como condiciones sobre la hora del checkin y del checkout (una
+# por bloque, generadas desde parameters.Block y las tolerancias), así la base de
+# datos comprueba las tolerancias y entrega sólo los conteos por primo en lugar de
+# todos los turnos registrados.
+# NOTA: Si un primo registró más de una vez el mismo turno, cada registro correcto
+# cuenta en onTime, late y lateness, aunque el turno se cuente una sola vez en attended.
+
+# Hora <offset> después de <t>
+def _shifted(t: time, offset: timedelta) -> time:
+    return (datetime.combine(date.min, t) + offset).time()
+
+# Ventana de entrada de cada bloque, como pares (desde, hasta) sin incluir los extremos
+checkinWindows = [(_shifted(block.start, -parameters.beforeStartTolerance), _shifted(block.start, parameters.afterStartTolerance)) for block in parameters.Block]
+
+# Condición de que un turno registrado esté dentro del horario de su bloque. Como
+# ningún bloque cruza la medianoche, basta comparar la hora del checkin y del
+# checkout con los límites de cada bloque.
+def inScheduleCondition() -> Q:
+    condition = Q()
+    for block, (since, until) in zip(parameters.Block, checkinWindows):
+        window = Q(
+            checkin__time__gt=since,
+            checkin__time__lt=until,
+            checkout__date=F('checkin__date'),
+            checkout__time__gt=block.end,
+            checkout__time__lt=_shifted(block.end, parameters.afterEndTolerance),
+        )
+        if block.index > 0:
+            # Si el descanso es más corto que la tolerancia, el turno se aproxima al
+            # bloque anterior mientras éste no termine
+            window &= Q(checkin__time__gt=parameters.Block[block.index - 1].end)
+        condition |= window
+    return Q(checkin__iso_week_day__lte=5) & condition
+
+# Expresión con el valor de <values> (uno por bloque) del bloque en cuya ventana de
+# entrada cae el checkin. Sólo tiene sentido para turnos dentro del horario.
+def _byCheckinWindow(values: list):
+    return Case(*(When(checkin__time__lt=until, then=Value(value)) for (_, until), value in zip(checkinWindows, values)), default=Value(None))
+
+# Conteos de puntualidad de los primos de <team> (pares primo, horario) entre <start>
+# y <end> (ambos incluidos), sólo de los turnos de <primo> si no es None. Sólo los
+# turnos esperados se cuentan en Python, a partir del horario.
+def punctuality(team: List[tuple], start: date, end: date, primo: Primo | None = None) -> List[dict]:
+    stamps = StampedShift.objects.filter(checkin__gte=start, checkin__lt=end + timedelta(days=1))
+    if primo is not None:
+        stamps = stamps.filter(primo=primo)
+    inSchedule = inScheduleCondition()
+
+    # Turnos correctos que corresponden a un turno esperado, es decir, del horario
+    # del primo y no perdonados
+    counted = stamps.filter(inSchedule).annotate(
+        date=TruncDate('checkin'),
+        weekday=ExtractIsoWeekDay('checkin') - 1,
+        block=_byCheckinWindow([block.index for block in parameters.Block]),
+    ).filter(
+        Exists(ScheduledShift.objects.filter(primo=OuterRef('primo'), weekday=OuterRef('weekday'), block=OuterRef('block'))),
+        ~Exists(PardonedShift.objects.filter(date=OuterRef('date'), block=OuterRef('block'))),
+    ).annotate(
+        lateness=ExtractHour('checkin')*60 + ExtractMinute('checkin') - _byCheckinWindow([block.start.hour*60 + block.start.minute for block in parameters.Block]),
+        # Llave única del turno (día, bloque) como entero
+        shift=(ExtractYear('checkin')*10000 + ExtractMonth('checkin')*100 + ExtractDay('checkin'))*len(parameters.Block) + F('block'),
+    ).values('primo').order_by('primo').annotate(
+        attended=Count('shift', distinct=True),
+        onTime=Count('pk', filter=Q(lateness__lte=0)),
+        late=Count('pk', filter=Q(lateness__gt=0)),
+        lateness=Avg('lateness'),
+    )
+    counts = {row['primo']: row for row in counted}
+    totals = {row['primo']: row for row in stamps.values('primo').order_by('primo').annotate(total=Count('pk'), inSchedule=Count('pk', filter=inSchedule))}
+
+    calendar = Calendar(start, end, caches.pardonedShifts(start, end))
+    summaries = []
+    for primo, schedule in team:
+        row = counts.get(primo.rol, {"attended": 0, "onTime": 0, "late": 0, "lateness": None})
+        total = totals.get(primo.rol, {"total": 0, "inSchedule": 0})
+        expected = len(calendar.expectedShifts(schedule)[0])
+        summaries.append({
+            "primo": {
+                "mail": primo.mail,
+                "nick": primo.nick,
+            },
+            "start": start,
+            "end": end,
+
+            "expected": expected,
+            "attended": row["attended"],
+            "onTime": row["onTime"],
+            "late": row["late"],
+            "missing": expected - row["attended"],
+            "suspicious": total["total"] - total["inSchedule"],
+            "lateness": row["lateness"],
+        })
+    return summaries
+
+def primoPunctuality(primo: Primo, start: date, end: date) -> dict:
+    return punctuality([(primo, primoSchedule(primo))], start, end, primo)[0]
+
+def teamPunctuality(start: date, end: date) -> List[dict]:
+    return punctuality(teamSchedules(), start, end)
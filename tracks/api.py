@@ -1,15 +1,30 @@
 # Django
 from django.shortcuts import get_object_or_404
+from django.db import transaction
 from django.db.utils import IntegrityError
-from django.forms.models import model_to_dict
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
 from ninja import NinjaAPI, Schema
+from ninja.renderers import NinjaJSONEncoder
 # Classes & Typing
-from datetime import datetime, time, timedelta, date
-from typing import List, Optional
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime, date, timedelta
+from functools import partial
+from itertools import islice
+from typing import List, Literal, Optional
 
 from tracks.models import *
 from tracks import utils
 from tracks import parameters
+from tracks import caches
+from tracks import analytics
+from tracks import metrics
+from tracks import events
+from tracks import attendance
+from tracks import export
 
 api = NinjaAPI()
 
@@ -86,24 +101,76 @@ class Resume(Schema):
     datapoints: List[int]
     labels: List[str]
 
+# Asistencia de un primo en un rango de fechas, contada desde la tabla Attendance
+class AttendanceSummary(Schema):
+    primo: NaturalPrimo
+
+    onTime: int
+    late: int
+    suspicious: int
+    missing: int
+    pardoned: int
+
+    # Minutos de atraso promedio de los turnos a tiempo o atrasados (negativo si
+    # llegó antes en promedio)
+    lateness: Optional[float]
+
+# Conteos de puntualidad de un primo calculados por la base de datos (véase
+# analytics.punctuality)
+class Punctuality(Schema):
+    primo: NaturalPrimo
+    start: date
+    end: date
+
+    expected: int # Turnos del horario, sin los perdonados
+    attended: int # Turnos esperados con un turno correctamente registrado
+    onTime: int
+    late: int
+    missing: int
+    suspicious: int # Turnos registrados fuera de las tolerancias
+
+    lateness: Optional[float] # Minutos de atraso promedio de los turnos correctos
+
+# Una página del historial de turnos registrados. <next> es el cursor con el que se
+# pide la página siguiente, nulo si ésta es la última.
+class ShiftHistory(Schema):
+    shifts: List[RegisteredShift]
+    next: Optional[str]
+
 class PushShift(Schema):
     mail: str
 
 class UpdateShift(Schema):
     id: int
 
+# Una entrada o salida registrada por un kiosko mientras estaba sin conexión. Las
+# salidas cierran el último turno abierto del primo, porque el kiosko no conoce el id
+# de los turnos que abrió sin conexión.
+class ShiftEvent(Schema):
+    type: Literal['checkin', 'checkout']
+    mail: str
+    at: datetime
+
+class ShiftBatch(Schema):
+    events: List[ShiftEvent]
+
+# Resultado de cada evento del lote, en el mismo orden en que se enviaron. <status>
+# es el código que habría respondido POST o PUT /shifts con ese evento.
+class ShiftEventResult(Schema):
+    status: int
+    detail: Optional[str]
+    shift: Optional[RegisteredShift]
+
 @api.get("/now", response=Now)
-@utils.logged
 def get_now_time(_):
-    now = utils.now()
+    return 200, now_payload(utils.now())
+
+# Respuesta de /now en el instante <now>, también la usa el stream de tracks/stream.py
+def now_payload(now: datetime) -> dict:
     upcoming = utils.aproximateToShift(now, False)
-    pair = []
-    for primo in Primo.objects.all():
-        schedule = utils.DEPRECATED_parseSchedule(primo.schedule)
-        if upcoming in schedule:
-            pair.append(primo)
+    pair = caches.primosOnDuty(upcoming.day.weekday(), upcoming.block)
 
-    return 200, {
+    return {
         "weekday": now.weekday(),
         "time": now.time().isoformat('minutes'),
         "datetime": now,
@@ -112,13 +179,12 @@ def get_now_time(_):
             "block": upcoming.block.name,
             "checkin": upcoming.checkin,
             "checkout": upcoming.checkout,
-            "isactive": (upcoming.checkin  - parameters.beforeStartTolerance) < utils.now() < (upcoming.checkin  + parameters.afterStartTolerance)
+            "isactive": (upcoming.checkin  - parameters.beforeStartTolerance) < now < (upcoming.checkin  + parameters.afterStartTolerance)
         },
         "pair": pair
     }
 
 @api.get("/primos", response=List[NaturalPrimo])
-@utils.logged
 def get_primos(_):
     return 200, [{
         "mail": primo.mail,
@@ -126,7 +192,6 @@ def get_primos(_):
     } for primo in Primo.objects.all()]
 
 @api.get("/primos/{str:mail}", response=CurrentPrimo)
-@utils.logged
 def get_primo(_, mail: str):
     primo = get_object_or_404(Primo, mail=mail.lower())
     try:
@@ -146,8 +211,7 @@ def get_primo(_, mail: str):
             "checkout": rshift.checkout
         }
     except StampedShift.DoesNotExist:
-        _, schedule = utils.parseSchedule(primo.schedule)
-        nshift = next(schedule)# utils.DEPRECATED_parseSchedule(primo.schedule)[0]
+        nshift = utils.upcomingShift(primo.schedule)
         running = None
 
     return 200, {
@@ -163,98 +227,159 @@ def get_primo(_, mail: str):
     }
 
 @api.get("/shifts")
-@utils.logged
 def get_shifts(_, mail: str, start: date, end: date | None = None):
     if end is None:
         end = utils.now().date()
     primo = get_object_or_404(Primo, mail=mail.lower())
 
-    inSchedule, suspicious = [], []
-    for stampedShift in StampedShift.objects.filter(checkin__gte=start, checkin__lte=end, primo=primo):
-        shift = utils.aproximateToShift(stampedShift.checkin)
-        fshift = model_to_dict(stampedShift)
-        fshift.update({
-            "primo": {
-                "mail": stampedShift.primo.mail,
-                "nick": stampedShift.primo.nick,
-            },
-            "block": shift.block.name,
-            "start": datetime.combine(shift.day, shift.block.start),
-            "end": datetime.combine(shift.day, shift.block.end),
-        })
+    return 200, analytics.primoResume(primo, start, end)
 
-        rightCheckin = (shift.checkin - parameters.beforeStartTolerance) < fshift["checkin"] < (shift.checkin  + parameters.afterStartTolerance)
-        rigthCheckout = (fshift["checkout"] is not None) and (shift.checkout < fshift["checkout"] < (shift.checkout + parameters.afterEndTolerance))
-        if rightCheckin and rigthCheckout:
-            inSchedule.append(fshift)
-        else:
-            suspicious.append(fshift)
-    
-    pardonedShifts = [utils.Shift(shift.date, parameters.Block[shift.block]) for shift in PardonedShift.objects.all()]
-    _, schedule = utils.parseSchedule(primo.schedule, datetime.combine(start, time())) 
-    datapoints, labels, shifts = [], [], []
-    j, k = 0, 0
-    while (shift := next(schedule)).day <= end:
-        while k < len(pardonedShifts) and pardonedShifts[k] < shift:
-            k += 1
-
-        if k >= len(pardonedShifts) or shift != pardonedShifts[k]:
-            labels.append(f"{parameters.days['mid'][shift.day.weekday()]} {shift.block.name}")
-            if (
-                    j < len(inSchedule)
-                and shift.day == inSchedule[j]["checkin"].date()
-                and shift.block.name == inSchedule[j]["block"]
-            ):
-                checkinTime = inSchedule[j]["checkin"].time()
-                shiftStartTime = shift.block.start
-                datapoints.append(60*(shiftStartTime.hour - checkinTime.hour) + shiftStartTime.minute - checkinTime.minute)
-
-                shifts.append(inSchedule[j])
-
-                j += 1
-            else:
-                datapoints.append(None)
-                shifts.append({
-                    "id": None,
-                    "primo": None,
-
-                    "checkin": None,
-                    "checkout": None,
-                    
-                    "block": shift.block.name,
-                    "start": datetime.combine(shift.day, shift.block.start),
-                    "end": datetime.combine(shift.day, shift.block.end),
-                })
+# Igual que /shifts, pero para todos los primos en una sola llamada
+@api.get("/shifts/report")
+def get_shifts_report(_, start: date, end: date | None = None):
+    if end is None:
+        end = utils.now().date()
+    return 200, analytics.teamResume(start, end)
 
-    return 200, {
+# Igual que /shifts/attendance, pero calculado por la base de datos directamente
+# desde los turnos registrados, sin depender de la tabla Attendance
+@api.get("/shifts/punctuality", response=List[Punctuality])
+def get_shifts_punctuality(_, start: date, end: date | None = None, mail: str | None = None):
+    if end is None:
+        end = utils.now().date()
+    if mail is not None:
+        return 200, [analytics.primoPunctuality(get_object_or_404(Primo, mail=mail.lower()), start, end)]
+    return 200, analytics.teamPunctuality(start, end)
+
+# Conteos de asistencia por primo (o sólo de <mail>) entre <start> y <end>, en una
+# sola agregación sobre la tabla Attendance
+@api.get("/shifts/attendance", response=List[AttendanceSummary])
+def get_shifts_attendance(_, start: date, end: date | None = None, mail: str | None = None):
+    if end is None:
+        end = utils.now().date()
+    rows = Attendance.objects.filter(date__gte=start, date__lte=end)
+    if mail is not None:
+        rows = rows.filter(primo=get_object_or_404(Primo, mail=mail.lower()))
+
+    Status = Attendance.Status
+    rows = rows.values('primo', 'primo__mail', 'primo__nick').order_by('primo').annotate(
+        onTime=Count('pk', filter=Q(status=Status.ONTIME)),
+        late=Count('pk', filter=Q(status=Status.LATE)),
+        suspicious=Count('pk', filter=Q(status=Status.SUSPICIOUS)),
+        missing=Count('pk', filter=Q(status=Status.MISSING)),
+        pardoned=Count('pk', filter=Q(status=Status.PARDONED)),
+        lateness=Avg('lateness', filter=Q(status__in=[Status.ONTIME, Status.LATE])),
+    )
+    return 200, [{
         "primo": {
-            "mail": primo.mail,
-            "nick": primo.nick,
+            "mail": row["primo__mail"],
+            "nick": row["primo__nick"],
         },
-        "start": start,
-        "end": end,
 
-        "shifts": shifts,
+        "onTime": row["onTime"],
+        "late": row["late"],
+        "suspicious": row["suspicious"],
+        "missing": row["missing"],
+        "pardoned": row["pardoned"],
+        "lateness": row["lateness"],
+    } for row in rows]
 
-        #"stamped": inSchedule,
-        "suspicious": suspicious,
+# Máximo de turnos por página de /shifts/history
+historyLimit = 500
 
-        "datapoints": datapoints,
-        "labels": labels,
+# El cursor es el (checkin, id) del último turno de la página, codificado para que
+# los clientes lo traten como un valor opaco
+def history_cursor(checkin: datetime, id: int) -> str:
+    return urlsafe_b64encode(f'{checkin.isoformat()} {id}'.encode()).decode()
+
+def parse_history_cursor(cursor: str) -> tuple:
+    checkin, id = urlsafe_b64decode(cursor.encode()).decode().split(' ')
+    return datetime.fromisoformat(checkin), int(id)
+
+def history_row(id: int, checkin: datetime, checkout: datetime | None, mail: str, nick: str) -> dict:
+    return {
+        "id": id,
+
+        "primo": {
+            "mail": mail,
+            "nick": nick,
+        },
+
+        # Sin modo estricto, porque el historial incluye cualquier turno guardado
+        "block": utils.aproximateToShift(checkin, False).block.name,
+
+        "checkin": checkin,
+        "checkout": checkout,
     }
 
+# Turnos registrados entre <start> y <end> (de todos los primos o sólo de <mail>)
+# ordenados por (checkin, id) y paginados con un cursor sobre ese mismo orden, así
+# cada página es una consulta por índice sin importar lo lejos que esté. Con <stream>
+# se entrega todo el resto del rango como un arreglo JSON que se va escribiendo a
+# medida que se leen los turnos, sin armar la respuesta completa en memoria.
+@api.get("/shifts/history", response={200: ShiftHistory, 403: Detail})
+def get_shift_history(_, start: date, end: date | None = None, mail: str | None = None, cursor: str | None = None, limit: int = 100, stream: bool = False):
+    if end is None:
+        end = utils.now().date()
+    if not 0 < limit <= historyLimit:
+        return 403, {"detail": f"The limit must be between 1 and {historyLimit}"}
+
+    rows = StampedShift.objects.filter(checkin__gte=start, checkin__lt=end + timedelta(days=1))
+    if mail is not None:
+        rows = rows.filter(primo=get_object_or_404(Primo, mail=mail.lower()))
+    if cursor is not None:
+        try:
+            checkin, id = parse_history_cursor(cursor)
+        except ValueError:
+            return 403, {"detail": "Invalid cursor"}
+        rows = rows.filter(Q(checkin__gt=checkin) | Q(checkin=checkin, id__gt=id))
+    rows = rows.order_by('checkin', 'id').values_list('id', 'checkin', 'checkout', 'primo__mail', 'primo__nick')
+
+    if stream:
+        # Bajo ASGI los turnos se leen fuera del event loop (véase tracks/stream.py)
+        return StreamingHttpResponse(stream_history(rows.iterator(chunk_size=2000)), content_type='application/json')
+
+    # Se pide un turno de más para saber si hay una página siguiente
+    page = list(rows[:limit + 1])
+    last = page[limit - 1] if len(page) > limit else None
+    return 200, {
+        "shifts": [history_row(*row) for row in page[:limit]],
+        "next": None if last is None else history_cursor(last[1], last[0]),
+    }
+
+# Arreglo JSON con los turnos <rows>, escrito por tramos de <size> turnos
+def stream_history(rows, size: int = 2000):
+    separator = '['
+    while batch := list(islice(rows, size)):
+        yield separator + ','.join(json.dumps(history_row(*row), cls=NinjaJSONEncoder) for row in batch)
+        separator = ','
+    yield '[]' if separator == '[' else ']'
+
+# Descarga de los turnos registrados entre <start> y <end> con su primo, bloque y
+# puntualidad en el formato <format> (véase tracks/export.py). El archivo se escribe a
+# medida que se leen los turnos; para rangos de varios años conviene el comando
+# exportshifts, que no ocupa un worker del servidor.
+@api.get("/shifts/export", response={403: Detail})
+def export_shifts(_, start: date, end: date | None = None, format: str = 'csv'):
+    if end is None:
+        end = utils.now().date()
+    if format not in export.formats:
+        return 403, {"detail": f"Unavailable format ({format}), the options are: {', '.join(export.formats)}"}
+
+    contentType, extension, write = export.formats[format]
+    # Bajo ASGI los turnos se leen y se escriben fuera del event loop (véase tracks/stream.py)
+    response = StreamingHttpResponse(write(export.chunks(start, end)), content_type=contentType)
+    response['Content-Disposition'] = f'attachment; filename="shifts-{start}-{end}.{extension}"'
+    return response
+
 @api.post("/shifts", response={200: RegisteredShift, 403: Detail})
-@utils.logged
 def push_a_shift(_, payload: PushShift):
     now = utils.now()
-    primo = get_object_or_404(Primo, mail=payload.mail)
-    shifts = utils.DEPRECATED_parseSchedule(primo.schedule)
+    # Aquí se verifica si el turno que estás intentando pushear corresponde a alguno
+    # de los turnos de tu horario, en la misma consulta que trae al primo
+    primo = get_object_or_404(Primo.objects.annotate(onShift=ScheduledShift.onShift(now)), mail=payload.mail)
     
-    # Aquí se verifica si el turno que estás intentando pushear corresponde a alguno de los turnos de tu horario
-    for shift in shifts:
-        if (shift.checkin - parameters.beforeStartTolerance) < now < (shift.checkin + parameters.afterStartTolerance): #< (shift["checkout"] + parameters.afterEndTolerance):
-            break
-    else:
+    if not primo.onShift:
         return 403, {"detail": "You're not on your shift"}
     
     shift = StampedShift.objects.create(**{"primo": primo, "checkin": now})
@@ -271,11 +396,22 @@ def push_a_shift(_, payload: PushShift):
         "checkin": shift.checkin,
     }
 
+# La semana se guarda ya renderizada en caches.weekShifts, y se responde con su ETag
+# y Last-Modified para que los clientes puedan preguntar si cambió (304).
 @api.get("/shifts/week", response=List[List[RegisteredShift]])
-@utils.logged
-def get_week_shifts(_):
+def get_week_shifts(request):
+    week = caches.weekShifts(utils.firstWeekday(), lambda: api.create_response(request, _week_shifts(), status=200).content)
+    if (response := get_conditional_response(request, etag=week.etag, last_modified=week.lastModified)) is None:
+        response = HttpResponse(week.content, content_type=f'{api.renderer.media_type}; charset={api.renderer.charset}')
+    response['ETag'] = week.etag
+    response['Last-Modified'] = http_date(week.lastModified)
+    # Los clientes pueden guardar la respuesta, pero deben validarla antes de usarla
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+def _week_shifts():
     week = [[], [], [], [], []]
-    for shift in StampedShift.objects.filter(checkin__gte=utils.firstWeekday()):
+    for shift in StampedShift.objects.select_related('primo').filter(checkin__gte=utils.firstWeekday()):
         week[shift.checkin.weekday()].append({
             "id": shift.id,
             
@@ -290,33 +426,15 @@ def get_week_shifts(_):
             "checkout": shift.checkout,
         })
 
-    # Esta parte del código se encarga de fusionar turnos consecutivos
+    # Fusiona los turnos consecutivos de cada primo (véase utils.mergeConsecutiveShifts)
     # NOTA: Esto puede ocasionar que "desaparezca" el turno más reciente si renovaste
     # turno (en la respuesta), pero según el uso actual de esta llamada no debería pasar nada.
-    onemin = timedelta(minutes=1)
-    for day in week:
-        thisshift = 0
-        while thisshift < len(day):
-            nextshift = thisshift + 1
-            while nextshift < len(day):
-                if (day[thisshift]["checkout"] is None) or (day[nextshift]["checkin"] - day[thisshift]["checkout"]) > onemin:
-                    # Ya que los turnos están ordenados se que esta condición se va a cumplir para todos los siguientes turnos
-                    # NOTA: Releí este comentario ^^^ y lo entiendo para la primera condición, pero no para la segunda,
-                    # valdría la pena revisarlo.
-                    break
-                if day[thisshift]["primo"] == day[nextshift]["primo"]:
-                    # Fusiono dos turnos si la diferencia entre que finalizó uno y empezó otro es de menos de 1 minuto
-                    day[thisshift]["checkout"] = day.pop(nextshift)["checkout"]    
-                nextshift += 1
-            thisshift += 1
-    
-    return 200, week
+    return [utils.mergeConsecutiveShifts(day) for day in week]
 
 @api.put("/shifts", response={200: RegisteredShift, 403: Detail})
-@utils.logged
 def update_a_shift(_, payload: UpdateShift):
     now = utils.now()
-    shift = get_object_or_404(StampedShift, id=payload.id)
+    shift = get_object_or_404(StampedShift.objects.select_related('primo'), id=payload.id)
 
     if shift.checkin.date() != now.date():
         return 403, {"detail": "The check-in day is already over"}
@@ -340,8 +458,109 @@ def update_a_shift(_, payload: UpdateShift):
         "checkout": shift.checkout
     }
 
+# Máximo de eventos por lote
+batchLimit = 1000
+
+# Registra de una vez las entradas y salidas acumuladas por un kiosko sin conexión.
+# Cada evento se valida con las mismas reglas que POST y PUT /shifts, pero en el
+# instante <at> en que ocurrió en lugar de ahora, y los eventos se aplican en orden
+# cronológico. Todo se escribe en una sola transacción con bulk_create y bulk_update.
+# Los instantes con zona horaria se pasan a la hora local (TIME_ZONE), y los eventos
+# que ya estaban registrados (un kiosko que reenvía el mismo lote) no se repiten: se
+# responden con el turno existente y el detalle "Already registered".
+@api.post("/shifts/batch", response={200: List[ShiftEventResult], 403: Detail})
+def push_shift_batch(_, payload: ShiftBatch):
+    if len(payload.events) > batchLimit:
+        return 403, {"detail": f"Too many events ({len(payload.events)}), the limit is {batchLimit}"}
+    now = utils.now()
+    moments = [timezone.make_naive(event.at, timezone.get_default_timezone()) if timezone.is_aware(event.at) else event.at for event in payload.events]
+    primos = {primo.mail: primo for primo in Primo.objects.filter(mail__in={event.mail for event in payload.events})}
+    rols = {primo.rol: primo for primo in primos.values()}
+    # Turnos abiertos de cada primo ordenados por checkin, y los turnos ya registrados
+    # con la entrada o la salida de algún evento, en una sola consulta
+    running, checkins, checkouts = {}, {}, {}
+    for shift in StampedShift.objects.filter(primo__in=primos.values()).filter(
+        Q(checkout__isnull=True)
+      | Q(checkin__in=[at for event, at in zip(payload.events, moments) if event.type == 'checkin'])
+      | Q(checkout__in=[at for event, at in zip(payload.events, moments) if event.type == 'checkout'])
+    ).order_by('checkin'):
+        shift.primo = rols[shift.primo_id]
+        checkins[(shift.primo_id, shift.checkin)] = shift
+        if shift.checkout is None:
+            running.setdefault(shift.primo_id, []).append(shift)
+        else:
+            checkouts[(shift.primo_id, shift.checkout)] = shift
+
+    results = [None]*len(payload.events)
+    created, closed = [], []
+    for i in sorted(range(len(payload.events)), key=lambda i: moments[i]):
+        event, at = payload.events[i], moments[i]
+        if (primo := primos.get(event.mail)) is None:
+            results[i] = (404, "Not Found", None)
+        elif at > now:
+            results[i] = (403, "The event is in the future", None)
+        elif event.type == 'checkin':
+            if (shift := checkins.get((primo.rol, at))) is not None:
+                results[i] = (200, "Already registered", shift)
+                continue
+            block = utils.checkinBlock(at)
+            if block is None or (at.weekday(), block.index) not in utils.scheduleShifts(primo.schedule):
+                results[i] = (403, "You're not on your shift", None)
+                continue
+            shift = checkins[(primo.rol, at)] = StampedShift(primo=primo, checkin=at)
+            created.append(shift)
+            running.setdefault(primo.rol, []).append(shift)
+            results[i] = (200, None, shift)
+        elif (shift := checkouts.get((primo.rol, at))) is not None:
+            results[i] = (200, "Already registered", shift)
+        else:
+            # El último turno abierto antes de la salida
+            shifts = running.get(primo.rol, [])
+            shift = max((shift for shift in shifts if shift.checkin <= at), key=lambda shift: shift.checkin, default=None)
+            if shift is None:
+                results[i] = (403, "There is no running shift", None)
+            elif shift.checkin.date() != at.date():
+                results[i] = (403, "The check-in day is already over", None)
+            else:
+                shifts.remove(shift)
+                shift.checkout = at
+                checkouts[(primo.rol, at)] = shift
+                if shift.pk is not None:
+                    closed.append(shift)
+                results[i] = (200, None, shift)
+
+    with transaction.atomic():
+        StampedShift.objects.bulk_create(created)
+        StampedShift.objects.bulk_update(closed, ['checkout'])
+        # bulk_create y bulk_update no envían las señales de tracks/signals.py
+        for day in {shift.checkin.date() for shift in created + closed}:
+            transaction.on_commit(partial(caches.invalidateWeekShifts, day))
+        for shift in created:
+            transaction.on_commit(partial(events.publishShift, shift, True))
+        for shift in closed:
+            transaction.on_commit(partial(events.publishShift, shift, False))
+        for shift in created + closed:
+            attendance.refreshStampOnCommit(shift.primo_id, shift.checkin)
+
+    return 200, [{
+        "status": status,
+        "detail": detail,
+        "shift": None if shift is None else {
+            "id": shift.id,
+
+            "primo": {
+                "mail": shift.primo.mail,
+                "nick": shift.primo.nick,
+            },
+
+            "block": utils.aproximateToShift(shift.checkin).block.name,
+
+            "checkin": shift.checkin,
+            "checkout": shift.checkout,
+        },
+    } for status, detail, shift in results]
+
 @api.post("/shifts/pardon", response={200: NaturalShift, 403: Detail})
-@utils.logged
 def pardon_a_shift(_, payload: _PrimitiveShift):
     if 0 <= payload.block < len(parameters.Block):
         try:
@@ -356,3 +575,8 @@ def pardon_a_shift(_, payload: _PrimitiveShift):
             "checkout": datetime.combine(payload.date, block.end)
         }
     return 403, {"detail": f"Block ({payload.block}) out of the range (0..{len(parameters.Block) - 1})"}
+
+# Métricas de este proceso en el formato de texto de Prometheus (véase tracks/metrics.py)
+@api.get("/metrics", include_in_schema=False)
+def get_metrics(_):
+    return HttpResponse(metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
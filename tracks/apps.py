@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class TracksConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'tracks'
+
+    def ready(self):
+        # Conecta las señales que invalidan las cachés de tracks.caches, la
+        # comprobación de las conexiones persistentes y la medición de consultas
+        from tracks import signals, db, metrics
+        metrics.startLogging()
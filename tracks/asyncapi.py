@@ -0,0 +1,117 @@
+# Django
+from asgiref.sync import sync_to_async
+from django.shortcuts import get_object_or_404
+from ninja import NinjaAPI
+
+from tracks.models import *
+from tracks.api import Detail, Now, CurrentPrimo, RegisteredShift, PushShift, UpdateShift, now_payload
+from tracks import utils
+
+# Versiones asíncronas de los endpoints que reciben la ráfaga de llamadas al
+# comienzo de cada bloque (se montan en /api/async/). Responden exactamente lo
+# mismo que los de tracks/api.py, pero bajo un servidor ASGI no ocupan un hilo
+# mientras esperan a la base de datos, sólo durante cada consulta.
+# NOTA: Django 4.0 todavía no trae la interfaz asíncrona del ORM (aget, acreate,
+# etc. llegan en 4.1), así que aquí se definen las pocas que se usan, envolviendo
+# las síncronas con sync_to_async igual que lo hace Django internamente.
+
+api = NinjaAPI(urls_namespace='async')
+
+aget_object_or_404 = sync_to_async(get_object_or_404)
+
+async def aget(queryset, **kwargs):
+    return await sync_to_async(queryset.get)(**kwargs)
+
+async def acreate(model, **kwargs):
+    return await sync_to_async(model.objects.create)(**kwargs)
+
+async def asave(instance, **kwargs):
+    return await sync_to_async(instance.save)(**kwargs)
+
+@api.get("/now", response=Now)
+async def get_now_time(_):
+    return 200, await sync_to_async(now_payload)(utils.now())
+
+@api.get("/primos/{str:mail}", response=CurrentPrimo)
+async def get_primo(_, mail: str):
+    primo = await aget_object_or_404(Primo, mail=mail.lower())
+    try:
+        rshift = await aget(StampedShift.objects, checkin__gte=utils.now().date(), primo=primo, checkout__isnull=True)
+        nshift = utils.aproximateToShift(rshift.checkin)
+        running = {
+            "id": rshift.id,
+
+            "primo": {
+                "mail": primo.mail,
+                "nick": primo.nick,
+            },
+
+            "block": nshift.block.name,
+
+            "checkin": rshift.checkin,
+            "checkout": rshift.checkout
+        }
+    except StampedShift.DoesNotExist:
+        nshift = utils.upcomingShift(primo.schedule)
+        running = None
+
+    return 200, {
+        "mail": primo.mail,
+        "nick": primo.nick,
+
+        "running": running,
+        "next": {
+            "block": nshift.block.name,
+            "checkin": nshift.checkin,
+            "checkout": nshift.checkout,
+        }
+    }
+
+@api.post("/shifts", response={200: RegisteredShift, 403: Detail})
+async def push_a_shift(_, payload: PushShift):
+    now = utils.now()
+    primo = await aget_object_or_404(Primo.objects.annotate(onShift=ScheduledShift.onShift(now)), mail=payload.mail)
+
+    if not primo.onShift:
+        return 403, {"detail": "You're not on your shift"}
+
+    shift = await acreate(StampedShift, primo=primo, checkin=now)
+    return 200, {
+        "id": shift.id,
+
+        "primo":  {
+            "mail": primo.mail,
+            "nick": primo.nick,
+        },
+
+        "block": utils.aproximateToShift(shift.checkin).block.name,
+
+        "checkin": shift.checkin,
+    }
+
+@api.put("/shifts", response={200: RegisteredShift, 403: Detail})
+async def update_a_shift(_, payload: UpdateShift):
+    now = utils.now()
+    shift = await aget_object_or_404(StampedShift.objects.select_related('primo'), id=payload.id)
+
+    if shift.checkin.date() != now.date():
+        return 403, {"detail": "The check-in day is already over"}
+    elif shift.checkout is not None:
+        return 403, {"detail": "Shift already closed"}
+
+    shift.checkout = now
+    await asave(shift)
+
+    return 200, {
+        "id": shift.id,
+
+        "primo": {
+            "mail": shift.primo.mail,
+            "nick": shift.primo.nick,
+        },
+
+        "block": utils.aproximateToShift(shift.checkin).block.name,
+
+        "checkin": shift.checkin,
+        "checkout": shift.checkout
+    }
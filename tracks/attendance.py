@@ -0,0 +1,208 @@
+from datetime import date, datetime, timedelta
+from threading import local
+import logging
+from typing import List, Optional
+
+import numpy as np
+from django.db import transaction
+
+from tracks.models import *
+from tracks import utils
+from tracks import parameters
+from tracks import caches
+from tracks import analytics
+
+# Mantiene la tabla Attendance, el resumen de asistencia por turno (primo, fecha,
+# bloque). Se recalcula por rangos de días con el mismo motor de tracks/analytics.py:
+# cada vez que se registra, cierra o borra un turno se recalcula sólo la fila de ese
+# primo en el día y bloque del turno, y cada vez que se perdona un turno se recalcula
+# ese bloque para los primos que pueden tener fila en él, una sola vez por transacción
+# (véase refreshOnCommit y tracks/signals.py). El comando rebuildattendance recalcula
+# rangos completos.
+# NOTA: Los turnos ausentes sólo se registran una vez que termina su bloque, y si el
+# primo no registró nada ese día nadie recalcula el día, así que hay que correr
+# "rebuildattendance --days 1" cada noche. Además los días se calculan con el horario
+# que tenía el primo en ese momento; para aplicar un horario nuevo al pasado hay que
+# recalcular el rango con rebuildattendance.
+
+Status = Attendance.Status
+
+# Filas de Attendance de <primo> según su horario <schedule> (pares día de la semana,
+# índice del bloque) y sus turnos registrados ya clasificados <classification>
+# (ordenados por checkin), en el calendario <calendar>. <pardoned> son los turnos
+# perdonados del calendario y <now> el instante hasta el que se cuentan las ausencias.
+def primoAttendance(primo: Primo, schedule: List[tuple], classification: analytics.Classification, calendar: analytics.Calendar, pardoned: set, now: datetime) -> List[Attendance]:
+    days, blocks = calendar.expectedShifts(schedule)
+    expected = set(zip(days.tolist(), blocks.tolist()))
+
+    # Datapoint del primer turno correcto y del primer turno sospechoso de cada día y
+    # bloque, igual que en analytics.resume
+    right, wrong = {}, {}
+    for day, block, inSchedule, datapoint in zip(classification.day.tolist(), classification.block.tolist(), classification.inSchedule.tolist(), classification.datapoint.tolist()):
+        if block >= 0:
+            (right if inSchedule else wrong).setdefault((day, block), datapoint)
+
+    records = []
+    for day, block in sorted(expected | wrong.keys()):
+        key = (day, block)
+        datapoint = None
+        if key not in expected:
+            # Sólo se guardan los turnos fuera del horario que además son sospechosos
+            status, datapoint = Status.SUSPICIOUS, wrong[key]
+        elif key in pardoned:
+            status = Status.PARDONED
+        elif key in right:
+            datapoint = right[key]
+            status = Status.ONTIME if datapoint >= 0 else Status.LATE
+        elif key in wrong:
+            status, datapoint = Status.SUSPICIOUS, wrong[key]
+        elif datetime.combine(day, parameters.Block[block].end) <= now:
+            status = Status.MISSING
+        else:
+            # El bloque todavía no termina
+            continue
+        records.append(Attendance(primo=primo, date=day, block=block, status=status, lateness=None if datapoint is None else -datapoint))
+    return records
+
+# Recalcula las filas de Attendance entre <start> y <end> (ambos incluidos) de los
+# primos con rol en <primos>, o de todos si es None. Si se indica <block> sólo se
+# recalculan las filas de ese bloque. Retorna la cantidad de filas.
+def refresh(start: date, end: date, primos: Optional[List[int]] = None, block: Optional[int] = None) -> int:
+    now = utils.now()
+    # Sin savepoint si ya hay una transacción, un error deshace la transacción
+    # completa de todas formas
+    with transaction.atomic(savepoint=False):
+        # Bloquea a los primos (siempre en el mismo orden) para que dos recálculos de
+        # los mismos días no se pisen al borrar e insertar las filas
+        team = Primo.objects.select_for_update().order_by('rol')
+        stamps = StampedShift.objects.filter(checkin__gte=start, checkin__lt=end + timedelta(days=1))
+        rollup = Attendance.objects.filter(date__gte=start, date__lte=end)
+        if primos is not None:
+            team, stamps, rollup = team.filter(rol__in=primos), stamps.filter(primo__in=primos), rollup.filter(primo__in=primos)
+        elif block is not None:
+            # Sólo pueden tener filas en el bloque los primos que lo tienen en su
+            # horario o que registraron un turno esos días, así no se bloquea a todos
+            weekdays = {(start + timedelta(days=i)).weekday() for i in range(min(7, (end - start).days + 1))}
+            team = team.filter(
+                Q(rol__in=ScheduledShift.objects.filter(weekday__in=weekdays, block=block).values('primo'))
+              | Q(rol__in=stamps.values('primo'))
+            )
+        if block is not None:
+            rollup = rollup.filter(block=block)
+        team = list(team)
+
+        rows = stamps.order_by('primo', 'checkin').values_list('primo', 'id', 'checkin', 'checkout')
+        primoIds = np.array([row[0] for row in rows], dtype=np.int64)
+        # Los turnos que no se aproximan a ningún bloque no cuentan en la asistencia
+        classification = analytics.classify(analytics.Stamps.fromRows([row[1:] for row in rows]), strict=False)
+        calendar = analytics.Calendar(start, end)
+        pardoned = caches.pardonedShifts(start, end)
+
+        records = []
+        for primo in team:
+            group = analytics.primoGroup(primoIds, primo.rol)
+            records += primoAttendance(
+                primo,
+                analytics.primoSchedule(primo),
+                analytics.Classification(*(column[group] for column in classification)),
+                calendar,
+                pardoned,
+                now,
+            )
+        if block is not None:
+            records = [record for record in records if record.block == block]
+
+        rollup.delete()
+        Attendance.objects.bulk_create(records, batch_size=5000)
+    return len(records)
+
+# Índice del bloque en el que cuenta un turno registrado con entrada <checkin>, o None
+# si no se aproxima a ningún bloque (y entonces no cuenta en la asistencia)
+def stampBlock(checkin: datetime) -> Optional[int]:
+    try:
+        return utils.aproximateToShift(checkin).block.index
+    except Exception:
+        return None
+
+logger = logging.getLogger('tracks.attendance')
+
+# Recálculos pendientes de una transacción: (día, bloque) -> roles de los primos, o
+# None si hay que recalcular el bloque de todos los primos. Se registra con on_commit
+# por cada turno que cambia, pero sólo la primera llamada recalcula. <deleted> son los
+# primos que se borran en la transacción, cuyos turnos y asistencia se borran en
+# cascada, así que no se recalculan.
+class PendingRefresh():
+    def __init__(self, savepoints: tuple, index: int):
+        self.savepoints = savepoints
+        # Posición de su primer on_commit en connection.run_on_commit
+        self.index = index
+        self.shifts = {}
+        self.deleted = set()
+        self.done = False
+
+    # Si la transacción o el savepoint se deshizo, Django ya descartó sus on_commit
+    def registered(self, connection) -> bool:
+        return self.index < len(connection.run_on_commit) and connection.run_on_commit[self.index][1] is self
+
+    def add(self, day: date, block: int, primo: Optional[int]):
+        key = (day, block)
+        if primo in self.deleted:
+            return
+        if primo is None:
+            self.shifts[key] = None
+        elif self.shifts.get(key, ()) is not None:
+            self.shifts.setdefault(key, set()).add(primo)
+
+    def __call__(self):
+        if self.done:
+            return
+        self.done = True
+        # Si se perdonó un turno en la misma transacción, el on_commit que invalida
+        # la caché de los turnos perdonados puede venir después de este
+        if None in self.shifts.values():
+            caches.invalidatePardonedShifts()
+        # Cada bloque en su propia transacción. Los turnos ya se guardaron, así que si
+        # un recálculo falla sólo se registra el error (la fila se corrige con el
+        # próximo cambio del turno o con rebuildattendance) en lugar de responder 500
+        for (day, block), primos in sorted(self.shifts.items()):
+            if primos is not None and not (primos := primos - self.deleted):
+                continue
+            try:
+                refresh(day, day, None if primos is None else sorted(primos), block)
+            except Exception:
+                logger.exception('Attendance refresh of block %s on %s failed', block, day)
+
+_pending = local()
+
+# Lote de recálculos de la transacción y savepoint en curso
+def _currentRefresh() -> PendingRefresh:
+    connection = transaction.get_connection()
+    savepoints = tuple(connection.savepoint_ids)
+    pending = getattr(_pending, 'refresh', None)
+    if pending is None or pending.done or pending.savepoints != savepoints or not pending.registered(connection):
+        pending = _pending.refresh = PendingRefresh(savepoints, len(connection.run_on_commit))
+    return pending
+
+# Recalcula la fila del bloque <block> del día <day> de <primo> (o de todos los primos
+# si es None) una vez que se confirme la transacción en curso. Los recálculos de la
+# misma transacción se juntan, así cada bloque se recalcula una sola vez aunque cambien
+# muchos turnos. Se junta por savepoint, para que los turnos de un savepoint que se
+# deshace no se recalculen con los demás.
+def refreshOnCommit(day: date, block: int, primo: Optional[int] = None):
+    pending = _currentRefresh()
+    pending.add(day, block, primo)
+    transaction.on_commit(pending)
+
+# Recalcula la fila del turno registrado por <primo> con entrada <checkin> una vez que
+# se confirme la transacción en curso (véase refreshOnCommit)
+def refreshStampOnCommit(primo: int, checkin: datetime):
+    if (block := stampBlock(checkin)) is not None:
+        refreshOnCommit(checkin.date(), block, primo)
+
+# Descarta los recálculos de <primo> en la transacción en curso, porque se está
+# borrando junto con sus turnos y su asistencia. Como se guarda en el lote de la
+# transacción, se olvida si el borrado falla y la transacción se deshace.
+def forgetPrimo(primo: int):
+    pending = _currentRefresh()
+    pending.deleted.add(primo)
+    transaction.on_commit(pending)
@@ -0,0 +1,104 @@
+from datetime import date
+from hashlib import sha1
+from threading import Lock
+from time import time
+from typing import Callable, NamedTuple
+
+from django.conf import settings
+
+from tracks.models import PardonedShift, ScheduledShift
+
+# Cachés en memoria compartidas por todo el proceso. Se invalidan desde las
+# señales en tracks/signals.py, por lo que sólo se enteran de los cambios hechos
+# a través del ORM de este mismo proceso.
+# NOTA: Si algún día se levantan varios workers (gunicorn, uvicorn, etc.), cada
+# uno tendrá su propia copia y sólo se invalidará la del worker que hizo el cambio.
+
+# Índice del horario semanal: (día de la semana, índice del bloque) -> primos de
+# turno en ese bloque. Se construye una sola vez a partir de ScheduledShift, así
+# /now no tiene que consultar la base de datos en cada llamada.
+_scheduleIndex = None
+_scheduleLock = Lock()
+
+def _buildScheduleIndex():
+    index = {}
+    for weekday, block, mail, nick in ScheduledShift.objects.values_list('weekday', 'block', 'primo__mail', 'primo__nick'):
+        index.setdefault((weekday, block), []).append({
+            "mail": mail,
+            "nick": nick,
+        })
+    return index
+
+def scheduleIndex():
+    global _scheduleIndex
+    if (index := _scheduleIndex) is None:
+        with _scheduleLock:
+            if (index := _scheduleIndex) is None:
+                index = _scheduleIndex = _buildScheduleIndex()
+    return index
+
+def invalidateScheduleIndex():
+    global _scheduleIndex
+    # Toma el lock para no pisar una reconstrucción que ya estaba en curso con
+    # datos anteriores al cambio
+    with _scheduleLock:
+        _scheduleIndex = None
+
+# Retorna los primos que tienen turno el día <weekday> en el bloque <block>
+def primosOnDuty(weekday: int, block) -> list:
+    return scheduleIndex().get((weekday, block.index), [])
+
+# Turnos perdonados como un set de pares (fecha, índice del bloque). Sólo se guardan
+# en memoria si PARDON_CACHE está activo en settings.py; en ese caso se cargan
+# todos de una vez, de lo contrario se consultan sólo los del rango pedido.
+_pardonedShifts = None
+_pardonLock = Lock()
+
+def pardonedShifts(start: date, end: date) -> set:
+    global _pardonedShifts
+    if not settings.PARDON_CACHE:
+        return set(PardonedShift.objects.filter(date__gte=start, date__lte=end).values_list('date', 'block'))
+
+    # El set incluye turnos fuera de [start, end], lo que no importa para
+    # comprobar si un turno del rango fue perdonado
+    if (pardoned := _pardonedShifts) is None:
+        with _pardonLock:
+            if (pardoned := _pardonedShifts) is None:
+                pardoned = _pardonedShifts = set(PardonedShift.objects.values_list('date', 'block'))
+    return pardoned
+
+def invalidatePardonedShifts():
+    global _pardonedShifts
+    with _pardonLock:
+        _pardonedShifts = None
+
+# Respuesta ya renderizada de /shifts/week. Se guarda junto a su ETag y la fecha en
+# que se generó, de modo que los clientes que vuelven a preguntar por la misma semana
+# reciban un 304 sin tocar la base de datos. Se descarta cuando se registra, modifica
+# o borra un turno de la semana guardada.
+class RenderedWeek(NamedTuple):
+    monday: date
+    etag: str
+    lastModified: int # Timestamp
+    content: bytes
+
+_weekShifts = None
+_weekLock = Lock()
+
+# Retorna la semana que comienza el lunes <monday>, renderizándola con <render> si
+# no está guardada
+def weekShifts(monday: date, render: Callable[[], bytes]) -> RenderedWeek:
+    global _weekShifts
+    if (week := _weekShifts) is None or week.monday != monday:
+        with _weekLock:
+            if (week := _weekShifts) is None or week.monday != monday:
+                content = render()
+                week = _weekShifts = RenderedWeek(monday, f'"{sha1(content).hexdigest()}"', int(time()), content)
+    return week
+
+# Descarta la semana guardada si el día <day> cae dentro de ella
+def invalidateWeekShifts(day: date):
+    global _weekShifts
+    with _weekLock:
+        if _weekShifts is not None and _weekShifts.monday <= day:
+            _weekShifts = None
@@ -0,0 +1,34 @@
+from functools import partial
+
+from django.core.signals import request_started
+from django.db import connections
+from django.dispatch import receiver
+
+# Comprobación de las conexiones persistentes (CONN_MAX_AGE > 0). Postgres, un
+# pooler o un firewall pueden cortar una conexión que lleva tiempo sin usarse, y la
+# siguiente petición que la reutilice fallaría. Si la base de datos tiene
+# CONN_HEALTH_CHECKS, la primera vez que una petición usa una conexión ya abierta se
+# comprueba que siga respondiendo, y si no se cierra para abrir una nueva en su lugar.
+# Las peticiones que no consultan la base de datos no hacen ninguna comprobación.
+# NOTA: Django 4.1 trae CONN_HEALTH_CHECKS de serie; en 4.0 la opción se ignora, por
+# eso se implementa aquí con el mismo comportamiento (y el mismo atributo
+# health_check_done). Al actualizar Django hay que borrar este módulo.
+
+@receiver(request_started)
+def check_connections(**kwargs):
+    for connection in connections.all():
+        if not connection.settings_dict.get('CONN_HEALTH_CHECKS'):
+            continue
+        # Se reemplaza ensure_connection sólo en esta conexión, que Django llama antes
+        # de cada consulta y de cada transacción
+        if 'ensure_connection' not in vars(connection):
+            connection.ensure_connection = partial(_ensure_connection, connection)
+        connection.health_check_done = False
+
+def _ensure_connection(connection):
+    if not connection.health_check_done:
+        connection.health_check_done = True
+        # Una conexión dentro de una transacción (por ejemplo en los tests) no se toca
+        if connection.connection is not None and not connection.in_atomic_block and not connection.is_usable():
+            connection.close()
+    type(connection).ensure_connection(connection)
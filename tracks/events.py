@@ -0,0 +1,83 @@
+import asyncio
+import json
+from threading import Lock
+
+from ninja.renderers import NinjaJSONEncoder
+
+from tracks import utils
+
+# Difusión de eventos en vivo para el stream de tracks/stream.py. Cada pantalla
+# conectada tiene su propia cola; publish reparte cada evento en todas las colas,
+# así un solo evento sirve a todas las pantallas en lugar de que cada una pregunte
+# por /now y /shifts/week una y otra vez.
+# NOTA: Sólo llegan a las pantallas conectadas a este mismo proceso.
+
+# Mensaje en el formato de Server-Sent Events
+def message(event: str, data) -> bytes:
+    return f'event: {event}\ndata: {json.dumps(data, cls=NinjaJSONEncoder)}\n\n'.encode()
+
+class Broadcaster():
+    # Eventos que puede acumular una pantalla que no alcanza a leerlos; si se llena
+    # se descartan los nuevos eventos de esa pantalla.
+    maxsize = 100
+
+    def __init__(self):
+        self._subscribers = set()
+        self._lock = Lock()
+        self._loop = None
+
+    # Se debe llamar desde el event loop que atiende el stream
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(self.maxsize)
+        with self._lock:
+            self._loop = asyncio.get_running_loop()
+            self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        with self._lock:
+            self._subscribers.discard(queue)
+
+    @property
+    def subscribers(self) -> int:
+        return len(self._subscribers)
+
+    # Publica el evento <event> con el contenido <data>. Se puede llamar desde
+    # cualquier hilo, por ejemplo desde las vistas síncronas de la api.
+    def publish(self, event: str, data):
+        with self._lock:
+            if not self._subscribers or self._loop is None or self._loop.is_closed():
+                return
+            loop = self._loop
+        loop.call_soon_threadsafe(self._dispatch, message(event, data))
+
+    def _dispatch(self, content: bytes):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for queue in subscribers:
+            try:
+                queue.put_nowait(content)
+            except asyncio.QueueFull:
+                pass
+
+broadcaster = Broadcaster()
+
+# Publica la entrada o salida del turno <shift> (un StampedShift) en el formato de
+# RegisteredShift
+def publishShift(shift, created: bool):
+    if not broadcaster.subscribers:
+        return
+    broadcaster.publish('checkin' if created else 'checkout', {
+        "id": shift.id,
+
+        "primo": {
+            "mail": shift.primo.mail,
+            "nick": shift.primo.nick,
+        },
+
+        # Sin modo estricto para no lanzar errores por turnos creados a mano
+        "block": utils.aproximateToShift(shift.checkin, False).block.name,
+
+        "checkin": shift.checkin,
+        "checkout": shift.checkout,
+    })
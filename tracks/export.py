@@ -0,0 +1,121 @@
+import csv
+import io
+from datetime import date, timedelta
+from itertools import islice
+from typing import Iterator
+
+import pyarrow
+import pyarrow.ipc
+import pyarrow.parquet
+
+from tracks.models import *
+from tracks import parameters
+from tracks import analytics
+
+# Exportación de los turnos registrados junto a su primo, el bloque al que se
+# aproximan y su puntualidad, para armar planillas sin tener que pedir /shifts primo
+# por primo. Los turnos se leen por tramos de <size> filas con .iterator() (un cursor
+# del lado del servidor en PostgreSQL) y cada tramo se clasifica con analytics.classify
+# y se escribe apenas se lee, así la memoria no crece con el rango exportado.
+# NOTA: pyarrow (para Arrow y Parquet) está fijado en una versión compatible con el
+# numpy de requirements.txt; las versiones 19 en adelante necesitan numpy 2.
+
+columns = ['id', 'rol', 'mail', 'nick', 'checkin', 'checkout', 'date', 'block', 'inSchedule', 'lateness']
+
+# Columnas de los turnos registrados entre <start> y <end> (ambos incluidos), como
+# diccionarios columna -> lista con hasta <size> turnos cada uno. Los turnos que no se
+# aproximan a ningún bloque quedan con date, block y lateness nulos.
+def chunks(start: date, end: date, size: int = 5000) -> Iterator[dict]:
+    rows = StampedShift.objects.filter(checkin__gte=start, checkin__lt=end + timedelta(days=1)).order_by('checkin', 'id').values_list(
+        'id', 'primo', 'primo__mail', 'primo__nick', 'checkin', 'checkout',
+    ).iterator(chunk_size=size)
+    while batch := list(islice(rows, size)):
+        stamps = analytics.Stamps.fromRows([(row[0], row[4], row[5]) for row in batch])
+        classification = analytics.classify(stamps, strict=False)
+        valid = (classification.block >= 0).tolist()
+        yield {
+            "id": stamps.id.tolist(),
+            "rol": [row[1] for row in batch],
+            "mail": [row[2] for row in batch],
+            "nick": [row[3] for row in batch],
+            "checkin": [row[4] for row in batch],
+            "checkout": [row[5] for row in batch],
+            "date": [day if isValid else None for day, isValid in zip(classification.day.tolist(), valid)],
+            "block": [parameters.Block[block].name if isValid else None for block, isValid in zip(classification.block.tolist(), valid)],
+            "inSchedule": classification.inSchedule.tolist(),
+            # Minutos de atraso, igual que en Attendance.lateness
+            "lateness": [-datapoint if isValid else None for datapoint, isValid in zip(classification.datapoint.tolist(), valid)],
+        }
+
+# Archivo que sólo acumula lo que se le escribe hasta que se vacía con drain, para ir
+# entregando por partes lo que escriben csv.writer y pyarrow
+class _Sink(io.RawIOBase):
+    def __init__(self):
+        self.parts, self.position = [], 0
+
+    def writable(self):
+        return True
+
+    def write(self, content):
+        self.parts.append(bytes(content))
+        self.position += len(content)
+        return len(content)
+
+    def tell(self):
+        return self.position
+
+    def drain(self) -> bytes:
+        content = b''.join(self.parts)
+        self.parts.clear()
+        return content
+
+def writeCsv(chunks: Iterator[dict]) -> Iterator[bytes]:
+    sink = _Sink()
+    writer = csv.writer(io.TextIOWrapper(sink, encoding='utf-8', newline='', write_through=True))
+    writer.writerow(columns)
+    yield sink.drain()
+    for chunk in chunks:
+        writer.writerows(zip(*(
+            ['' if value is None else value.isoformat() if hasattr(value, 'isoformat') else value for value in chunk[column]]
+            for column in columns
+        )))
+        yield sink.drain()
+
+def _schema():
+    return pyarrow.schema([
+        ('id', pyarrow.int64()),
+        ('rol', pyarrow.int64()),
+        ('mail', pyarrow.string()),
+        ('nick', pyarrow.string()),
+        ('checkin', pyarrow.timestamp('us')),
+        ('checkout', pyarrow.timestamp('us')),
+        ('date', pyarrow.date32()),
+        ('block', pyarrow.string()),
+        ('inSchedule', pyarrow.bool_()),
+        ('lateness', pyarrow.int32()),
+    ])
+
+# Arrow IPC en formato stream, un record batch por tramo
+def writeArrow(chunks: Iterator[dict]) -> Iterator[bytes]:
+    sink, schema = _Sink(), _schema()
+    with pyarrow.ipc.new_stream(sink, schema) as writer:
+        for chunk in chunks:
+            writer.write_batch(pyarrow.RecordBatch.from_pydict(chunk, schema=schema))
+            yield sink.drain()
+    yield sink.drain()
+
+# Parquet, un row group por tramo. El pie del archivo se escribe al final.
+def writeParquet(chunks: Iterator[dict]) -> Iterator[bytes]:
+    sink, schema = _Sink(), _schema()
+    with pyarrow.parquet.ParquetWriter(sink, schema) as writer:
+        for chunk in chunks:
+            writer.write_table(pyarrow.Table.from_pydict(chunk, schema=schema))
+            yield sink.drain()
+    yield sink.drain()
+
+# Formato -> (content type, extensión, escritor)
+formats = {
+    'csv': ('text/csv', 'csv', writeCsv),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows', writeArrow),
+    'parquet': ('application/vnd.apache.parquet', 'parquet', writeParquet),
+}
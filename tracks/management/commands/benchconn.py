@@ -0,0 +1,148 @@
+import json
+from datetime import datetime, timedelta
+from io import BytesIO
+from random import Random
+from time import perf_counter
+from typing import Callable
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.backends.signals import connection_created
+
+from tracks.models import *
+from tracks import parameters
+from tracks import synthetic
+from tracks import utils
+from tracks import metrics
+from tracks.management.commands.loadtest import percentiles
+
+# Mide la latencia de POST /shifts y cuántas conexiones a la base de datos se abren.
+# Las peticiones pasan dentro del mismo proceso por la aplicación que se despliega,
+# así que se ejecutan las señales request_started y request_finished que abren,
+# comprueban y cierran las conexiones, igual que bajo un servidor de verdad:
+#  - asgi: PrimosCheckIn/asgi.py, como bajo daphne, con cada petición en un hilo
+#    nuevo. Ahí las conexiones nunca se reutilizan, así que sólo se mide una conexión
+#    por petición.
+#  - wsgi: PrimosCheckIn/wsgi.py, como bajo gunicorn, abriendo una conexión por
+#    petición (CONN_MAX_AGE = 0) y reutilizándola entre peticiones, con y sin la
+#    comprobación de tracks/db.py.
+# Usa la base de datos configurada en settings, así que para comparar contra un
+# pooler como pgbouncer basta con correrlo con otro POSTGRES_HOST (y POSTGRES_POOLER).
+# NOTA: Crea un primo sintético y la hora se congela al comienzo de un bloque para
+# que todas las entradas se acepten; al final se borra el primo y sus turnos.
+
+class Command(BaseCommand):
+    help = 'Reports p50/p99 latency of POST /shifts and the database connections it opens, through the deployed ASGI application or the WSGI one'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--server', choices=['asgi', 'wsgi'], default='asgi', help='Application the requests go through: asgi as served by daphne, or wsgi with and without persistent connections')
+        parser.add_argument('--requests', type=int, default=500, help='Check-ins per mode')
+        parser.add_argument('--max-age', type=int, default=60, help='CONN_MAX_AGE used for persistent connections')
+
+    def handle(self, *args, server, requests, max_age, **options):
+        primo, = synthetic.primos(Random(0), 1, 5*len(parameters.Block))
+        # Un rol que no usen los primos del comando seed
+        primo.rol = max(Primo.objects.aggregate(Max('rol'))['rol__max'] or 0, synthetic.firstRol) + 1
+        primo.mail = f'synthetic{primo.rol}@primos.cl'
+        primo.save()
+        monday = utils.firstWeekday()
+        instant = datetime.combine(monday, parameters.Block[0].start) + timedelta(minutes=1)
+        modes = [('new connection per request', 0, False)]
+        if server == 'wsgi':
+            modes += [
+                (f'persistent (CONN_MAX_AGE={max_age})', max_age, False),
+                (f'persistent (CONN_MAX_AGE={max_age}) + health checks', max_age, True),
+            ]
+
+        # Antes de silenciar el log, porque importar PrimosCheckIn/asgi.py vuelve a
+        # configurarlo
+        body = json.dumps({"mail": primo.mail}).encode()
+        request = self.asgi(body) if server == 'asgi' else self.wsgi(body)
+
+        settings_dict = connection.settings_dict
+        original = settings_dict.get('CONN_MAX_AGE', 0), settings_dict.get('CONN_HEALTH_CHECKS', False)
+        try:
+            for title, age, checks in modes:
+                settings_dict['CONN_MAX_AGE'], settings_dict['CONN_HEALTH_CHECKS'] = age, checks
+                connection.close()
+                # Sólo interesa el resumen, no el log de cada petición
+                with mock.patch.object(utils, 'now', return_value=instant), mock.patch.object(metrics.logger, 'disabled', True):
+                    timings, statuses, opened = self.run(request, requests)
+                self.stdout.write(f'{server} {title}: {percentiles(timings)} {statuses} {opened} connections opened')
+        finally:
+            settings_dict['CONN_MAX_AGE'], settings_dict['CONN_HEALTH_CHECKS'] = original
+            connection.close()
+            primo.delete()
+
+    def run(self, request: Callable[[], int], requests: int):
+        timings, statuses, opened = [], {}, 0
+
+        def created(**kwargs):
+            nonlocal opened
+            opened += 1
+
+        connection_created.connect(created)
+        try:
+            for _ in range(requests):
+                counter = perf_counter()
+                status = request()
+                timings.append(perf_counter() - counter)
+                statuses[status] = statuses.get(status, 0) + 1
+        finally:
+            connection_created.disconnect(created)
+        return timings, statuses, opened
+
+    # Petición a la aplicación ASGI, que retorna el estado de la respuesta
+    def asgi(self, body: bytes):
+        from PrimosCheckIn.asgi import application
+        scope = {
+            'type': 'http',
+            'method': 'POST',
+            'path': '/api/shifts',
+            'query_string': b'',
+            'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())],
+            'server': ('localhost', 80),
+        }
+
+        async def receive():
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        def request() -> int:
+            sent = []
+
+            async def send(message):
+                sent.append(message)
+
+            async_to_sync(application)(scope, receive, send)
+            return sent[0]['status']
+        return request
+
+    # Petición a la aplicación WSGI, que retorna el estado de la respuesta
+    def wsgi(self, body: bytes):
+        handler = WSGIHandler()
+
+        def request() -> int:
+            statuses = []
+
+            def start_response(status, headers):
+                statuses.append(int(status.split()[0]))
+
+            environ = {
+                'REQUEST_METHOD': 'POST',
+                'PATH_INFO': '/api/shifts',
+                'QUERY_STRING': '',
+                'CONTENT_TYPE': 'application/json',
+                'CONTENT_LENGTH': str(len(body)),
+                'SERVER_NAME': 'localhost',
+                'SERVER_PORT': '80',
+                'wsgi.url_scheme': 'http',
+                'wsgi.input': BytesIO(body),
+            }
+            response = handler(environ, start_response)
+            # Igual que un servidor WSGI, close() dispara request_finished
+            response.close()
+            return statuses[0]
+        return request
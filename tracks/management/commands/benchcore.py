@@ -0,0 +1,106 @@
+import json
+import platform
+import subprocess
+from datetime import datetime, timedelta
+from itertools import islice
+from random import Random
+from statistics import median
+from timeit import Timer
+
+from django.core.management.base import BaseCommand
+
+from tracks import analytics
+from tracks import parameters
+from tracks import synthetic
+from tracks import utils
+
+# Benchmarks de las funciones de tracks/utils.py que interpretan horarios y
+# aproximan turnos. No usa la base de datos y todo se genera a partir de <seed>, así
+# que dos ejecuciones en la misma máquina son comparables. El resultado es un JSON
+# con el tiempo por llamada de cada caso; con --compare se muestra la razón contra
+# un JSON anterior (por ejemplo, el del commit previo).
+
+class Command(BaseCommand):
+    help = 'Benchmarks the schedule parsing and shift approximation helpers and emits the results as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=7, help='Timing rounds per case, the best and median are reported')
+        parser.add_argument('--weeks', type=int, default=52, help='Weeks covered by the long range cases')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='Write the JSON to this file instead of stdout')
+        parser.add_argument('--compare', help='JSON from a previous run to compare against')
+
+    def handle(self, *args, repeat, weeks, seed, output, compare, **options):
+        results = {}
+        for name, function in self.cases(Random(seed), weeks):
+            timer = Timer(function)
+            number, _ = timer.autorange()
+            rounds = [elapsed/number*1e6 for elapsed in timer.repeat(repeat, number)]
+            results[name] = {"loops": number, "best_us": round(min(rounds), 3), "median_us": round(median(rounds), 3)}
+
+        report = json.dumps({
+            "commit": revision(),
+            "python": platform.python_version(),
+            "weeks": weeks,
+            "seed": seed,
+            "results": results,
+        }, indent=2)
+        if output:
+            with open(output, 'w') as file:
+                file.write(report + '\n')
+        else:
+            self.stdout.write(report)
+
+        if compare:
+            with open(compare) as file:
+                baseline = json.load(file)["results"]
+            for name, result in results.items():
+                if name in baseline:
+                    ratio = result["best_us"]/baseline[name]["best_us"]
+                    style = self.style.ERROR if ratio > 1.1 else self.style.SUCCESS if ratio < 0.9 else str
+                    self.stderr.write(style(f'{name}: {baseline[name]["best_us"]:.1f}us -> {result["best_us"]:.1f}us ({ratio:.2f}x)'))
+
+    # Pares (nombre, función sin argumentos) a medir
+    def cases(self, rng: Random, weeks: int):
+        reference = datetime.combine(utils.firstWeekday(datetime(2022, 9, 5)), parameters.Block[3].start)
+        schedules = {
+            # Lo típico: un par de turnos a la semana
+            'realistic': synthetic.randomSchedule(rng, 4),
+            # Todos los bloques de todos los días
+            'full': synthetic.randomSchedule(rng, 5*len(parameters.Block)),
+        }
+        weekly = {name: len(utils.scheduleBlocks(schedule)) for name, schedule in schedules.items()}
+
+        for name, schedule in schedules.items():
+            blocks = utils.scheduleBlocks(schedule)
+            yield f'verifyRegex[{name}]', lambda schedule=schedule: utils.verifyRegex(schedule)
+            yield f'DEPRECATED_parseSchedule[{name}]', lambda schedule=schedule: utils.DEPRECATED_parseSchedule(schedule, reference)
+            yield f'parseSchedule[{name}]', lambda schedule=schedule: next(utils.parseSchedule(schedule, reference)[1])
+            # Todos los turnos de <weeks> semanas, como al armar las estadísticas
+            yield f'parseSchedule[{name}, {weeks} weeks]', lambda schedule=schedule, n=weekly[name]*weeks: list(islice(utils.parseSchedule(schedule, reference)[1], n))
+            yield f'_scheduleGenerator[{name}, {weeks} weeks]', lambda blocks=blocks, n=weekly[name]*weeks: list(islice(utils._scheduleGenerator(blocks, reference), n))
+            # Lo mismo sin recorrer el horario: el último turno y todos los turnos como arreglos
+            yield f'upcomingShift[{name}, {weeks} weeks]', lambda schedule=schedule, k=weekly[name]*weeks - 1: utils.upcomingShift(schedule, reference, k)
+            yield f'expectedShifts[{name}, {weeks} weeks]', lambda schedule=schedule: analytics.expectedShifts(schedule, reference.date(), reference.date() + timedelta(weeks=weeks))
+
+        # Un horario casi válido que el regex sólo rechaza en el último caracter
+        invalid = schedules['full'] + ','
+        yield 'verifyRegex[invalid]', lambda: utils.verifyRegex(invalid)
+
+        # Instantes al azar dentro de los bloques de <weeks> semanas de días hábiles
+        instants = []
+        for _ in range(1000):
+            day = reference.date() + timedelta(weeks=rng.randrange(weeks), days=rng.randrange(5))
+            block = parameters.Block[rng.randrange(len(parameters.Block))]
+            instants.append(datetime.combine(day, block.start) + timedelta(seconds=rng.randrange(-300, 600)))
+        yield f'aproximateToShift[{len(instants)} instants]', lambda: [utils.aproximateToShift(instant, False) for instant in instants]
+        # Fines de semana y noches, que se aproximan al próximo día hábil
+        nights = [datetime.combine(reference.date() + timedelta(days=day), parameters.Block[-1].end) + timedelta(hours=2) for day in range(7)]
+        yield f'aproximateToShift[{len(nights)} nights]', lambda: [utils.aproximateToShift(instant, False) for instant in nights]
+
+# Commit actual, para saber contra qué se está comparando
+def revision() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
@@ -0,0 +1,90 @@
+from datetime import datetime, timedelta
+from random import Random
+from statistics import median
+from time import perf_counter
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from tracks.models import *
+from tracks import synthetic
+
+# Mide las consultas más frecuentes sobre StampedShift con y sin los índices de
+# StampedShift.Meta.indexes. Todo ocurre dentro de una transacción que se deshace
+# al final, así que la base de datos queda tal como estaba.
+# NOTA: Necesita PostgreSQL, porque quita y vuelve a crear los índices dentro de la
+# transacción (DDL transaccional) y usa EXPLAIN ANALYZE.
+
+class Rollback(Exception):
+    pass
+
+class Command(BaseCommand):
+    help = 'Seeds a synthetic StampedShift history and reports query plans and timings without and with its indexes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--primos', type=int, default=60)
+        parser.add_argument('--weeks', type=int, default=4*52, help='Weeks of history to generate')
+        parser.add_argument('--repeat', type=int, default=20, help='Times each query is timed')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('This benchmark needs PostgreSQL')
+
+        try:
+            with transaction.atomic():
+                self.run(**options)
+                raise Rollback()
+        except Rollback:
+            pass
+
+    def run(self, primos, weeks, repeat, seed, **_):
+        rng = Random(seed)
+        end = datetime.now().date()
+        start = end - timedelta(weeks=weeks)
+
+        seeded = Primo.objects.bulk_create(synthetic.primos(rng, primos))
+        shifts = StampedShift.objects.bulk_create(synthetic.stampedShifts(rng, seeded, start, end), batch_size=5000)
+        with connection.cursor() as cursor:
+            cursor.execute(f'ANALYZE {StampedShift._meta.db_table}')
+        self.stdout.write(f'Seeded {len(seeded)} primos and {len(shifts)} stamped shifts ({start} - {end})')
+
+        primo = seeded[0]
+        monday = end - timedelta(days=end.weekday())
+        queries = {
+            # get_primo
+            'running shift': StampedShift.objects.filter(checkin__gte=end, primo=primo, checkout__isnull=True),
+            # get_shifts, un semestre
+            'primo range': StampedShift.objects.filter(checkin__gte=end - timedelta(weeks=18), checkin__lte=end, primo=primo),
+            # get_week_shifts
+            'week': StampedShift.objects.select_related('primo').filter(checkin__gte=monday),
+        }
+
+        # Antes de estos índices sólo existía el índice de la llave foránea
+        indexes, foreignKeyIndex = StampedShift._meta.indexes, Index(fields=['primo'], name='stampedshift_primo_bench')
+        with connection.schema_editor() as editor:
+            for index in indexes:
+                editor.remove_index(StampedShift, index)
+            editor.add_index(StampedShift, foreignKeyIndex)
+        with connection.cursor() as cursor:
+            cursor.execute(f'ANALYZE {StampedShift._meta.db_table}')
+        self.report('without indexes', queries, repeat)
+
+        with connection.schema_editor() as editor:
+            editor.remove_index(StampedShift, foreignKeyIndex)
+            for index in indexes:
+                editor.add_index(StampedShift, index)
+        with connection.cursor() as cursor:
+            cursor.execute(f'ANALYZE {StampedShift._meta.db_table}')
+        self.report('with indexes', queries, repeat)
+
+    def report(self, title, queries, repeat):
+        self.stdout.write(self.style.MIGRATE_HEADING(f'\n== {title}'))
+        for name, queryset in queries.items():
+            timings = []
+            for _ in range(repeat):
+                counter = perf_counter()
+                list(queryset.all())
+                timings.append((perf_counter() - counter)*1000)
+            self.stdout.write(self.style.SUCCESS(f'{name}: median {median(timings):.2f}ms, min {min(timings):.2f}ms ({repeat} runs)'))
+            self.stdout.write(queryset.explain(analyze=True))
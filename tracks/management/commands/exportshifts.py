@@ -0,0 +1,53 @@
+import sys
+from datetime import date
+from time import perf_counter
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Min
+
+from tracks.models import *
+from tracks import export
+from tracks import utils
+
+# Exporta los turnos registrados con su primo, bloque y puntualidad a un archivo (o a
+# la salida estándar si es CSV), igual que /shifts/export pero sin pasar por el
+# servidor. Los turnos se leen y escriben por tramos de <chunk> filas.
+
+class Command(BaseCommand):
+    help = 'Exports the stamped shifts with their primo, block and punctuality columns as CSV, Arrow IPC or Parquet'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', type=date.fromisoformat, help='First day to export (default: the first stamped shift)')
+        parser.add_argument('--end', type=date.fromisoformat, help='Last day to export (default: today)')
+        parser.add_argument('--format', choices=export.formats, default='csv')
+        parser.add_argument('--output', help='File to write, required unless the format is csv (default: stdout)')
+        parser.add_argument('--chunk', type=int, default=5000, help='Rows read and written at a time')
+
+    def handle(self, *args, start, end, format, output, chunk, **options):
+        if output is None and format != 'csv':
+            raise CommandError(f'Pass --output to export as {format}')
+
+        end = end or utils.now().date()
+        if start is None:
+            first = StampedShift.objects.aggregate(first=Min('checkin'))['first']
+            start = first.date() if first is not None else end
+
+        rows = 0
+        def counted(chunks):
+            nonlocal rows
+            for columns in chunks:
+                rows += len(columns['id'])
+                yield columns
+
+        counter = perf_counter()
+        _, _, write = export.formats[format]
+        file = sys.stdout.buffer if output is None else open(output, 'wb')
+        try:
+            for content in write(counted(export.chunks(start, end, chunk))):
+                file.write(content)
+        finally:
+            if output is not None:
+                file.close()
+
+        elapsed = perf_counter() - counter
+        self.stderr.write(self.style.SUCCESS(f'Exported {rows} stamped shifts ({start} - {end}) in {elapsed:.2f}s ({rows/elapsed:.0f} rows/s)'))
@@ -0,0 +1,196 @@
+import csv
+import io
+import json
+from datetime import date, datetime
+from time import perf_counter
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from tracks.models import *
+from tracks import parameters
+from tracks import utils
+
+# Carga de una vez primos, turnos registrados o turnos perdonados desde un CSV (con
+# encabezado) o un JSON (una lista de objetos) con las columnas:
+#   primos: rol, mail, name, nick, schedule
+#   shifts: mail, checkin, checkout (vacío si el turno no se cerró), en hora local
+#   pardons: date, block (el índice del bloque)
+# Los horarios se validan con utils.verifyRegex y las entradas de los turnos con
+# utils.aproximateToShift, igual que las que se registran por la api. Se descartan los registros repetidos,
+# tanto dentro del archivo como los que ya están en la base de datos: los primos por
+# mail, los turnos registrados por (primo, checkin) y los perdonados por (block, date).
+# Todo se inserta en una transacción con bulk_create por lotes, o con COPY en
+# PostgreSQL para los turnos registrados, que suelen ser la mayoría de las filas.
+# NOTA: Igual que el comando seed, no envía las señales que invalidan las cachés de
+# tracks/caches.py, así que hay que reiniciar el servidor si ya estaba corriendo. La
+# tabla Attendance sí se recalcula en el rango importado.
+
+class Command(BaseCommand):
+    help = 'Imports primos, stamped shifts or pardoned shifts from a CSV or JSON file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=['primos', 'shifts', 'pardons'])
+        parser.add_argument('path', help='CSV file with a header row, or JSON file with a list of objects')
+        parser.add_argument('--batch', type=int, default=5000, help='Rows per bulk_create batch')
+        parser.add_argument('--skip-invalid', action='store_true', help='Skip invalid records instead of aborting the import')
+
+    def handle(self, *args, kind, path, batch, skip_invalid, **options):
+        counter = perf_counter()
+        objects, errors, duplicates = getattr(self, kind)(read(path))
+        if errors:
+            for error in errors[:10]:
+                self.stderr.write(error)
+            if len(errors) > 10:
+                self.stderr.write(f'... and {len(errors) - 10} more')
+            if not skip_invalid:
+                raise CommandError(f'{len(errors)} invalid records, nothing was imported (use --skip-invalid to import the rest)')
+
+        with transaction.atomic():
+            if kind == 'primos':
+                Primo.objects.bulk_create(objects, batch_size=batch)
+                ScheduledShift.sync(objects)
+            elif kind == 'shifts' and connection.vendor == 'postgresql':
+                copy(StampedShift, ['primo_id', 'checkin', 'checkout'], ((shift.primo_id, shift.checkin, shift.checkout) for shift in objects))
+            elif kind == 'shifts':
+                StampedShift.objects.bulk_create(objects, batch_size=batch)
+            else:
+                PardonedShift.objects.bulk_create(objects, batch_size=batch)
+        elapsed = perf_counter() - counter
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {len(objects)} {kind} in {elapsed:.2f}s ({len(objects)/elapsed:.0f} rows/s), '
+            f'skipped {duplicates} duplicated and {len(errors)} invalid records'
+        ))
+
+        # Los turnos importados cambian la asistencia de sus días
+        days = [shift.checkin.date() for shift in objects] if kind == 'shifts' else [pardon.date for pardon in objects] if kind == 'pardons' else []
+        if days:
+            call_command('rebuildattendance', start=min(days), end=max(days), stdout=self.stdout)
+
+    # Cada método retorna los objetos a insertar, los errores y la cantidad de
+    # registros repetidos
+
+    def primos(self, records):
+        existing = dict(Primo.objects.values_list('mail', 'rol'))
+        rols = set(existing.values())
+        primos, errors, duplicates = [], [], 0
+        for n, record in records:
+            try:
+                primo = Primo(
+                    rol=int(record['rol']),
+                    mail=record['mail'].strip().lower(),
+                    name=record['name'].strip(),
+                    nick=record['nick'].strip(),
+                    schedule=record['schedule'].strip(),
+                )
+            except (KeyError, TypeError, ValueError, AttributeError) as error:
+                errors.append(f'Record {n}: {error!r}')
+                continue
+
+            if not utils.verifyRegex(primo.schedule):
+                errors.append(f'Record {n}: invalid schedule ({primo.schedule})')
+            elif primo.mail in existing:
+                duplicates += 1
+            elif primo.rol in rols:
+                errors.append(f'Record {n}: the rol {primo.rol} belongs to another primo')
+            else:
+                existing[primo.mail] = primo.rol
+                rols.add(primo.rol)
+                primos.append(primo)
+        return primos, errors, duplicates
+
+    def shifts(self, records):
+        primos = dict(Primo.objects.values_list('mail', 'rol'))
+        shifts, errors = [], []
+        for n, record in records:
+            try:
+                checkout = record.get('checkout') or None
+                shift = StampedShift(
+                    primo_id=primos[record['mail'].strip().lower()],
+                    checkin=parse(record['checkin']),
+                    checkout=None if checkout is None else parse(checkout),
+                )
+            except KeyError as error:
+                errors.append(f'Record {n}: unknown primo or missing column {error}')
+                continue
+            except (TypeError, ValueError, AttributeError) as error:
+                errors.append(f'Record {n}: {error!r}')
+                continue
+
+            if shift.checkout is not None and shift.checkout < shift.checkin:
+                errors.append(f'Record {n}: the checkout is before the checkin')
+                continue
+            try:
+                # El resto de la app asume que cada turno se aproxima a un bloque
+                utils.aproximateToShift(shift.checkin)
+            except Exception:
+                errors.append(f'Record {n}: the checkin ({shift.checkin}) is not close enough to any block')
+                continue
+            shifts.append(shift)
+
+        # Los turnos que ya estaban registrados se buscan en una sola consulta, dentro
+        # del rango de los turnos del archivo
+        seen = set()
+        if shifts:
+            seen = set(StampedShift.objects.filter(
+                primo__in={shift.primo_id for shift in shifts},
+                checkin__gte=min(shift.checkin for shift in shifts),
+                checkin__lte=max(shift.checkin for shift in shifts),
+            ).values_list('primo', 'checkin'))
+        unique = []
+        for shift in shifts:
+            if (shift.primo_id, shift.checkin) not in seen:
+                seen.add((shift.primo_id, shift.checkin))
+                unique.append(shift)
+        return unique, errors, len(shifts) - len(unique)
+
+    def pardons(self, records):
+        seen = set(PardonedShift.objects.values_list('block', 'date'))
+        pardons, errors, duplicates = [], [], 0
+        for n, record in records:
+            try:
+                pardon = PardonedShift(block=int(record['block']), date=date.fromisoformat(str(record['date']).strip()))
+            except (KeyError, TypeError, ValueError) as error:
+                errors.append(f'Record {n}: {error!r}')
+                continue
+
+            if not 0 <= pardon.block < len(parameters.Block):
+                errors.append(f'Record {n}: block ({pardon.block}) out of the range (0..{len(parameters.Block) - 1})')
+            elif (pardon.block, pardon.date) in seen:
+                duplicates += 1
+            else:
+                seen.add((pardon.block, pardon.date))
+                pardons.append(pardon)
+        return pardons, errors, duplicates
+
+# Pares (número de registro, registro) del archivo en <path>
+def read(path: str):
+    with open(path, newline='', encoding='utf-8') as file:
+        if path.endswith('.json'):
+            records = json.load(file)
+            if not isinstance(records, list):
+                raise CommandError('The JSON file must contain a list of objects')
+            yield from enumerate(records, 1)
+        else:
+            yield from enumerate(csv.DictReader(file), 1)
+
+# Los instantes se guardan sin zona horaria (USE_TZ = False), así que se rechazan los
+# que traen una para no guardarlos corridos
+def parse(value) -> datetime:
+    instant = datetime.fromisoformat(str(value).strip())
+    if instant.tzinfo is not None:
+        raise ValueError(f'{value} has a time zone, use the local time instead')
+    return instant
+
+# Inserta las filas <rows> en las columnas <columns> de la tabla de <model> con COPY,
+# bastante más rápido que INSERT para muchas filas
+def copy(model, columns: list, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    # En el formato csv de COPY un campo vacío sin comillas es NULL
+    writer.writerows(['' if value is None else value for value in row] for row in rows)
+    buffer.seek(0)
+    with connection.cursor() as cursor:
+        cursor.copy_expert(f'COPY {model._meta.db_table} ({", ".join(columns)}) FROM STDIN WITH (FORMAT csv)', buffer)
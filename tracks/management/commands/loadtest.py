@@ -0,0 +1,171 @@
+import json
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from http.client import HTTPConnection
+from random import Random
+from statistics import quantiles
+from threading import local
+from time import perf_counter
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand, CommandError
+
+from tracks import parameters
+
+# Reproduce tráfico concurrente contra un servidor corriendo y reporta el throughput
+# y los percentiles de latencia de cada ruta. Cada escenario es una mezcla de
+# operaciones con su peso (véase <scenarios>); el de check-in es la ráfaga al comienzo
+# de cada bloque, donde cada entrada es un POST /shifts seguido de un PUT /shifts si
+# se pudo iniciar el turno. Sirve para comparar la api síncrona (/api) con la
+# asíncrona (/api/async) bajo el servidor ASGI, y con --wsgi-url también la api
+# síncrona bajo un servidor WSGI (el servicio wsgi de docker-compose.yml, con
+# gunicorn), que es como conviene servirla; las rutas que no tiene la api asíncrona
+# se piden siempre a /api.
+# NOTA: Registra turnos (y perdona turnos en el escenario mixed) de verdad, así que
+# no se debe usar contra la base de datos de producción. Conviene llenarla antes con
+# el comando seed.
+
+class Client(local):
+    # Una conexión persistente por hilo
+    def __init__(self, url: str):
+        self.url = urlsplit(url)
+        self.connection = None
+
+    def request(self, method: str, path: str, payload = None):
+        if self.connection is None:
+            self.connection = HTTPConnection(self.url.hostname, self.url.port or 80, timeout=30)
+        body = None if payload is None else json.dumps(payload)
+        counter = perf_counter()
+        try:
+            self.connection.request(method, self.url.path.rstrip('/') + path, body, {'Content-Type': 'application/json'})
+            response = self.connection.getresponse()
+            content = response.read()
+        except OSError:
+            self.connection.close()
+            self.connection = None
+            return 0, None, perf_counter() - counter
+        return response.status, content, perf_counter() - counter
+
+# Una pasada de un escenario contra la api en <prefix>
+class Run():
+    def __init__(self, client: Client, prefix: str, mails: list, onDuty: list):
+        self.client, self.prefix = client, prefix
+        # Todos los primos y los que están de turno (los únicos que pueden entrar)
+        self.mails, self.onDuty = mails, onDuty
+        self.timings, self.statuses = defaultdict(list), defaultdict(Counter)
+
+    # Hace la petición y la registra como <route> (por defecto <path>)
+    def call(self, method: str, path: str, payload = None, route: str | None = None, syncOnly: bool = False):
+        prefix = '/api' if syncOnly else self.prefix
+        status, content, elapsed = self.client.request(method, prefix + path, payload)
+        route = f'{method} {prefix}{route or path}'
+        self.timings[route].append(elapsed)
+        self.statuses[route][status] += 1
+        return status, content
+
+# Operaciones, cada una recibe la pasada y un generador aleatorio propio
+
+def now(run: Run, rng: Random):
+    run.call('GET', '/now')
+
+def week(run: Run, rng: Random):
+    run.call('GET', '/shifts/week', syncOnly=True)
+
+def primos(run: Run, rng: Random):
+    run.call('GET', '/primos', syncOnly=True)
+
+def primo(run: Run, rng: Random):
+    run.call('GET', f'/primos/{rng.choice(run.mails)}', route='/primos/{mail}')
+
+# Estadísticas de un primo durante el último semestre
+def shifts(run: Run, rng: Random):
+    end = date.today()
+    run.call('GET', f'/shifts?mail={rng.choice(run.mails)}&start={end - timedelta(weeks=18)}&end={end}', route='/shifts', syncOnly=True)
+
+def report(run: Run, rng: Random):
+    end = date.today()
+    run.call('GET', f'/shifts/report?start={end - timedelta(weeks=18)}&end={end}', route='/shifts/report', syncOnly=True)
+
+def checkin(run: Run, rng: Random):
+    status, content = run.call('POST', '/shifts', {"mail": rng.choice(run.onDuty)})
+    if status == 200:
+        run.call('PUT', '/shifts', {"id": json.loads(content)["id"]})
+
+# Usa fechas lejanas para no alterar las estadísticas de los turnos reales
+def pardon(run: Run, rng: Random):
+    day = date(2000, 1, 3) + timedelta(days=rng.randrange(5*365))
+    run.call('POST', '/shifts/pardon', {"date": day.isoformat(), "block": rng.randrange(len(parameters.Block))}, syncOnly=True)
+
+def metrics(run: Run, rng: Random):
+    run.call('GET', '/metrics', syncOnly=True)
+
+# Escenarios como pares (operación, peso)
+scenarios = {
+    # Ráfaga de entradas y salidas al comienzo de un bloque
+    'checkin': [(checkin, 1)],
+    # Pantallas que consultan una y otra vez quién está de turno
+    'dashboard': [(now, 4), (week, 1)],
+    # Todas las rutas, en proporciones parecidas a las de un día normal
+    'mixed': [(now, 30), (week, 15), (primo, 15), (checkin, 10), (primos, 5), (shifts, 5), (report, 1), (pardon, 1), (metrics, 1)],
+}
+
+class Command(BaseCommand):
+    help = 'Replays concurrent traffic mixes against a running server and reports throughput and latency percentiles per route'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://localhost:8001', help='Base URL of the running ASGI server')
+        parser.add_argument('--prefix', action='append', help='API prefix to test on the ASGI server, can be repeated (default: /api and /api/async)')
+        parser.add_argument('--wsgi-url', help='Base URL of the same API under a WSGI server (e.g. http://localhost:8002), whose /api is also tested')
+        parser.add_argument('--scenario', action='append', choices=scenarios, help='Traffic mix to replay, can be repeated (default: checkin)')
+        parser.add_argument('--mail', action='append', help='Mail of a primo on shift, can be repeated (default: the pair of /now)')
+        parser.add_argument('--requests', type=int, default=500, help='Operations per scenario and prefix')
+        parser.add_argument('--concurrency', type=int, default=50)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, url, prefix, wsgi_url, scenario, mail, requests, concurrency, seed, **options):
+        client = Client(url)
+        mails, onDuty = self.discover(client)
+        # Pares (título, cliente, prefijo) de cada api a probar
+        targets = [(f'{api} (asgi)', client, api) for api in prefix or ['/api', '/api/async']]
+        if wsgi_url:
+            targets.insert(0, ('/api (wsgi)', Client(wsgi_url), '/api'))
+        onDuty = mail or onDuty
+        if not onDuty and any(operation is checkin for name in scenario or ['checkin'] for operation, _ in scenarios[name]):
+            raise CommandError('Nobody is on shift right now, pass the mails to check in with --mail')
+
+        for name in scenario or ['checkin']:
+            operations, weights = zip(*scenarios[name])
+            for title, target, api in targets:
+                run = Run(target, api, mails or onDuty, onDuty)
+
+                def operate(i: int):
+                    rng = Random(seed*requests + i)
+                    rng.choices(operations, weights)[0](run, rng)
+
+                counter = perf_counter()
+                with ThreadPoolExecutor(concurrency) as executor:
+                    list(executor.map(operate, range(requests)))
+                self.report(f'{name} {title}', perf_counter() - counter, run.timings, run.statuses)
+
+    # Todos los primos (/primos) y los que están de turno (/now)
+    def discover(self, client: Client):
+        status, content, _ = client.request('GET', '/api/primos')
+        if status != 200:
+            raise CommandError(f'GET /api/primos answered {status}, is the server running at the given --url?')
+        mails = [primo["mail"] for primo in json.loads(content)]
+        _, content, _ = client.request('GET', '/api/now')
+        return mails, [primo["mail"] for primo in json.loads(content)["pair"]]
+
+    def report(self, title: str, elapsed: float, timings: dict, statuses: dict):
+        total = sum(len(samples) for samples in timings.values())
+        self.stdout.write(self.style.MIGRATE_HEADING(f'== {title}: {total} requests in {elapsed:.2f}s ({total/elapsed:.1f} req/s)'))
+        for route, samples in sorted(timings.items()):
+            self.stdout.write(f'{route}: {percentiles(samples)} {dict(statuses[route])}')
+
+# p50, p90 y p99 en milisegundos
+def percentiles(samples: list) -> str:
+    if len(samples) < 2:
+        samples = samples*2
+    cuts = quantiles([sample*1000 for sample in samples], n=100)
+    return f'p50 {cuts[49]:.1f}ms p90 {cuts[89]:.1f}ms p99 {cuts[98]:.1f}ms'
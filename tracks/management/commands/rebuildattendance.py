@@ -0,0 +1,44 @@
+from datetime import date, timedelta
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+from django.db.models import Min
+
+from tracks.models import *
+from tracks import attendance
+from tracks import utils
+
+# Recalcula la tabla Attendance a partir de StampedShift y PardonedShift, por tramos
+# de <chunk> días para no cargar todo el historial de una vez. Sin fechas recalcula
+# desde el primer turno registrado hasta hoy (por ejemplo después de migrar o de
+# cargar turnos con bulk_create). Con --days 1 recalcula ayer y hoy, que es lo que
+# hay que correr cada noche para registrar las ausencias (véase tracks/attendance.py).
+
+class Command(BaseCommand):
+    help = 'Rebuilds the attendance rollup from the stamped and pardoned shifts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', type=date.fromisoformat, help='First day to rebuild (default: the first stamped shift)')
+        parser.add_argument('--end', type=date.fromisoformat, help='Last day to rebuild (default: today)')
+        parser.add_argument('--days', type=int, help='Rebuild only the last DAYS days and today, overrides --start')
+        parser.add_argument('--chunk', type=int, default=28, help='Days rebuilt per transaction')
+
+    def handle(self, *args, start, end, days, chunk, **options):
+        today = utils.now().date()
+        end = end or today
+        if days is not None:
+            start = today - timedelta(days=days)
+        elif start is None:
+            first = StampedShift.objects.aggregate(first=Min('checkin'))['first']
+            start = first.date() if first is not None else end
+
+        counter = perf_counter()
+        rows = 0
+        day = start
+        while day <= end:
+            last = min(day + timedelta(days=chunk - 1), end)
+            rows += attendance.refresh(day, last)
+            day = last + timedelta(days=1)
+
+        elapsed = perf_counter() - counter
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {rows} attendance rows ({start} - {end}) in {elapsed:.2f}s'))
@@ -0,0 +1,56 @@
+from datetime import timedelta
+from random import Random
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from tracks.models import *
+from tracks import attendance
+from tracks import synthetic
+from tracks import utils
+
+# Llena la base de datos con primos sintéticos (roles desde synthetic.firstRol), su
+# historial de turnos registrados hasta hoy y turnos perdonados, para probar la api
+# con un volumen realista (por ejemplo con el comando loadtest).
+# NOTA: Usa bulk_create, que no envía las señales que invalidan las cachés de
+# tracks/caches.py, así que hay que reiniciar el servidor si ya estaba corriendo.
+
+class Command(BaseCommand):
+    help = 'Seeds the database with synthetic primos, their stamped shift history and pardoned shifts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--primos', type=int, default=60)
+        parser.add_argument('--shifts', type=int, default=4, help='Shifts per week of each primo')
+        parser.add_argument('--years', type=float, default=2, help='Years of history to generate')
+        parser.add_argument('--pardons', type=int, default=40, help='Pardoned shifts to generate within the history')
+        # Con otro dest, para no tapar el módulo tracks.attendance dentro de handle
+        parser.add_argument('--attendance', type=float, default=0.9, dest='attendance_rate', help='Fraction of the scheduled shifts that get stamped')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--clear', action='store_true', help='Delete the synthetic primos (and their shifts) before seeding')
+
+    def handle(self, *args, primos, shifts, years, pardons, attendance_rate, seed, clear, **options):
+        rng = Random(seed)
+        end = utils.now().date()
+        start = end - timedelta(days=round(365*years))
+        counter = perf_counter()
+
+        with transaction.atomic():
+            if clear:
+                deleted, _ = Primo.objects.filter(rol__gte=synthetic.firstRol).delete()
+                self.stdout.write(f'Deleted {deleted} rows')
+            seeded = Primo.objects.bulk_create(synthetic.primos(rng, primos, shifts))
+            ScheduledShift.sync(seeded)
+            stamped = StampedShift.objects.bulk_create(synthetic.stampedShifts(rng, seeded, start, end, attendance_rate), batch_size=5000)
+            # Los que ya estaban perdonados se ignoran
+            pardoned = PardonedShift.objects.bulk_create(synthetic.pardonedShifts(rng, start, end, pardons), ignore_conflicts=True)
+            # bulk_create tampoco actualiza la asistencia, así que se recalcula el rango
+            # completo para todos los primos (los perdones afectan a todos)
+            rollup = attendance.refresh(start, end)
+
+        elapsed = perf_counter() - counter
+        rows = len(seeded) + len(stamped) + len(pardoned)
+        self.stdout.write(self.style.SUCCESS(
+            f'Seeded {len(seeded)} primos, {len(stamped)} stamped shifts, {len(pardoned)} pardoned shifts and {rollup} attendance rows ({start} - {end}) '
+            f'in {elapsed:.2f}s ({rows/elapsed:.0f} rows/s)'
+        ))
@@ -0,0 +1,177 @@
+import atexit
+import logging
+import sys
+from asyncio import iscoroutinefunction
+from asyncio.coroutines import _is_coroutine
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+from threading import Lock
+from time import perf_counter
+
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+# Métricas de la api, en reemplazo del antiguo utils.logged. Un middleware mide cada
+# petición (latencia, código de respuesta y consultas a la base de datos) sin tener
+# que decorar cada endpoint, y las deja en un registro que se publica en /api/metrics
+# en el formato de texto de Prometheus. Cada petición también queda en el log
+# "tracks.requests", que escribe desde un hilo aparte para no bloquear la respuesta.
+# NOTA: Las métricas son de este proceso, si hay varios procesos cada uno tiene las
+# suyas. El stream de tracks/stream.py no pasa por Django, así que no se mide.
+
+# Límites (en segundos) de los buckets del histograma de latencia
+buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Registry():
+    def __init__(self):
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # (método, ruta) -> conteos por bucket (el último es +Inf), suma y cantidad
+            self.latency = {}
+            # (método, ruta, código) -> cantidad de respuestas
+            self.responses = {}
+            # (método, ruta) -> [consultas, segundos en la base de datos]
+            self.database = {}
+
+    def observe(self, method: str, route: str, status: int, elapsed: float, queries: int, queriesTime: float):
+        key = (method, route)
+        with self._lock:
+            histogram = self.latency.setdefault(key, [[0]*(len(buckets) + 1), 0.0, 0])
+            histogram[0][next((i for i, bound in enumerate(buckets) if elapsed <= bound), len(buckets))] += 1
+            histogram[1] += elapsed
+            histogram[2] += 1
+            self.responses[(*key, status)] = self.responses.get((*key, status), 0) + 1
+            database = self.database.setdefault(key, [0, 0.0])
+            database[0] += queries
+            database[1] += queriesTime
+
+    # Exporta el registro en el formato de texto de Prometheus
+    # https://prometheus.io/docs/instrumenting/exposition_formats/
+    def render(self) -> str:
+        with self._lock:
+            latency = {key: (list(counts), total, count) for key, (counts, total, count) in self.latency.items()}
+            responses = dict(self.responses)
+            database = {key: tuple(value) for key, value in self.database.items()}
+
+        lines = [
+            '# HELP tracks_request_duration_seconds Request latency by route.',
+            '# TYPE tracks_request_duration_seconds histogram',
+        ]
+        for (method, route), (counts, total, count) in sorted(latency.items()):
+            labels = f'method="{method}",route="{route}"'
+            cumulative = 0
+            for bound, n in zip((*buckets, '+Inf'), counts):
+                cumulative += n
+                lines.append(f'tracks_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'tracks_request_duration_seconds_sum{{{labels}}} {total}')
+            lines.append(f'tracks_request_duration_seconds_count{{{labels}}} {count}')
+
+        lines += [
+            '# HELP tracks_responses_total Responses by route and status code.',
+            '# TYPE tracks_responses_total counter',
+        ]
+        for (method, route, status), n in sorted(responses.items()):
+            lines.append(f'tracks_responses_total{{method="{method}",route="{route}",status="{status}"}} {n}')
+
+        lines += [
+            '# HELP tracks_db_queries_total Database queries by route.',
+            '# TYPE tracks_db_queries_total counter',
+        ]
+        lines += [f'tracks_db_queries_total{{method="{method}",route="{route}"}} {queries}' for (method, route), (queries, _) in sorted(database.items())]
+        lines += [
+            '# HELP tracks_db_query_seconds_total Time spent in database queries by route.',
+            '# TYPE tracks_db_query_seconds_total counter',
+        ]
+        lines += [f'tracks_db_query_seconds_total{{method="{method}",route="{route}"}} {elapsed}' for (method, route), (_, elapsed) in sorted(database.items())]
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+logger = logging.getLogger('tracks.requests')
+
+# Consultas de la petición en curso, como [cantidad, segundos]. Las vistas asíncronas
+# consultan la base de datos desde otro hilo (sync_to_async), pero este copia el
+# contexto, así que las consultas se siguen sumando a la misma petición.
+_queries = ContextVar('queries', default=None)
+
+def _measure(execute, sql, params, many, context):
+    queries = _queries.get()
+    if queries is None:
+        return execute(sql, params, many, context)
+    counter = perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        queries[0] += 1
+        queries[1] += perf_counter() - counter
+
+# Cada hilo tiene su propia conexión, así que se instala la medición en todas
+@receiver(connection_created)
+def instrument_connection(sender, connection, **kwargs):
+    if _measure not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_measure)
+
+# Ruta (el patrón de la url, no la url) con la que se agrupan las métricas, así
+# /api/primos/{mail} es una sola serie y no una por primo
+def route(request) -> str:
+    match = getattr(request, 'resolver_match', None)
+    return match.route if match is not None else 'unmatched'
+
+class MetricsMiddleware():
+    # Funciona tanto con WSGI como con ASGI, para no pasar las vistas de
+    # tracks/asyncapi.py a un hilo
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            self._is_coroutine = _is_coroutine
+
+    def __call__(self, request):
+        if iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        token, counter = _queries.set([0, 0.0]), perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            queries = _queries.get()
+            _queries.reset(token)
+        self.record(request, response, perf_counter() - counter, queries)
+        return response
+
+    async def __acall__(self, request):
+        token, counter = _queries.set([0, 0.0]), perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            queries = _queries.get()
+            _queries.reset(token)
+        self.record(request, response, perf_counter() - counter, queries)
+        return response
+
+    def record(self, request, response, elapsed: float, queries: list):
+        registry.observe(request.method, route(request), response.status_code, elapsed, *queries)
+        logger.info('%s %s %s %.0fms %dq %.0fms', request.method, request.get_full_path(), response.status_code, elapsed*1000, queries[0], queries[1]*1000)
+
+# Los registros de "tracks.requests" se encolan y un hilo aparte los escribe en la
+# salida estándar, así la petición nunca espera a que se escriba el log.
+_listener = None
+
+def startLogging():
+    global _listener
+    if _listener is not None:
+        return
+    queue = SimpleQueue()
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    _listener = QueueListener(queue, handler)
+    _listener.start()
+    logger.addHandler(QueueHandler(queue))
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    atexit.register(_listener.stop)
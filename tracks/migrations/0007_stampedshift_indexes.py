@@ -0,0 +1,39 @@
+# Generated by Django 4.0.4 on 2026-10-17 14:34
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracks', '0006_pardonedshift_rename_shift_stampedshift_and_more'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='pardonedshift',
+            options={'ordering': ['date', 'block']},
+        ),
+        migrations.AlterModelOptions(
+            name='stampedshift',
+            options={'ordering': ['checkin']},
+        ),
+        migrations.AlterField(
+            model_name='stampedshift',
+            name='primo',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='tracks.primo'),
+        ),
+        migrations.AddIndex(
+            model_name='stampedshift',
+            index=models.Index(fields=['primo', 'checkin'], name='stampedshift_primo_checkin'),
+        ),
+        migrations.AddIndex(
+            model_name='stampedshift',
+            index=models.Index(fields=['checkin'], name='stampedshift_checkin'),
+        ),
+        migrations.AddIndex(
+            model_name='stampedshift',
+            index=models.Index(condition=models.Q(('checkout__isnull', True)), fields=['primo', 'checkin'], name='stampedshift_running'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.0.4 on 2026-10-17 14:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracks', '0007_stampedshift_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='pardonedshift',
+            index=models.Index(fields=['date', 'block'], name='pardonedshift_date_block'),
+        ),
+    ]
@@ -0,0 +1,61 @@
+# Generated by Django 4.0.4 on 2026-10-17 14:50
+
+from django.db import migrations, models
+import django.db.models.deletion
+import re
+
+
+# Formato de Primo.schedule al momento de esta migración (días de lunes a viernes y
+# 8 bloques), copiado de tracks/parameters.py para que la migración no cambie si
+# cambian los bloques
+weekdays = 'lmxjv'
+schedulePattern = re.compile(r'([lmxjv](?:[0-7],)*[0-7])')
+
+# Pares (día de la semana, índice del bloque) del horario <schedule>
+def schedule_shifts(schedule):
+    return {
+        (weekdays.index(daily[0]), int(block))
+        for daily in schedulePattern.findall(schedule)
+        for block in daily[1:].split(',')
+    }
+
+# Llena ScheduledShift a partir del Primo.schedule de los primos que ya existen
+def populate_scheduled_shifts(apps, schema_editor):
+    Primo = apps.get_model('tracks', 'Primo')
+    ScheduledShift = apps.get_model('tracks', 'ScheduledShift')
+    ScheduledShift.objects.bulk_create([
+        ScheduledShift(primo=primo, weekday=weekday, block=block)
+        for primo in Primo.objects.all()
+        for weekday, block in sorted(schedule_shifts(primo.schedule))
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracks', '0008_pardonedshift_date_block'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScheduledShift',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('weekday', models.IntegerField()),
+                ('block', models.IntegerField()),
+                ('primo', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='tracks.primo')),
+            ],
+            options={
+                'ordering': ['primo', 'weekday', 'block'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='scheduledshift',
+            index=models.Index(fields=['weekday', 'block'], name='scheduledshift_weekday_block'),
+        ),
+        migrations.AddConstraint(
+            model_name='scheduledshift',
+            constraint=models.UniqueConstraint(fields=('primo', 'weekday', 'block'), name='unique_primo_weekday_block'),
+        ),
+        migrations.RunPython(populate_scheduled_shifts, migrations.RunPython.noop),
+    ]
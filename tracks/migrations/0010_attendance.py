@@ -0,0 +1,36 @@
+# Generated by Django 4.0.4 on 2026-10-17 14:58
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracks', '0009_scheduledshift'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Attendance',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('date', models.DateField()),
+                ('block', models.IntegerField()),
+                ('status', models.CharField(choices=[('on-time', 'On time'), ('late', 'Late'), ('suspicious', 'Suspicious'), ('missing', 'Missing'), ('pardoned', 'Pardoned')], max_length=10)),
+                ('lateness', models.IntegerField(null=True)),
+                ('primo', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='tracks.primo')),
+            ],
+            options={
+                'ordering': ['primo', 'date', 'block'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='attendance',
+            index=models.Index(fields=['date'], name='attendance_date'),
+        ),
+        migrations.AddConstraint(
+            model_name='attendance',
+            constraint=models.UniqueConstraint(fields=('primo', 'date', 'block'), name='unique_primo_date_block'),
+        ),
+    ]
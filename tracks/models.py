@@ -1,6 +1,12 @@
 # type: ignore
+from datetime import datetime
+from typing import List
+
+from django.db import transaction
 from django.db.models import *
 
+from tracks import utils
+
 class Primo(Model):
     rol = IntegerField(primary_key=True)
     mail = CharField(unique=True, max_length=100)
@@ -12,13 +18,25 @@ class Primo(Model):
 
 class StampedShift(Model):
     id = AutoField(primary_key=True)
-    primo = ForeignKey(Primo, on_delete=CASCADE)
+    # Sin índice propio, el índice (primo, checkin) ya sirve para buscar por primo. Lo
+    # mismo pasa con las restricciones únicas de ScheduledShift y Attendance, que
+    # también comienzan por primo.
+    primo = ForeignKey(Primo, on_delete=CASCADE, db_index=False)
     
     checkin = DateTimeField()
     checkout = DateTimeField(null=True)
 
     class Meta:
         ordering = ['checkin']
+        indexes = [
+            # Turnos de un primo dentro de un rango de fechas (/shifts)
+            Index(fields=['primo', 'checkin'], name='stampedshift_primo_checkin'),
+            # Turnos de todos los primos desde una fecha (/shifts/week)
+            Index(fields=['checkin'], name='stampedshift_checkin'),
+            # Turno corriendo de un primo (/primos/{mail}), sólo indexa los turnos
+            # sin cerrar, por lo que se mantiene pequeño aunque crezca el historial
+            Index(fields=['primo', 'checkin'], condition=Q(checkout__isnull=True), name='stampedshift_running'),
+        ]
 
 class PardonedShift(Model):
     id = AutoField(primary_key=True)
@@ -31,3 +49,82 @@ class PardonedShift(Model):
         constraints = [
             UniqueConstraint(fields=['block', 'date'], name='unique_block_date')
         ]
+        indexes = [
+            # Turnos perdonados dentro de un rango de fechas (/shifts)
+            Index(fields=['date', 'block'], name='pardonedshift_date_block'),
+        ]
+
+# Horario de los primos normalizado, una fila por cada turno semanal de
+# Primo.schedule, para que la base de datos pueda responder quién tiene turno en
+# cierto día y bloque. Se mantiene al día con Primo.schedule desde tracks/signals.py.
+# NOTA: bulk_create no envía señales, así que quien cree primos con bulk_create
+# (por ejemplo el comando seed) debe llamar a ScheduledShift.sync.
+class ScheduledShift(Model):
+    id = AutoField(primary_key=True)
+    primo = ForeignKey(Primo, on_delete=CASCADE, db_index=False)
+
+    weekday = IntegerField() # 0 es lunes
+    block = IntegerField() # Índice del bloque en parameters.Block
+
+    class Meta:
+        ordering = ['primo', 'weekday', 'block']
+        constraints = [
+            UniqueConstraint(fields=['primo', 'weekday', 'block'], name='unique_primo_weekday_block')
+        ]
+        indexes = [
+            # Primos de turno en un día y bloque (/now, POST /shifts)
+            Index(fields=['weekday', 'block'], name='scheduledshift_weekday_block'),
+        ]
+
+    # Reemplaza los turnos semanales de <primos> por los de su Primo.schedule actual,
+    # en una transacción para que nadie vea a los primos sin turnos
+    @classmethod
+    def sync(cls, primos: List[Primo]):
+        with transaction.atomic():
+            cls.objects.filter(primo__in=primos).delete()
+            cls.objects.bulk_create({
+                (primo.pk, weekday, block.index): cls(primo=primo, weekday=weekday, block=block.index)
+                for primo in primos
+                for weekday, block in utils.scheduleBlocks(primo.schedule)
+            }.values())
+
+    # Expresión para annotate que indica si el primo puede iniciar un turno en el
+    # instante <instant> según su horario
+    @classmethod
+    def onShift(cls, instant: datetime):
+        if (block := utils.checkinBlock(instant)) is None:
+            return Value(False)
+        return Exists(cls.objects.filter(primo=OuterRef('pk'), weekday=instant.weekday(), block=block.index))
+
+# Asistencia ya clasificada, una fila por cada turno (primo, fecha, bloque) que el
+# primo tenía en su horario o en el que registró un turno sospechoso. Es un resumen
+# de StampedShift y PardonedShift que se mantiene al día desde tracks/signals.py
+# (véase tracks/attendance.py), para que los reportes sean simples agregaciones.
+class Attendance(Model):
+    class Status(TextChoices):
+        ONTIME = 'on-time', 'On time'
+        LATE = 'late' # Dentro de la tolerancia, pero después del comienzo del bloque
+        SUSPICIOUS = 'suspicious'
+        MISSING = 'missing'
+        PARDONED = 'pardoned'
+
+    id = AutoField(primary_key=True)
+    primo = ForeignKey(Primo, on_delete=CASCADE, db_index=False)
+
+    date = DateField()
+    block = IntegerField() # Índice del bloque en parameters.Block
+
+    status = CharField(max_length=10, choices=Status.choices)
+    # Minutos de atraso con que se inició el turno, negativo si fue antes del
+    # comienzo del bloque. Nulo si no se registró ningún turno.
+    lateness = IntegerField(null=True)
+
+    class Meta:
+        ordering = ['primo', 'date', 'block']
+        constraints = [
+            UniqueConstraint(fields=['primo', 'date', 'block'], name='unique_primo_date_block')
+        ]
+        indexes = [
+            # Asistencia de todos los primos dentro de un rango de fechas (/shifts/attendance)
+            Index(fields=['date'], name='attendance_date'),
+        ]
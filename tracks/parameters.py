@@ -1,3 +1,4 @@
+import re
 from datetime import time, timedelta
 from functools import total_ordering
 from warnings import warn
@@ -20,20 +21,40 @@ class BlockMeta(type):
     def __getitem__(self, key):
         return self._blocks[key]
 
+# Los bloques son inmutables y hay uno solo por cada bloque (se comparan por
+# identidad), así que se pueden usar como llaves de diccionarios y en sets.
 @total_ordering
 class Block(metaclass=BlockMeta):
+    __slots__ = ('name', 'start', 'end', 'index')
+
     def __init__(self, name: str, start: time, end: time) -> None:
-        self.name = name
-        self.start = start
-        self.end = end
+        object.__setattr__(self, 'name', name)
+        object.__setattr__(self, 'start', start)
+        object.__setattr__(self, 'end', end)
+        # Posición del bloque en Block, es el mismo número que se usa en el
+        # horario de los primos y en PardonedShift.block
+        object.__setattr__(self, 'index', len(Block._blocks))
 
         Block._blocks.append(self)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'Block is immutable, cannot set {name}')
+
+    # Una copia sería otro bloque distinto a los de Block
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
     
     def __repr__(self) -> str:
         return f"Block('{self.name}', {self.start.isoformat('minutes')}, {self.end.isoformat('minutes')})"
     
     def __eq__(self, other):
         return self is other
+
+    def __hash__(self):
+        return self.index
     
     def __lt__(self, other):
         return self.start < other.start
@@ -50,6 +71,10 @@ Block('13-14', time(17, 10), time(18, 20))
 Block('15-16', time(18, 30), time(19, 40))
 
 scheduleRegEx = f"([{days['short']}](?:[0-{(lastShift := len(Block) - 1)}],)*[0-{lastShift}])"
+# Compilados una sola vez: <schedulePattern> encuentra cada día del horario y
+# <fullSchedulePattern> valida el horario completo
+schedulePattern = re.compile(scheduleRegEx)
+fullSchedulePattern = re.compile(f'{scheduleRegEx}+')
 
 # TOLERANCIAS
 # beforeStartTolerance: Cuanto tiempo antes de que comienze el turno se puede
@@ -101,3 +126,29 @@ def checks():
     if afterEndTolerance > minRest:
         warn(f'El tiempo de tolerancia <afterEndTolerance> ({str(afterEndTolerance)}) es mayor al descanso más pequeño ({minRest})')
 checks()
+
+# TABLAS DE BÚSQUEDA
+# Inicio y término de cada bloque en microsegundos desde que comenzó el día. Como
+# los bloques están ordenados y no se traslapan (véase checks), utils.aproximateToShift
+# puede encontrar el bloque de un instante con una búsqueda binaria sobre <blockEnds>
+# en lugar de recorrer todos los bloques.
+# NOTA: Esto asume que los bloques se declaran en orden, tal como están arriba.
+def microseconds(t: time) -> int:
+    return ((t.hour*60 + t.minute)*60 + t.second)*1_000_000 + t.microsecond
+
+blockStarts = [microseconds(block.start) for block in Block]
+blockEnds = [microseconds(block.end) for block in Block]
+beforeStartMicroseconds = beforeStartTolerance // timedelta(microseconds=1)
+afterStartMicroseconds = afterStartTolerance // timedelta(microseconds=1)
+# Instante del día (en microsegundos) en el que se cierra la tolerancia de entrada de
+# cada bloque, para utils.checkinBlock
+checkinEnds = [start + afterStartMicroseconds for start in blockStarts]
+# Instantes del día (en microsegundos) en los que cambia la respuesta de /now: justo
+# después de que se abre la tolerancia de entrada de un bloque, cuando se cierra y
+# justo después de que termina el bloque.
+blockTransitions = sorted({
+    moment
+    for start, end in zip(blockStarts, blockEnds)
+    for moment in (start - beforeStartMicroseconds + 1, start + afterStartMicroseconds, end + 1)
+    if moment >= 0
+})
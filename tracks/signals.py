@@ -0,0 +1,52 @@
+from datetime import date
+from functools import partial
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from tracks.models import Primo, StampedShift, PardonedShift, ScheduledShift
+from tracks import caches
+from tracks import events
+from tracks import attendance
+
+# Las invalidaciones se hacen una vez que se confirma la transacción, de lo
+# contrario otra petición podría reconstruir la caché con los datos antiguos.
+
+# La semana guardada muestra el nick de los primos, así que se descarta sin importar
+# cuál sea
+@receiver([post_save, post_delete], sender=Primo)
+def primo_changed(sender, **kwargs):
+    transaction.on_commit(caches.invalidateScheduleIndex)
+    transaction.on_commit(partial(caches.invalidateWeekShifts, date.max))
+
+# Al borrar un primo sus turnos semanales se borran en cascada
+@receiver(post_save, sender=Primo)
+def primo_saved(sender, instance, **kwargs):
+    ScheduledShift.sync([instance])
+
+@receiver([post_save, post_delete], sender=PardonedShift)
+def pardoned_shift_changed(sender, **kwargs):
+    transaction.on_commit(caches.invalidatePardonedShifts)
+
+@receiver([post_save, post_delete], sender=StampedShift)
+def stamped_shift_changed(sender, instance, **kwargs):
+    transaction.on_commit(partial(caches.invalidateWeekShifts, instance.checkin.date()))
+
+@receiver(post_save, sender=StampedShift)
+def stamped_shift_saved(sender, instance, created, **kwargs):
+    transaction.on_commit(partial(events.publishShift, instance, created))
+
+# Los turnos registrados de un primo que se borra se borran en cascada, y no tiene
+# sentido recalcular su asistencia, que también se borra
+@receiver(pre_delete, sender=Primo)
+def primo_deleting(sender, instance, **kwargs):
+    attendance.forgetPrimo(instance.rol)
+
+@receiver([post_save, post_delete], sender=StampedShift)
+def stamped_shift_attendance(sender, instance, **kwargs):
+    attendance.refreshStampOnCommit(instance.primo_id, instance.checkin)
+
+@receiver([post_save, post_delete], sender=PardonedShift)
+def pardoned_shift_attendance(sender, instance, **kwargs):
+    attendance.refreshOnCommit(instance.date, instance.block)
@@ -0,0 +1,131 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
+from django.db import close_old_connections, connections
+
+from tracks import utils
+from tracks.api import now_payload
+from tracks.events import broadcaster, message
+
+# Stream de eventos (Server-Sent Events) para las pantallas que muestran quién está
+# de turno. Al conectarse se envía la respuesta de /now (evento "now") y luego:
+#  - "checkin" / "checkout": Cada vez que se registra o cierra un turno, en el
+#    formato de RegisteredShift.
+#  - "now": Cada vez que comienza o termina un bloque o su tolerancia de entrada.
+# Se atiende directamente desde PrimosCheckIn/asgi.py, por lo que sólo funciona bajo
+# un servidor ASGI (uvicorn, daphne, etc.), no con runserver ni WSGI.
+
+path = '/api/stream'
+
+# Cada cuántos segundos se envía un comentario para que los proxies no corten la conexión
+heartbeat = 15
+
+# Publica la respuesta de /now cada vez que cambia el bloque. Hay una sola tarea por
+# proceso, que corre mientras haya pantallas conectadas.
+_ticker = None
+
+async def _tick():
+    while True:
+        now = utils.now()
+        await asyncio.sleep((utils.nextTransition(now) - now).total_seconds())
+        broadcaster.publish('now', await sync_to_async(now_payload)(utils.now()))
+
+async def stream(scope, receive, send):
+    global _ticker
+    queue = broadcaster.subscribe()
+    if _ticker is None or _ticker.done():
+        _ticker = asyncio.create_task(_tick())
+
+    try:
+        headers = [
+            (b'content-type', b'text/event-stream'),
+            (b'cache-control', b'no-cache'),
+            # Evita que nginx acumule los eventos
+            (b'x-accel-buffering', b'no'),
+        ]
+        if settings.CORS_ORIGIN_ALLOW_ALL:
+            headers.append((b'access-control-allow-origin', b'*'))
+        await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+
+        payload = await sync_to_async(now_payload)(utils.now())
+        await send({'type': 'http.response.body', 'body': message('now', payload), 'more_body': True})
+
+        disconnected = asyncio.ensure_future(_disconnected(receive))
+        try:
+            while True:
+                event = asyncio.ensure_future(queue.get())
+                done, _ = await asyncio.wait({event, disconnected}, timeout=heartbeat, return_when=asyncio.FIRST_COMPLETED)
+                if event in done:
+                    await send({'type': 'http.response.body', 'body': event.result(), 'more_body': True})
+                    continue
+                event.cancel()
+                if disconnected in done:
+                    break
+                await send({'type': 'http.response.body', 'body': b': heartbeat\n\n', 'more_body': True})
+        finally:
+            disconnected.cancel()
+    finally:
+        broadcaster.unsubscribe(queue)
+        if not broadcaster.subscribers and _ticker is not None:
+            _ticker.cancel()
+            _ticker = None
+
+async def _disconnected(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+# Envuelve la aplicación ASGI de Django <application> para atender el stream en <path>
+def streaming(application):
+    async def router(scope, receive, send):
+        if scope['type'] == 'http' and scope['path'] == path and scope['method'] == 'GET':
+            return await stream(scope, receive, send)
+        return await application(scope, receive, send)
+    return router
+
+# Django 4.0 recorre las respuestas en streaming (/shifts/history?stream=true,
+# /shifts/export) dentro del event loop, que queda bloqueado mientras se lee cada
+# parte de la base de datos y no atiende ni las demás peticiones ni este stream. Este
+# handler lee cada parte en un hilo propio de la respuesta (siempre el mismo, para que
+# use una sola conexión) y sólo espera el resultado en el event loop.
+# NOTA: Django 4.2 recorre las respuestas asíncronas sin bloquear el event loop; al
+# actualizarlo se puede volver a get_asgi_application.
+class StreamingASGIHandler(ASGIHandler):
+    async def send_response(self, response, send):
+        if not response.streaming:
+            return await super().send_response(response, send)
+
+        # Los encabezados se envían igual que en ASGIHandler.send_response
+        headers = []
+        for header, value in response.items():
+            if isinstance(header, str):
+                header = header.encode('ascii')
+            if isinstance(value, str):
+                value = value.encode('latin1')
+            headers.append((bytes(header), bytes(value)))
+        for cookie in response.cookies.values():
+            headers.append((b'Set-Cookie', cookie.output(header='').encode('ascii').strip()))
+        await send({'type': 'http.response.start', 'status': response.status_code, 'headers': headers})
+
+        loop = asyncio.get_running_loop()
+        reader = ThreadPoolExecutor(1, thread_name_prefix='streaming')
+        parts = iter(response)
+        try:
+            while (part := await loop.run_in_executor(reader, next, parts, None)) is not None:
+                for chunk, _ in self.chunk_bytes(part):
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body'})
+        finally:
+            # El contenido (y su cursor) se cierra en el hilo que lo leyó, y luego su
+            # conexión, que ningún otro hilo va a reutilizar
+            await loop.run_in_executor(reader, _close, response)
+            reader.shutdown(wait=False)
+            await sync_to_async(close_old_connections, thread_sensitive=True)()
+
+def _close(response):
+    try:
+        response.close()
+    finally:
+        connections.close_all()
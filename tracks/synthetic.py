@@ -0,0 +1,58 @@
+from datetime import date, datetime, timedelta
+from random import Random
+from typing import Iterator, List
+
+from tracks.models import *
+from tracks import utils
+from tracks import parameters
+
+# Generadores de datos sintéticos para los benchmarks. Todo se genera a partir de
+# parameters.Block y de las tolerancias, por lo que los turnos resultantes son
+# coherentes con lo que aceptaría la api. Ninguna función guarda nada en la base
+# de datos, sólo retornan los objetos para que se guarden con bulk_create.
+
+# Los primos sintéticos usan roles a partir de este número para no chocar con
+# los roles reales.
+firstRol = 900_000_000
+
+# Retorna un horario aleatorio válido (en el formato del regex) con <shifts> turnos
+def randomSchedule(rng: Random, shifts: int = 4) -> str:
+    pairs = sorted(rng.sample([(weekday, block) for weekday in range(5) for block in range(len(parameters.Block))], shifts))
+    schedule = ''
+    for weekday in sorted({weekday for weekday, _ in pairs}):
+        schedule += parameters.days['short'][weekday] + ','.join(str(block) for day, block in pairs if day == weekday)
+    return schedule
+
+def primos(rng: Random, n: int, shifts: int = 4) -> List[Primo]:
+    return [Primo(
+        rol=(rol := firstRol + i),
+        mail=f'synthetic{rol}@primos.cl',
+        name=f'Primo Sintético {i}',
+        nick=f'synthetic{i}',
+        schedule=randomSchedule(rng, shifts),
+    ) for i in range(n)]
+
+# Genera los turnos registrados de <primos> entre <start> y <end> (ambos incluidos).
+# Cada turno del horario se registra con probabilidad <attendance>; la entrada cae
+# dentro de la tolerancia del bloque y la salida poco después de que termina, salvo
+# una fracción <unclosed> de turnos que nunca se cerraron.
+def stampedShifts(rng: Random, primos: List[Primo], start: date, end: date, attendance: float = 0.9, unclosed: float = 0.02) -> Iterator[StampedShift]:
+    checkinWindow = int((parameters.beforeStartTolerance + parameters.afterStartTolerance).total_seconds())
+    checkoutWindow = int(parameters.afterEndTolerance.total_seconds())
+    for primo in primos:
+        _, schedule = utils.parseSchedule(primo.schedule, datetime.combine(start, datetime.min.time()))
+        while (shift := next(schedule)).day <= end:
+            if rng.random() >= attendance:
+                continue
+            checkin = shift.checkin - parameters.beforeStartTolerance + timedelta(seconds=rng.randrange(1, checkinWindow))
+            checkout = None
+            if rng.random() >= unclosed:
+                checkout = shift.checkout + timedelta(seconds=rng.randrange(1, checkoutWindow))
+            yield StampedShift(primo=primo, checkin=checkin, checkout=checkout)
+
+
+# Retorna <n> turnos perdonados distintos entre <start> y <end>, sólo en días hábiles
+def pardonedShifts(rng: Random, start: date, end: date, n: int) -> List[PardonedShift]:
+    days = [day for i in range((end - start).days + 1) if (day := start + timedelta(days=i)).weekday() < 5]
+    shifts = rng.sample(range(len(days)*len(parameters.Block)), min(n, len(days)*len(parameters.Block)))
+    return [PardonedShift(date=days[i // len(parameters.Block)], block=i % len(parameters.Block)) for i in sorted(shifts)]
@@ -1,5 +1,1233 @@
-from django.test import TestCase
+from datetime import date, datetime, time, timedelta, timezone as dt_timezone
+from importlib import import_module
+from itertools import islice, takewhile
+from random import Random
+from time import sleep
+import asyncio
+import copy
+import csv
+import io
+import json
+import tempfile
+from unittest import mock
+from zoneinfo import ZoneInfo
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.http import StreamingHttpResponse
+from django.db import IntegrityError, transaction
+from django.db.models.signals import post_delete
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
 
+from tracks.models import *
+from tracks import utils
+from tracks import parameters
+from tracks import caches
+from tracks import analytics
+from tracks import attendance
+from tracks import synthetic
+from tracks import events
+from tracks import export
+from tracks import stream
+from tracks import db
+from tracks import metrics
+from tracks import api
 
+# Congela la hora de toda la app en <instant>
+def frozen(instant: datetime):
+    return mock.patch.object(utils, 'now', return_value=instant)
+
+class NowTests(TestCase):
+    def setUp(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Primo.objects.create(rol=1, mail='ana@primos.cl', name='Ana', nick='ana', schedule='l0,1m2')
+            Primo.objects.create(rol=2, mail='beto@primos.cl', name='Beto', nick='beto', schedule='l1v7')
+
+    def pair(self, instant: datetime):
+        with frozen(instant):
+            response = self.client.get('/api/now')
+        self.assertEqual(response.status_code, 200)
+        return sorted(primo['mail'] for primo in response.json()['pair'])
+
+    def test_pair_follows_schedule(self):
+        # Lunes 2022-09-05
+        self.assertEqual(self.pair(datetime(2022, 9, 5, 8, 20)), ['ana@primos.cl'])
+        self.assertEqual(self.pair(datetime(2022, 9, 5, 9, 30)), ['ana@primos.cl', 'beto@primos.cl'])
+        self.assertEqual(self.pair(datetime(2022, 9, 5, 14, 0)), [])
+        # Durante el fin de semana el bloque más cercano es el 1-2 del lunes siguiente
+        self.assertEqual(self.pair(datetime(2022, 9, 10, 12, 0)), ['ana@primos.cl'])
+
+    def test_index_is_rebuilt_when_a_primo_changes(self):
+        instant = datetime(2022, 9, 6, 11, 0)
+        self.assertEqual(self.pair(instant), ['ana@primos.cl'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            beto = Primo.objects.get(rol=2)
+            beto.schedule = 'm2'
+            beto.save()
+        self.assertEqual(self.pair(instant), ['ana@primos.cl', 'beto@primos.cl'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Primo.objects.get(rol=1).delete()
+        self.assertEqual(self.pair(instant), ['beto@primos.cl'])
+
+# Implementación original de utils.aproximateToShift, recorre todos los bloques.
+# Se mantiene como referencia para comprobar que la búsqueda binaria es equivalente.
+def legacyAproximateToShift(instant: datetime, strictmode = True):
+    firstHour = instant.date()
+    if (weekday := firstHour.weekday()) > 4:
+        if strictmode:
+            raise Exception()
+        firstHour += timedelta(days=7 - weekday)
+    for block in parameters.Block:
+        checkin = datetime.combine(firstHour, block.start)
+        checkout = datetime.combine(firstHour, block.end)
+        if strictmode:
+            nextblockCondition = checkin - parameters.beforeStartTolerance < instant < checkin
+        else:
+            nextblockCondition = instant < checkin
+        if (checkin <= instant <= checkout) or nextblockCondition:
+            return utils.Shift(firstHour, block)
+    if strictmode:
+        raise Exception()
+    return utils.Shift(firstHour + timedelta(days=7), parameters.Block[0])
+
+class AproximateToShiftTests(SimpleTestCase):
+    def assertSameShift(self, instant: datetime, strictmode: bool):
+        try:
+            expected = legacyAproximateToShift(instant, strictmode)
+        except Exception:
+            with self.assertRaises(Exception, msg=instant):
+                utils.aproximateToShift(instant, strictmode)
+            return
+        shift = utils.aproximateToShift(instant, strictmode)
+        self.assertEqual((shift.day, shift.block), (expected.day, expected.block), msg=instant)
+
+    def test_matches_linear_search_every_minute_of_the_week(self):
+        monday = datetime(2022, 9, 5)
+        for minute in range(7*24*60):
+            for offset in (timedelta(), timedelta(seconds=59), timedelta(seconds=59, microseconds=999999)):
+                instant = monday + timedelta(minutes=minute) + offset
+                self.assertSameShift(instant, True)
+                self.assertSameShift(instant, False)
+
+    def test_matches_linear_search_on_block_boundaries(self):
+        day = datetime(2022, 9, 7)
+        for block in parameters.Block:
+            for edge in (block.start, block.end):
+                edge = datetime.combine(day, edge)
+                for delta in (timedelta(), timedelta(microseconds=1), parameters.beforeStartTolerance):
+                    for instant in (edge - delta, edge + delta):
+                        self.assertSameShift(instant, True)
+                        self.assertSameShift(instant, False)
+
+# utils.onShift antes de que el horario se consultara desde ScheduledShift
+def legacyOnShift(schedule: str, instant: datetime) -> bool:
+    for shift in utils.DEPRECATED_parseSchedule(schedule, instant):
+        if (shift.checkin - parameters.beforeStartTolerance) < instant < (shift.checkin + parameters.afterStartTolerance):
+            return True
+    return False
+
+class ScheduledShiftTests(TestCase):
+    def scheduled(self, primo: Primo) -> set:
+        return set(ScheduledShift.objects.filter(primo=primo).values_list('weekday', 'block'))
+
+    def test_follows_the_schedule_string(self):
+        primo = Primo.objects.create(rol=1, mail='ana@primos.cl', name='Ana', nick='ana', schedule='l0,0m2')
+        self.assertEqual(self.scheduled(primo), {(0, 0), (1, 2)})
+        primo.schedule = 'v7'
+        primo.save()
+        self.assertEqual(self.scheduled(primo), {(4, 7)})
+        primo.delete()
+        self.assertFalse(ScheduledShift.objects.exists())
+
+    def test_sync_is_all_or_nothing(self):
+        primo = Primo.objects.create(rol=1, mail='ana@primos.cl', name='Ana', nick='ana', schedule='l0,0m2')
+        primo.schedule = 'v7'
+        with mock.patch.object(ScheduledShift.objects, 'bulk_create', side_effect=IntegrityError), self.assertRaises(IntegrityError):
+            ScheduledShift.sync([primo])
+        self.assertEqual(self.scheduled(primo), {(0, 0), (1, 2)})
+
+    def test_on_shift_matches_the_schedule_string(self):
+        rng = Random(3)
+        schedules = [synthetic.randomSchedule(rng, rng.randrange(1, 10)) for _ in range(20)] + [synthetic.randomSchedule(rng, 5*len(parameters.Block))]
+        primos = [Primo.objects.create(rol=i, mail=f'{i}@primos.cl', name=str(i), nick=str(i), schedule=schedule) for i, schedule in enumerate(schedules)]
+
+        monday = datetime(2022, 9, 5)
+        instants = [datetime.combine(monday + timedelta(days=day), block.start) + delta
+            for day in range(7) for block in parameters.Block
+            for delta in (-parameters.beforeStartTolerance, -parameters.beforeStartTolerance + timedelta(microseconds=1), timedelta(), parameters.afterStartTolerance - timedelta(microseconds=1), parameters.afterStartTolerance)]
+        instants += [monday + timedelta(seconds=rng.randrange(7*24*60*60)) for _ in range(100)]
+        for instant in instants:
+            onShift = dict(Primo.objects.annotate(onShift=ScheduledShift.onShift(instant)).values_list('mail', 'onShift'))
+            for primo in primos:
+                self.assertEqual(onShift[primo.mail], legacyOnShift(primo.schedule, instant), msg=(primo.schedule, instant))
+
+class ScheduleParsingTests(SimpleTestCase):
+    def test_parses_sorted_and_without_duplicates(self):
+        self.assertEqual(utils.scheduleShifts('v7m2,0l1m0'), ((0, 1), (1, 0), (1, 2), (4, 7)))
+        self.assertEqual(utils.scheduleBlocks('l1'), ((0, parameters.Block[1]),))
+
+    def test_memoized(self):
+        schedule = synthetic.randomSchedule(Random(1), 6)
+        first = utils.scheduleShifts(schedule)
+        hits = utils.scheduleShifts.cache_info().hits
+        self.assertIs(utils.scheduleShifts(schedule), first)
+        self.assertEqual(utils.scheduleShifts.cache_info().hits, hits + 1)
+
+    def test_migration_parser_matches(self):
+        # La migración 0009 tiene su propia copia del formato
+        migration = import_module('tracks.migrations.0009_scheduledshift')
+        rng = Random(2)
+        for schedule in [synthetic.randomSchedule(rng, rng.randrange(1, 12)) for _ in range(50)] + ['v7m2,0l1m0']:
+            self.assertEqual(sorted(migration.schedule_shifts(schedule)), list(utils.scheduleShifts(schedule)), msg=schedule)
+
+    def test_unsorted_schedules_yield_shifts_in_order(self):
+        _, shifts = utils.parseSchedule('v0l1', datetime(2022, 9, 6))
+        self.assertEqual([(shift.day, shift.block) for shift in islice(shifts, 3)], [
+            (date(2022, 9, 9), parameters.Block[0]),
+            (date(2022, 9, 12), parameters.Block[1]),
+            (date(2022, 9, 16), parameters.Block[0]),
+        ])
+
+    def test_verify(self):
+        for schedule, valid in (('l0', True), ('l0,1m7', True), ('', False), ('l0,', False), ('s0', False), ('l8', False)):
+            self.assertEqual(utils.verifyRegex(schedule), valid, msg=schedule)
+
+class ValueTypesTests(SimpleTestCase):
+    def test_blocks_are_hashable_singletons(self):
+        block = parameters.Block[2]
+        self.assertFalse(hasattr(block, '__dict__'))
+        self.assertEqual({block: 1}[parameters.Block[2]], 1)
+        self.assertIs(copy.deepcopy(block), block)
+        self.assertLess(parameters.Block[1], block)
+        with self.assertRaises(AttributeError):
+            block.name = '1-2'
+
+    def test_shifts_are_ordered_hashable_values(self):
+        monday, tuesday = date(2022, 9, 5), date(2022, 9, 6)
+        shifts = [utils.Shift(tuesday, parameters.Block[0]), utils.Shift(monday, parameters.Block[3]), utils.Shift(monday, parameters.Block[1])]
+        self.assertEqual(sorted(shifts), [shifts[2], shifts[1], shifts[0]])
+        self.assertIn(utils.Shift(monday, parameters.Block[3]), set(shifts))
+        self.assertGreater(shifts[0], shifts[1])
+        self.assertEqual(shifts[0].checkin, datetime(2022, 9, 6, 8, 15))
+        with self.assertRaises(AttributeError):
+            shifts[0].day = monday
+
+# utils._scheduleGenerator antes de buscar el primer turno con bisect
+def legacyScheduleGenerator(schedule, reference: datetime):
+    i = 0
+    monday = utils.firstWeekday(reference)
+    for weekday, block in schedule:
+        checkout = datetime.combine(monday, block.end) + timedelta(days=weekday)
+        if checkout >= reference:
+            break
+        i += 1
+    else:
+        i = 0
+        monday += timedelta(days=7)
+
+    while True:
+        weekday, block = schedule[i]
+        yield utils.Shift(monday + timedelta(days=weekday), block)
+        if not (i := (i + 1)%len(schedule)):
+            monday += timedelta(days=7)
+
+class UpcomingShiftTests(SimpleTestCase):
+    def schedules(self, rng: Random):
+        return [synthetic.randomSchedule(rng, rng.randrange(1, 12)) for _ in range(10)] + [synthetic.randomSchedule(rng, 5*len(parameters.Block))]
+
+    def instants(self, rng: Random):
+        monday = datetime(2022, 9, 5)
+        instants = [datetime.combine(monday + timedelta(days=day), edge) + delta
+            for day in range(7) for block in parameters.Block for edge in (block.start, block.end)
+            for delta in (-timedelta(microseconds=1), timedelta(), timedelta(microseconds=1))]
+        return instants + [monday + timedelta(seconds=rng.randrange(7*24*60*60)) for _ in range(50)]
+
+    def test_matches_walking_the_schedule(self):
+        rng = Random(5)
+        for schedule in self.schedules(rng):
+            for reference in self.instants(rng):
+                expected = list(islice(legacyScheduleGenerator(utils.scheduleBlocks(schedule), reference), 50))
+                _, shifts = utils.parseSchedule(schedule, reference)
+                self.assertEqual(list(islice(shifts, 50)), expected, msg=(schedule, reference))
+                for k in (0, 1, 7, 49):
+                    self.assertEqual(utils.upcomingShift(schedule, reference, k), expected[k], msg=(schedule, reference, k))
+
+    def test_expected_shifts_in_bulk(self):
+        rng = Random(6)
+        for schedule in self.schedules(rng):
+            start = date(2022, 1, 1) + timedelta(days=rng.randrange(365))
+            end = start + timedelta(days=rng.randrange(-1, 3*365))
+            _, shifts = utils.parseSchedule(schedule, datetime.combine(start, time()))
+            expected = list(takewhile(lambda shift: shift.day <= end, shifts))
+            days, blocks = analytics.expectedShifts(schedule, start, end)
+            self.assertEqual(list(zip(days.tolist(), blocks.tolist())), [(shift.day, shift.block.index) for shift in expected], msg=(schedule, start, end))
+
+# Cada endpoint debe hacer un número fijo de consultas, sin importar cuántos
+# turnos o primos haya. Si alguno de estos tests falla después de agregar un campo
+# a la respuesta, probablemente falta un select_related.
+class QueryCountTests(TestCase):
+    # Miércoles 2022-09-07, recién comenzado el bloque 5-6
+    instant = datetime(2022, 9, 7, 10, 57)
+
+    @classmethod
+    def setUpTestData(cls):
+        monday = utils.firstWeekday(cls.instant)
+        for rol in range(1, 6):
+            primo = Primo.objects.create(rol=rol, mail=f'primo{rol}@primos.cl', name=f'Primo {rol}', nick=f'p{rol}', schedule='l0,1m2x0,1')
+            for day in range(3):
+                for block in parameters.Block[:2]:
+                    checkin = datetime.combine(monday + timedelta(days=day), block.start)
+                    StampedShift.objects.create(primo=primo, checkin=checkin, checkout=checkin + timedelta(minutes=70))
+        cls.onDuty = Primo.objects.create(rol=10, mail='turno@primos.cl', name='Turno', nick='turno', schedule='x2')
+        cls.running = StampedShift.objects.create(primo=cls.onDuty, checkin=cls.instant - timedelta(minutes=1))
+        PardonedShift.objects.create(block=0, date=monday)
+
+    def setUp(self):
+        caches.invalidateScheduleIndex()
+        caches.invalidateWeekShifts(date.max)
+
+    # Cuenta también las consultas de los on_commit, como el recálculo de la asistencia
+    def assertQueries(self, queries: int, method: str, path: str, payload = None):
+        with frozen(self.instant), self.assertNumQueries(queries), self.captureOnCommitCallbacks(execute=True):
+            if payload is None:
+                response = getattr(self.client, method)(path)
+            else:
+                response = getattr(self.client, method)(path, json.dumps(payload), content_type='application/json')
+        self.assertLess(response.status_code, 400, response.content)
+
+    def test_now(self):
+        # Sólo la primera llamada construye el índice del horario
+        self.assertQueries(1, 'get', '/api/now')
+        self.assertQueries(0, 'get', '/api/now')
+
+    def test_primos(self):
+        self.assertQueries(1, 'get', '/api/primos')
+        self.assertQueries(2, 'get', '/api/primos/primo1@primos.cl')
+
+    def test_shifts(self):
+        self.assertQueries(3, 'get', '/api/shifts?mail=primo1@primos.cl&start=2022-09-01&end=2022-09-08')
+
+    def test_shifts_report(self):
+        self.assertQueries(3, 'get', '/api/shifts/report?start=2022-09-01&end=2022-09-08')
+
+    def test_shifts_attendance(self):
+        self.assertQueries(1, 'get', '/api/shifts/attendance?start=2022-09-01&end=2022-09-08')
+        self.assertQueries(2, 'get', '/api/shifts/attendance?mail=primo1@primos.cl&start=2022-09-01&end=2022-09-08')
+
+    def test_shift_history(self):
+        self.assertQueries(1, 'get', '/api/shifts/history?start=2022-09-01&end=2022-09-08&limit=5')
+        self.assertQueries(2, 'get', '/api/shifts/history?mail=primo1@primos.cl&start=2022-09-01&end=2022-09-08')
+
+    def test_shifts_punctuality(self):
+        self.assertQueries(4, 'get', '/api/shifts/punctuality?start=2022-09-01&end=2022-09-08')
+        self.assertQueries(4, 'get', '/api/shifts/punctuality?mail=primo1@primos.cl&start=2022-09-01&end=2022-09-08')
+
+    def test_week_shifts(self):
+        # La segunda llamada sale de caches.weekShifts
+        self.assertQueries(1, 'get', '/api/shifts/week')
+        self.assertQueries(0, 'get', '/api/shifts/week')
+
+    # Cada escritura recalcula una sola vez la fila de cada bloque que cambió: bloquea
+    # al primo, lee sus turnos y los perdonados del día, y borra e inserta la fila
+
+    def test_push_a_shift(self):
+        self.assertQueries(2 + 5, 'post', '/api/shifts', {"mail": "turno@primos.cl"})
+
+    def test_update_a_shift(self):
+        self.assertQueries(2 + 5, 'put', '/api/shifts', {"id": self.running.id})
+
+    def test_pardon_a_shift(self):
+        # Nadie tiene turno ese día, así que no hay filas que insertar
+        self.assertQueries(1 + 4, 'post', '/api/shifts/pardon', {"block": 1, "date": "2022-09-08"})
+
+    def test_push_a_batch(self):
+        # Un solo recálculo por bloque para todos los turnos del lote (el bloque 1-2 de
+        # los cinco primos y el bloque 5-6 del primo de turno), después del bulk_create
+        # y el bulk_update con su savepoint
+        self.assertQueries(2 + 4 + 2*5, 'post', '/api/shifts/batch', {"events": [
+            {"type": "checkout", "mail": "turno@primos.cl", "at": self.instant.isoformat()},
+        ] + [
+            {"type": "checkin", "mail": f"primo{rol}@primos.cl", "at": (datetime.combine(utils.firstWeekday(self.instant) + timedelta(days=2), parameters.Block[0].start) + timedelta(minutes=1)).isoformat()}
+            for rol in range(1, 6)
+        ]})
+
+    def test_delete_a_primo(self):
+        # Sin recalcular la asistencia de los turnos que se borran en cascada
+        with self.assertNumQueries(6), self.captureOnCommitCallbacks(execute=True):
+            Primo.objects.get(rol=1).delete()
+
+class PardonTests(TestCase):
+    path = '/api/shifts?mail=ana@primos.cl&start=2022-09-05&end=2022-09-19'
+
+    @classmethod
+    def setUpTestData(cls):
+        Primo.objects.create(rol=1, mail='ana@primos.cl', name='Ana', nick='ana', schedule='l0')
+        PardonedShift.objects.create(block=0, date=datetime(2022, 9, 5))
+        # Fuera del rango pedido
+        PardonedShift.objects.create(block=0, date=datetime(2022, 9, 26))
+
+    def setUp(self):
+        caches.invalidatePardonedShifts()
+
+    def labels(self):
+        with frozen(datetime(2022, 9, 20)):
+            return self.client.get(self.path).json()['labels']
+
+    def pardon(self, day: str):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/api/shifts/pardon', json.dumps({"block": 0, "date": day}), content_type='application/json')
+
+    def test_pardoned_shifts_are_skipped(self):
+        self.assertEqual(self.labels(), ['lun 1-2', 'lun 1-2'])
+        self.pardon('2022-09-12')
+        self.assertEqual(self.labels(), ['lun 1-2'])
+
+    @override_settings(PARDON_CACHE=True)
+    def test_cached_pardons_are_invalidated_on_write(self):
+        self.assertEqual(self.labels(), ['lun 1-2', 'lun 1-2'])
+        with self.assertNumQueries(2):
+            self.assertEqual(self.labels(), ['lun 1-2', 'lun 1-2'])
+        self.pardon('2022-09-12')
+        self.assertEqual(self.labels(), ['lun 1-2'])
+
+# Implementación original de las estadísticas de /shifts, recorre los turnos uno por
+# uno con varios cursores. Se mantiene como referencia para tracks.analytics.
+def legacyResume(primo: Primo, start: date, end: date) -> dict:
+    inSchedule, suspicious = [], []
+    for stampedShift in StampedShift.objects.filter(checkin__gte=start, checkin__lte=end, primo=primo):
+        shift = utils.aproximateToShift(stampedShift.checkin)
+        fshift = {
+            "id": stampedShift.id,
+            "primo": {"mail": primo.mail, "nick": primo.nick},
+            "checkin": stampedShift.checkin,
+            "checkout": stampedShift.checkout,
+            "block": shift.block.name,
+            "start": datetime.combine(shift.day, shift.block.start),
+            "end": datetime.combine(shift.day, shift.block.end),
+        }
+        rightCheckin = (shift.checkin - parameters.beforeStartTolerance) < fshift["checkin"] < (shift.checkin  + parameters.afterStartTolerance)
+        rigthCheckout = (fshift["checkout"] is not None) and (shift.checkout < fshift["checkout"] < (shift.checkout + parameters.afterEndTolerance))
+        if rightCheckin and rigthCheckout:
+            inSchedule.append(fshift)
+        else:
+            suspicious.append(fshift)
+
+    pardonedShifts = [utils.Shift(shift.date, parameters.Block[shift.block]) for shift in PardonedShift.objects.all()]
+    _, schedule = utils.parseSchedule(primo.schedule, datetime.combine(start, time()))
+    datapoints, labels, shifts = [], [], []
+    j, k = 0, 0
+    while (shift := next(schedule)).day <= end:
+        while k < len(pardonedShifts) and pardonedShifts[k] < shift:
+            k += 1
+        if k >= len(pardonedShifts) or shift != pardonedShifts[k]:
+            labels.append(f"{parameters.days['mid'][shift.day.weekday()]} {shift.block.name}")
+            if (
+                    j < len(inSchedule)
+                and shift.day == inSchedule[j]["checkin"].date()
+                and shift.block.name == inSchedule[j]["block"]
+            ):
+                checkinTime = inSchedule[j]["checkin"].time()
+                shiftStartTime = shift.block.start
+                datapoints.append(60*(shiftStartTime.hour - checkinTime.hour) + shiftStartTime.minute - checkinTime.minute)
+                shifts.append(inSchedule[j])
+                j += 1
+            else:
+                datapoints.append(None)
+                shifts.append({
+                    "id": None, "primo": None, "checkin": None, "checkout": None,
+                    "block": shift.block.name,
+                    "start": datetime.combine(shift.day, shift.block.start),
+                    "end": datetime.combine(shift.day, shift.block.end),
+                })
+
+    return {
+        "primo": {"mail": primo.mail, "nick": primo.nick},
+        "start": start,
+        "end": end,
+        "shifts": shifts,
+        "suspicious": suspicious,
+        "datapoints": datapoints,
+        "labels": labels,
+    }
+
+class AnalyticsTests(TestCase):
+    start, end = date(2022, 3, 7), date(2022, 7, 15)
+
+    def seed(self, seed: int):
+        rng = Random(seed)
+        primos = Primo.objects.bulk_create(synthetic.primos(rng, 3, shifts=rng.randint(1, 8)))
+        ScheduledShift.sync(primos)
+        stamps = list(synthetic.stampedShifts(rng, primos, self.start - timedelta(days=7), self.end + timedelta(days=7), attendance=0.8, unclosed=0.05))
+        for stamp in rng.sample(stamps, len(stamps)//10):
+            # Turnos cerrados antes de tiempo
+            stamp.checkout = stamp.checkin + timedelta(minutes=rng.randint(1, 60))
+
+        # El recorrido original se traba si el primo registró un turno que después
+        # fue perdonado, así que sólo se perdonan turnos sin registrar
+        stamped = {(stamp.checkin.date(), utils.aproximateToShift(stamp.checkin).block.index) for stamp in stamps}
+        candidates = [(self.start + timedelta(days=day), block) for day in range((self.end - self.start).days) for block in range(len(parameters.Block))]
+        pardons = [PardonedShift(date=day, block=block) for day, block in rng.sample(candidates, 40) if (day, block) not in stamped]
+        StampedShift.objects.bulk_create(stamps)
+        PardonedShift.objects.bulk_create(pardons)
+        return primos
+
+    def test_matches_legacy_loop(self):
+        for seed in range(5):
+            with self.subTest(seed=seed):
+                for primo in self.seed(seed):
+                    self.assertEqual(analytics.primoResume(primo, self.start, self.end), legacyResume(primo, self.start, self.end))
+                Primo.objects.all().delete()
+                PardonedShift.objects.all().delete()
+
+    def test_team_report_matches_each_primo(self):
+        primos = self.seed(0)
+        with self.assertNumQueries(3):
+            report = analytics.teamResume(self.start, self.end)
+        self.assertEqual(report, [analytics.primoResume(primo, self.start, self.end) for primo in primos])
+
+    def test_unmatched_stamps_are_suspicious(self):
+        ana = Primo.objects.create(rol=1, mail='ana@primos.cl', name='Ana', nick='ana', schedule='l0')
+        Primo.objects.create(rol=2, mail='beto@primos.cl', name='Beto', nick='beto', schedule='l0')
+        # Un sábado, no se aproxima a ningún bloque
+        saturday = StampedShift.objects.create(primo=ana, checkin=datetime(2022, 3, 12, 10), checkout=datetime(2022, 3, 12, 11))
+        response = self.client.get('/api/shifts/report?start=2022-03-07&end=2022-03-13')
+        self.assertEqual(response.status_code, 200)
+        ana, beto = response.json()
+        self.assertEqual([(shift["id"], shift["block"], shift["start"]) for shift in ana["suspicious"]], [
+            (saturday.id, parameters.Block[0].name, datetime.combine(date(2022, 3, 14), parameters.Block[0].start).isoformat()),
+        ])
+        self.assertEqual(ana["datapoints"], [None])
+        self.assertEqual(beto["suspicious"], [])
+        self.assertEqual(self.client.get('/api/shifts?mail=ana@primos.cl&start=2022-03-07&end=2022-03-13').json(), ana)
+
+    def test_database_punctuality_matches_resume(self):
+        for seed in range(3):
+            with self.subTest(seed=seed):
+                primos = self.seed(seed)
+                # Sin turnos duplicados, así que cada turno correcto se cuenta una vez
+                summaries = analytics.teamPunctuality(self.start, self.end)
+                self.assertEqual(len(summaries), len(primos))
+                for primo, summary in zip(primos, summaries):
+                    # /shifts no incluye los turnos registrados el último día (compara el
+                    # checkin con la fecha), así que se le pide hasta el sábado
+                    resume = analytics.primoResume(primo, self.start, self.end + timedelta(days=1))
+                    lateness = [-datapoint for datapoint in resume["datapoints"] if datapoint is not None]
+                    self.assertEqual(summary, analytics.primoPunctuality(primo, self.start, self.end))
+                    self.assertEqual(summary["primo"], resume["primo"])
+                    self.assertEqual((summary["expected"], summary["attended"], summary["missing"]), (len(resume["shifts"]), len(lateness), len(resume["shifts"]) - len(lateness)))
+                    self.assertEqual((summary["onTime"], summary["late"]), (sum(1 for minutes in lateness if minutes <= 0), sum(1 for minutes in lateness if minutes > 0)))
+                    self.assertEqual(summary["suspicious"], len(resume["suspicious"]))
+                    if lateness:
+                        self.assertAlmostEqual(summary["lateness"], sum(lateness)/len(lateness))
+                    else:
+                        self.assertIsNone(summary["lateness"])
+                Primo.objects.all().delete()
+                PardonedShift.objects.all().delete()
+
+    def test_duplicated_stamps_do_not_hide_later_shifts(self):
+        primo = Primo.objects.create(rol=1, mail='ana@primos.cl', name='Ana', nick='ana', schedule='l0')
+        for day in (date(2022, 9, 5), date(2022, 9, 5), date(2022, 9, 12)):
+            checkin = datetime.combine(day, parameters.Block[0].start)
+            StampedShift.objects.create(primo=primo, checkin=checkin, checkout=checkin + timedelta(minutes=71))
+        resume = analytics.primoResume(primo, date(2022, 9, 5), date(2022, 9, 13))
+        self.assertEqual(resume['datapoints'], [0, 0])
+
+class AttendanceTests(TestCase):
+    start, end = AnalyticsTests.start, AnalyticsTests.end
+
+    def rows(self, **kwargs) -> list:
+        return list(Attendance.objects.filter(**kwargs).values_list('primo', 'date', 'block', 'status', 'lateness'))
+
+    def test_rebuild_matches_analytics(self):
+        primos = AnalyticsTests.seed(self, 0)
+        with frozen(datetime(2022, 8, 1)):
+            call_command('rebuildattendance', start=self.start, end=self.end, chunk=10, stdout=io.StringIO())
+        blocks = {block.name: block.index for block in parameters.Block}
+        Status = Attendance.Status
+
+        for primo in primos:
+            # /shifts no incluye los turnos registrados el último día (compara el
+            # checkin con la fecha), así que se le pide hasta el sábado
+            resume = analytics.primoResume(primo, self.start, self.end + timedelta(days=1))
+            rows = Attendance.objects.filter(primo=primo)
+            keys = lambda statuses: {(row.date, row.block) for row in rows if row.status in statuses}
+            shiftKey = lambda shift: (shift["start"].date(), blocks[shift["block"]])
+
+            self.assertEqual(
+                [row.lateness for row in rows if row.status in (Status.ONTIME, Status.LATE)],
+                [-datapoint for datapoint in resume["datapoints"] if datapoint is not None],
+            )
+            self.assertTrue(all((row.status == Status.LATE) == (row.lateness > 0) for row in rows if row.status in (Status.ONTIME, Status.LATE)))
+            # Los turnos esperados de /shifts son los que no fueron perdonados
+            expected = {shiftKey(shift) for shift in resume["shifts"]}
+            scheduled = set(zip(*(array.tolist() for array in analytics.expectedShifts(primo.schedule, self.start, self.end))))
+            self.assertEqual(keys({Status.ONTIME, Status.LATE, Status.MISSING}) | (keys({Status.SUSPICIOUS}) & scheduled), expected)
+            self.assertEqual(keys({Status.PARDONED}), scheduled - expected)
+            self.assertEqual(keys({Status.SUSPICIOUS}), {shiftKey(shift) for shift in resume["suspicious"]} - keys({Status.ONTIME, Status.LATE, Status.PARDONED}))
+
+    def test_incremental_matches_rebuild(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Primo.objects.create(rol=1, mail='ana@primos.cl', name='Ana', nick='ana', schedule='l0x2')
+            Primo.objects.create(rol=2, mail='beto@primos.cl', name='Beto', nick='beto', schedule='x2v0')
+
+        def call(instant: datetime, method: str, path: str, payload: dict):
+            with frozen(instant), self.captureOnCommitCallbacks(execute=True):
+                return getattr(self.client, method)(path, json.dumps(payload), content_type='application/json').json()
+
+        monday = datetime(2022, 9, 5)
+        start = datetime.combine(monday, parameters.Block[0].start)
+        # Ana llega 3 minutos tarde el lunes
+        shift = call(start + timedelta(minutes=3), 'post', '/api/shifts', {"mail": "ana@primos.cl"})
+        call(start + timedelta(minutes=75), 'put', '/api/shifts', {"id": shift["id"]})
+        self.assertEqual(self.rows(), [(1, monday.date(), 0, 'late', 3)])
+
+        # El miércoles Ana llega antes y cierra temprano, y Beto entra desde un kiosko sin conexión
+        wednesday = datetime.combine(monday + timedelta(days=2), parameters.Block[2].start)
+        shift = call(wednesday - timedelta(minutes=2), 'post', '/api/shifts', {"mail": "ana@primos.cl"})
+        call(wednesday + timedelta(minutes=5), 'put', '/api/shifts', {"id": shift["id"]})
+        call(wednesday + timedelta(hours=2), 'post', '/api/shifts/batch', {"events": [
+            {"type": "checkin", "mail": "beto@primos.cl", "at": wednesday.isoformat()},
+            {"type": "checkout", "mail": "beto@primos.cl", "at": (wednesday + timedelta(minutes=72)).isoformat()},
+        ]})
+        # Se perdona el lunes y se borra el turno de Ana del miércoles
+        call(wednesday + timedelta(hours=2), 'post', '/api/shifts/pardon', {"block": 0, "date": "2022-09-05"})
+        self.assertEqual(self.rows(date=wednesday.date()), [(1, wednesday.date(), 2, 'suspicious', -2), (2, wednesday.date(), 2, 'on-time', 0)])
+        with frozen(wednesday + timedelta(hours=2)), self.captureOnCommitCallbacks(execute=True):
+            StampedShift.objects.get(id=shift["id"]).delete()
+
+        with frozen(wednesday + timedelta(hours=2)):
+            incremental = self.rows()
+            attendance.refresh(monday.date(), wednesday.date())
+        self.assertEqual(incremental, self.rows())
+        self.assertEqual(incremental, [
+            (1, monday.date(), 0, 'pardoned', None),
+            (1, wednesday.date(), 2, 'missing', None),
+            (2, wednesday.date(), 2, 'on-time', 0),
+        ])
+
+        # Beto no registra nada el viernes, así que su ausencia sólo aparece al recalcular
+        with frozen(monday + timedelta(days=4, hours=20)):
+            call_command('rebuildattendance', days=1, stdout=io.StringIO())
+            summary = self.client.get('/api/shifts/attendance?start=2022-09-05').json()
+        self.assertEqual([(row["primo"]["mail"], row["missing"], row["pardoned"], row["onTime"], row["lateness"]) for row in summary], [
+            ("ana@primos.cl", 1, 1, 0, None),
+            ("beto@primos.cl", 1, 0, 1, 0.0),
+        ])
+
+    def test_refreshes_once_per_transaction(self):
+        ana = Primo.objects.create(rol=1, mail='ana@primos.cl', name='Ana', nick='ana', schedule='l0,1')
+        monday = datetime.combine(date(2022, 9, 5), parameters.Block[0].start)
+        with frozen(monday + timedelta(days=1)), mock.patch.object(attendance, 'refresh', wraps=attendance.refresh) as refresh:
+            with self.captureOnCommitCallbacks(execute=True), transaction.atomic():
+                StampedShift.objects.create(primo=ana, checkin=monday)
+                StampedShift.objects.create(primo=ana, checkin=monday + timedelta(minutes=82))
+                # Lo que se deshace no se recalcula
+                try:
+                    with transaction.atomic():
+                        StampedShift.objects.create(primo=ana, checkin=monday + timedelta(days=7))
+                        raise IntegrityError
+                except IntegrityError:
+                    pass
+        # Una vez por cada bloque con turnos nuevos, sólo para Ana
+        self.assertEqual(refresh.call_args_list, [mock.call(monday.date(), monday.date(), [1], 0), mock.call(monday.date(), monday.date(), [1], 1)])
+        self.assertEqual(self.rows(), [(1, monday.date(), 0, 'suspicious', 0), (1, monday.date(), 1, 'suspicious', 2)])
+
+    def test_failed_refresh_keeps_the_shift(self):
+        Primo.objects.create(rol=1, mail='ana@primos.cl', name='Ana', nick='ana', schedule='l0')
+        monday = datetime.combine(date(2022, 9, 5), parameters.Block[0].start)
+        with frozen(monday), mock.patch.object(attendance, 'refresh', side_effect=IntegrityError), self.assertLogs('tracks.attendance', 'ERROR'):
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post('/api/shifts', json.dumps({"mail": "ana@primos.cl"}), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(StampedShift.objects.filter(primo=1).exists())
+
+    def test_failed_primo_delete_keeps_refreshing(self):
+        ana = Primo.objects.create(rol=1, mail='ana@primos.cl', name='Ana', nick='ana', schedule='l0')
+        monday = datetime.combine(date(2022, 9, 5), parameters.Block[0].start)
+        with frozen(monday + timedelta(days=1)):
+            with self.captureOnCommitCallbacks(execute=True):
+                StampedShift.objects.create(primo=ana, checkin=monday)
+
+            # El borrado falla después de borrar en cascada los turnos de Ana
+            def fail(**kwargs):
+                raise IntegrityError
+            post_delete.connect(fail, sender=StampedShift)
+            try:
+                with self.assertRaises(IntegrityError), transaction.atomic():
+                    ana.delete()
+            finally:
+                post_delete.disconnect(fail, sender=StampedShift)
+
+            with self.captureOnCommitCallbacks(execute=True):
+                StampedShift.objects.create(primo=ana, checkin=monday + timedelta(days=7, minutes=3))
+        self.assertEqual(self.rows(), [(1, monday.date(), 0, 'suspicious', 0), (1, monday.date() + timedelta(days=7), 0, 'suspicious', 3)])
+
+    def test_seed_fills_the_rollup(self):
+        output = io.StringIO()
+        with frozen(datetime(2022, 9, 9, 20)):
+            call_command('seed', primos=3, years=0.1, pardons=2, attendance=0.5, stdout=output)
+            rows = self.rows()
+            attendance.refresh(date(2022, 9, 9) - timedelta(days=36), date(2022, 9, 9))
+        self.assertTrue(rows)
+        self.assertEqual(rows, self.rows())
+        self.assertIn(f'{len(rows)} attendance rows', output.getvalue())
+        self.assertEqual(Primo.objects.filter(rol__gte=synthetic.firstRol).count(), 3)
+
+class ShiftHistoryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        monday = datetime.combine(date(2022, 9, 5), parameters.Block[0].start)
+        for rol in range(1, 4):
+            primo = Primo.objects.create(rol=rol, mail=f'primo{rol}@primos.cl', name=f'Primo {rol}', nick=f'p{rol}', schedule='l0')
+            # Todos entran en el mismo instante, así el cursor debe desempatar por id
+            for week in range(4):
+                StampedShift.objects.create(primo=primo, checkin=monday + timedelta(weeks=week), checkout=monday + timedelta(weeks=week, minutes=71))
+
+    def get(self, path: str):
+        with frozen(datetime(2022, 10, 1)):
+            return self.client.get(path)
+
+    def test_pages_cover_the_range_once_in_order(self):
+        ids, path = [], '/api/shifts/history?start=2022-09-05&limit=5'
+        while True:
+            page = self.get(path).json()
+            ids += [shift["id"] for shift in page["shifts"]]
+            if page["next"] is None:
+                break
+            path = f'/api/shifts/history?start=2022-09-05&limit=5&cursor={page["next"]}'
+        self.assertEqual(ids, list(StampedShift.objects.order_by('checkin', 'id').values_list('id', flat=True)))
+
+        page = self.get('/api/shifts/history?start=2022-09-05&end=2022-09-12&mail=PRIMO2@primos.cl').json()
+        self.assertEqual([(shift["primo"]["mail"], shift["block"]) for shift in page["shifts"]], [("primo2@primos.cl", parameters.Block[0].name)]*2)
+        self.assertIsNone(page["next"])
+
+    def test_stream_matches_pages(self):
+        first = self.get('/api/shifts/history?start=2022-09-05&limit=4').json()
+        response = self.get(f'/api/shifts/history?start=2022-09-05&stream=true&cursor={first["next"]}')
+        self.assertTrue(response.streaming)
+        streamed = json.loads(b''.join(response.streaming_content))
+        rest = self.get(f'/api/shifts/history?start=2022-09-05&limit=500&cursor={first["next"]}').json()
+        self.assertEqual(streamed, rest["shifts"])
+        self.assertEqual(len(first["shifts"] + streamed), 12)
+
+    def test_rejects_bad_cursors_and_limits(self):
+        self.assertEqual(self.get('/api/shifts/history?start=2022-09-05&cursor=nope').status_code, 403)
+        self.assertEqual(self.get(f'/api/shifts/history?start=2022-09-05&limit={api.historyLimit + 1}').status_code, 403)
+
+class ExportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        primo = Primo.objects.create(rol=1, mail='ana@primos.cl', name='Ana', nick='ana', schedule='l0')
+        start = datetime.combine(date(2022, 9, 5), parameters.Block[0].start)
+        cls.stamps = [
+            StampedShift.objects.create(primo=primo, checkin=start + timedelta(minutes=2), checkout=start + timedelta(minutes=72)),
+            # Sin cerrar
+            StampedShift.objects.create(primo=primo, checkin=start + timedelta(days=7, minutes=-3)),
+            # Un sábado, no se aproxima a ningún bloque
+            StampedShift.objects.create(primo=primo, checkin=start + timedelta(days=12)),
+        ]
+
+    def download(self, format: str):
+        with frozen(datetime(2022, 10, 1)):
+            return self.client.get(f'/api/shifts/export?start=2022-09-01&format={format}')
+
+    def test_csv(self):
+        response = self.download('csv')
+        self.assertTrue(response.streaming)
+        rows = list(csv.DictReader(io.StringIO(b''.join(response.streaming_content).decode())))
+        self.assertEqual([(row["id"], row["block"], row["inSchedule"], row["lateness"]) for row in rows], [
+            (str(self.stamps[0].id), parameters.Block[0].name, 'True', '2'),
+            (str(self.stamps[1].id), parameters.Block[0].name, 'False', '-3'),
+            (str(self.stamps[2].id), '', 'False', ''),
+        ])
+        self.assertEqual(rows[1]["checkout"], '')
+
+    def test_chunks_do_not_change_the_output(self):
+        whole = list(export.writeCsv(export.chunks(date(2022, 9, 1), date(2022, 10, 1))))
+        pieces = list(export.writeCsv(export.chunks(date(2022, 9, 1), date(2022, 10, 1), size=1)))
+        self.assertEqual(b''.join(whole), b''.join(pieces))
+        self.assertEqual(len(pieces), 4)
+
+    def test_rejects_unknown_formats(self):
+        response = self.download('xlsx')
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.json(), {"detail": "Unavailable format (xlsx), the options are: csv, arrow, parquet"})
+
+    def test_arrow_matches_csv(self):
+        table = export.pyarrow.ipc.open_stream(b''.join(self.download('arrow').streaming_content)).read_all()
+        self.assertEqual(table.column('id').to_pylist(), [stamp.id for stamp in self.stamps])
+        self.assertEqual(table.column('lateness').to_pylist(), [2, -3, None])
+        parquet = export.pyarrow.parquet.read_table(export.pyarrow.BufferReader(b''.join(self.download('parquet').streaming_content)))
+        self.assertTrue(parquet.equals(table))
+
+# Las respuestas en streaming bajo ASGI (daphne) se recorren dentro del event loop,
+# donde Django no permite consultar la base de datos. Las consultas ocurren en otro
+# hilo, así que los datos deben estar confirmados (TransactionTestCase).
+class AsgiStreamingTests(TransactionTestCase):
+    def setUp(self):
+        primo = Primo.objects.create(rol=1, mail='ana@primos.cl', name='Ana', nick='ana', schedule='l0')
+        start = datetime.combine(date(2022, 9, 5), parameters.Block[0].start)
+        self.stamps = [StampedShift.objects.create(primo=primo, checkin=start + timedelta(weeks=week), checkout=start + timedelta(weeks=week, minutes=70)) for week in range(5)]
+
+    def get(self, path: str, query: str) -> bytes:
+        received = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            received.append(message)
+
+        scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': query.encode(), 'headers': [], 'server': ('testserver', 80)}
+        with frozen(datetime(2022, 10, 7)):
+            async_to_sync(stream.StreamingASGIHandler())(scope, receive, send)
+        self.assertEqual(received[0]['status'], 200)
+        return b''.join(message.get('body', b'') for message in received[1:])
+
+    def test_history(self):
+        shifts = json.loads(self.get('/api/shifts/history', 'start=2022-09-01&stream=true'))
+        self.assertEqual([shift["id"] for shift in shifts], [stamp.id for stamp in self.stamps])
+        self.assertEqual(json.loads(self.get('/api/shifts/history', 'start=2022-10-04&stream=true')), [])
+
+    def test_export(self):
+        rows = list(csv.DictReader(io.StringIO(self.get('/api/shifts/export', 'start=2022-09-01&format=csv').decode())))
+        self.assertEqual([int(row["id"]) for row in rows], [stamp.id for stamp in self.stamps])
+        table = export.pyarrow.ipc.open_stream(self.get('/api/shifts/export', 'start=2022-09-01&format=arrow')).read_all()
+        self.assertEqual(table.column('id').to_pylist(), [stamp.id for stamp in self.stamps])
+
+    def test_streaming_does_not_block_the_loop(self):
+        def slow():
+            for _ in range(10):
+                sleep(0.02)
+                yield b'x'
+
+        async def run():
+            sent, ticks = [], 0
+
+            async def send(message):
+                sent.append(message)
+
+            response = StreamingHttpResponse(slow())
+            task = asyncio.ensure_future(stream.StreamingASGIHandler().send_response(response, send))
+            while not task.done():
+                ticks += 1
+                await asyncio.sleep(0.005)
+            await task
+            return sent, ticks
+
+        sent, ticks = async_to_sync(run)()
+        self.assertEqual(b''.join(message.get('body', b'') for message in sent[1:]), b'x'*10)
+        # Leer las partes toma 200ms, si el event loop se bloqueara no correría
+        self.assertGreater(ticks, 10)
+
+class ImportTests(TestCase):
+    def load(self, kind: str, suffix: str, content: str, **options):
+        with tempfile.NamedTemporaryFile('w', suffix=suffix) as file:
+            file.write(content)
+            file.flush()
+            out = io.StringIO()
+            with frozen(datetime(2022, 10, 1)):
+                call_command('importdata', kind, file.name, stdout=out, stderr=io.StringIO(), **options)
+        return out.getvalue()
+
+    def test_primos_are_validated_and_deduplicated(self):
+        Primo.objects.create(rol=1, mail='ana@primos.cl', name='Ana', nick='ana', schedule='l0')
+        content = (
+            'rol,mail,name,nick,schedule\n'
+            '2,beto@primos.cl,Beto,beto,l0m1\n'
+            '3,ANA@primos.cl,Ana,ana,x2\n'
+            '4,carla@primos.cl,Carla,carla,l0m\n'
+            '5,Beto@primos.cl,Beto,beto,l0\n'
+        )
+        with self.assertRaises(CommandError):
+            self.load('primos', '.csv', content)
+        self.assertEqual(Primo.objects.count(), 1)
+
+        output = self.load('primos', '.csv', content, skip_invalid=True)
+        self.assertIn('skipped 2 duplicated and 1 invalid records', output)
+        self.assertEqual(list(Primo.objects.order_by('rol').values_list('mail', flat=True)), ['ana@primos.cl', 'beto@primos.cl'])
+        self.assertEqual(list(ScheduledShift.objects.filter(primo=2).values_list('weekday', 'block')), [(0, 0), (1, 1)])
+
+    def test_shifts_and_pardons(self):
+        Primo.objects.create(rol=1, mail='ana@primos.cl', name='Ana', nick='ana', schedule='l0')
+        checkin = datetime.combine(date(2022, 9, 5), parameters.Block[0].start)
+        StampedShift.objects.create(primo_id=1, checkin=checkin, checkout=checkin + timedelta(minutes=71))
+        shifts = [
+            {"mail": "ana@primos.cl", "checkin": checkin.isoformat(), "checkout": (checkin + timedelta(minutes=71)).isoformat()},
+            {"mail": "ana@primos.cl", "checkin": (checkin + timedelta(weeks=1, minutes=3)).isoformat(), "checkout": (checkin + timedelta(weeks=1, minutes=72)).isoformat()},
+            {"mail": "ana@primos.cl", "checkin": (checkin + timedelta(weeks=1, minutes=3)).isoformat(), "checkout": None},
+            {"mail": "nadie@primos.cl", "checkin": checkin.isoformat()},
+            # Un sábado, no se aproxima a ningún bloque
+            {"mail": "ana@primos.cl", "checkin": (checkin + timedelta(days=5)).isoformat()},
+            # Con zona horaria
+            {"mail": "ana@primos.cl", "checkin": (checkin + timedelta(weeks=2)).isoformat() + '-03:00'},
+        ]
+        with self.assertRaises(CommandError):
+            self.load('shifts', '.json', json.dumps(shifts))
+        output = self.load('shifts', '.json', json.dumps(shifts), skip_invalid=True)
+        self.assertIn('Imported 1 shifts', output)
+        self.assertIn('skipped 2 duplicated and 3 invalid records', output)
+        self.assertEqual(StampedShift.objects.count(), 2)
+        # Sólo se recalcula la asistencia de los días importados
+        self.assertEqual(list(Attendance.objects.values_list('date', 'status', 'lateness')), [(date(2022, 9, 12), 'late', 3)])
+
+        self.load('pardons', '.csv', 'date,block\n2022-09-19,0\n2022-09-19,0\n2022-09-20,1\n')
+        self.assertEqual(list(PardonedShift.objects.values_list('date', 'block')), [(date(2022, 9, 19), 0), (date(2022, 9, 20), 1)])
+        self.assertIn((date(2022, 9, 19), 'pardoned'), Attendance.objects.values_list('date', 'status'))
+
+class WeekShiftsTests(TestCase):
+    instant = datetime(2022, 9, 7, 10, 57)
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.primo = Primo.objects.create(rol=1, mail='ana@primos.cl', name='Ana', nick='ana', schedule='x2')
+
+    def setUp(self):
+        caches.invalidateWeekShifts(date.max)
+
+    def get(self, **headers):
+        with frozen(self.instant):
+            return self.client.get('/api/shifts/week', **headers)
+
+    def test_not_modified_until_a_shift_of_the_week_changes(self):
+        first = self.get()
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.json(), [[], [], [], [], []])
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get(HTTP_IF_NONE_MATCH=first['ETag']).status_code, 304)
+
+        # Un turno de la semana anterior no invalida la semana actual
+        with self.captureOnCommitCallbacks(execute=True):
+            StampedShift.objects.create(primo=self.primo, checkin=self.instant - timedelta(days=7))
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=first['ETag']).status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True), frozen(self.instant):
+            self.client.post('/api/shifts', json.dumps({"mail": "ana@primos.cl"}), content_type='application/json')
+        second = self.get(HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(second.status_code, 200)
+        self.assertNotEqual(second['ETag'], first['ETag'])
+        self.assertEqual([shift['primo']['mail'] for shift in second.json()[2]], ['ana@primos.cl'])
+
+    def test_primo_changes_invalidate_the_week(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            StampedShift.objects.create(primo=self.primo, checkin=self.instant)
+        first = self.get()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.primo.nick = 'anita'
+            self.primo.save()
+        second = self.get(HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual([shift['primo']['nick'] for shift in second.json()[2]], ['anita'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.primo.delete()
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=second['ETag']).json(), [[], [], [], [], []])
+
+# Fusión original de /shifts/week, con dos while anidados y pops desde el medio de
+# la lista. Se mantiene como referencia para utils.mergeConsecutiveShifts.
+def legacyMerge(day: list) -> list:
+    onemin = timedelta(minutes=1)
+    thisshift = 0
+    while thisshift < len(day):
+        nextshift = thisshift + 1
+        while nextshift < len(day):
+            if (day[thisshift]["checkout"] is None) or (day[nextshift]["checkin"] - day[thisshift]["checkout"]) > onemin:
+                break
+            if day[thisshift]["primo"] == day[nextshift]["primo"]:
+                day[thisshift]["checkout"] = day.pop(nextshift)["checkout"]
+            nextshift += 1
+        thisshift += 1
+    return day
+
+class MergeConsecutiveShiftsTests(SimpleTestCase):
+    # Genera un día al azar: cada primo hace algunos turnos que no se traslapan y de
+    # al menos dos minutos, a veces renovándolos (cierra y abre otro de inmediato).
+    # Con <renewals> se limita cuántas veces seguidas se puede renovar un turno.
+    def randomDay(self, rng: Random, renewals: int) -> list:
+        day = []
+        for i in range(rng.randint(1, 6)):
+            primo = {"mail": f'primo{i}@primos.cl', "nick": f'p{i}'}
+            instant, chain = datetime(2022, 9, 7, 8) + timedelta(minutes=rng.randint(0, 120)), 0
+            for _ in range(rng.randint(1, 8)):
+                checkin = instant
+                checkout = None if rng.random() < 0.1 else checkin + timedelta(minutes=rng.randint(2, 90), seconds=rng.randint(0, 59))
+                day.append({"id": len(day), "primo": primo, "checkin": checkin, "checkout": checkout})
+                if checkout is None:
+                    break
+                if chain < renewals and rng.random() < 0.6:
+                    chain, instant = chain + 1, checkout + timedelta(seconds=rng.randint(0, 60))
+                else:
+                    chain, instant = 0, checkout + timedelta(minutes=rng.randint(2, 120))
+        day.sort(key=lambda shift: shift["checkin"])
+        return day
+
+    def copy(self, day: list) -> list:
+        return [dict(shift) for shift in day]
+
+    def test_matches_legacy_merge(self):
+        # Si cada turno se renueva a lo más una vez, la fusión original no se salta nada
+        rng = Random(0)
+        for _ in range(2000):
+            day = self.randomDay(rng, renewals=1)
+            self.assertEqual(utils.mergeConsecutiveShifts(self.copy(day)), legacyMerge(self.copy(day)))
+
+    def test_matches_legacy_merge_repeated_until_stable(self):
+        # La fusión original se salta el turno que sigue a cada fusión, por lo que una
+        # cadena de renovaciones necesitaba varias pasadas para quedar fusionada
+        rng = Random(1)
+        for _ in range(2000):
+            day = self.randomDay(rng, renewals=5)
+            expected = legacyMerge(self.copy(day))
+            while len(again := legacyMerge(self.copy(expected))) != len(expected):
+                expected = again
+            self.assertEqual(utils.mergeConsecutiveShifts(self.copy(day)), expected)
+
+class StreamTests(TestCase):
+    instant = datetime(2022, 9, 7, 10, 57)
+
+    def test_next_transition(self):
+        day = datetime(2022, 9, 7)
+        # Se abre la tolerancia de entrada del bloque 5-6 (10:55)
+        self.assertEqual(utils.nextTransition(day.replace(hour=10, minute=40)), day.replace(hour=10, minute=45, microsecond=1))
+        # Se cierra la tolerancia de entrada
+        self.assertEqual(utils.nextTransition(self.instant), day.replace(hour=11, minute=5, second=59))
+        # Termina el bloque
+        self.assertEqual(utils.nextTransition(day.replace(hour=11, minute=30)), day.replace(hour=12, minute=5, microsecond=1))
+        self.assertEqual(utils.nextTransition(day.replace(hour=21)), day + timedelta(days=1))
+
+    def test_stream_pushes_now_and_shift_events(self):
+        Primo.objects.create(rol=1, mail='ana@primos.cl', name='Ana', nick='ana', schedule='x2')
+        caches.invalidateScheduleIndex()
+        received, sent = [], []
+
+        async def receive():
+            # La pantalla se desconecta después de recibir el segundo evento
+            while len(received) < 2:
+                await asyncio.sleep(0.01)
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            sent.append(message)
+            if message['type'] == 'http.response.body':
+                received.append(message['body'].decode())
+                if len(received) == 1:
+                    # Publicado desde otro hilo, igual que desde una vista síncrona
+                    await asyncio.to_thread(events.broadcaster.publish, 'checkin', {"id": 1})
+
+        with frozen(self.instant):
+            async_to_sync(stream.streaming(None))({'type': 'http', 'path': '/api/stream', 'method': 'GET'}, receive, send)
+
+        self.assertEqual(dict(sent[0]['headers'])[b'content-type'], b'text/event-stream')
+        self.assertTrue(received[0].startswith('event: now\n'))
+        self.assertIn('"pair": [{"mail": "ana@primos.cl", "nick": "ana"}]', received[0])
+        self.assertEqual(received[1], 'event: checkin\ndata: {"id": 1}\n\n')
+        self.assertEqual(events.broadcaster.subscribers, 0)
+
+class AsyncApiTests(TestCase):
+    instant = datetime(2022, 9, 7, 10, 57)
+
+    @classmethod
+    def setUpTestData(cls):
+        Primo.objects.create(rol=1, mail='ana@primos.cl', name='Ana', nick='ana', schedule='x2')
+        Primo.objects.create(rol=2, mail='beto@primos.cl', name='Beto', nick='beto', schedule='l0')
+
+    def call(self, method: str, path: str, payload = None):
+        with frozen(self.instant):
+            if payload is None:
+                response = getattr(self.client, method)(path)
+            else:
+                response = getattr(self.client, method)(path, json.dumps(payload), content_type='application/json')
+        body = response.json()
+        if isinstance(body, dict):
+            body.pop("id", None)
+        return response.status_code, body
+
+    # Ambas versiones de cada endpoint deben responder lo mismo
+    def test_same_responses_as_sync_api(self):
+        caches.invalidateScheduleIndex()
+        for prefix in ('/api', '/api/async'):
+            with self.subTest(prefix=prefix):
+                self.assertEqual(self.call('get', f'{prefix}/now'), self.call('get', '/api/now'))
+                self.assertEqual(self.call('post', f'{prefix}/shifts', {"mail": "beto@primos.cl"})[0], 403)
+                pushed = self.call('post', f'{prefix}/shifts', {"mail": "ana@primos.cl"})
+                self.assertEqual(pushed[0], 200)
+                self.assertEqual(self.call('get', f'{prefix}/primos/ana@primos.cl'), self.call('get', '/api/primos/ana@primos.cl'))
+
+                running = StampedShift.objects.get(checkout__isnull=True)
+                status, closed = self.call('put', f'{prefix}/shifts', {"id": running.id})
+                self.assertEqual(status, 200)
+                self.assertEqual(closed["checkout"], self.instant.isoformat())
+                self.assertEqual(self.call('put', f'{prefix}/shifts', {"id": running.id}), (403, {"detail": "Shift already closed"}))
+
+# Conexión de mentira, con lo que usa tracks/db.py de BaseDatabaseWrapper
+class FakeConnection():
+    def __init__(self, checks: bool, usable: bool, atomic: bool = False):
+        self.settings_dict = {'CONN_HEALTH_CHECKS': checks}
+        self.in_atomic_block = atomic
+        self.usable = usable
+        self.connection = object()
+        self.checks = self.connects = 0
+
+    def is_usable(self):
+        self.checks += 1
+        return self.usable
+
+    def close(self):
+        self.connection = None
+
+    def ensure_connection(self):
+        if self.connection is None:
+            self.connection = object()
+            self.connects += 1
+
+class ConnectionHealthTests(SimpleTestCase):
+    def test_checks_once_on_first_use(self):
+        broken, alive, unchecked, atomic = FakeConnection(True, False), FakeConnection(True, True), FakeConnection(False, False), FakeConnection(True, False, True)
+        connections = [broken, alive, unchecked, atomic]
+        with mock.patch.object(db.connections, 'all', return_value=connections):
+            db.check_connections()
+        # Sin consultas no se comprueba nada
+        self.assertEqual([connection.checks for connection in connections], [0, 0, 0, 0])
+
+        for _ in range(2):
+            for connection in connections:
+                connection.ensure_connection()
+        self.assertEqual([connection.checks for connection in connections], [1, 1, 0, 0])
+        self.assertEqual([connection.connects for connection in connections], [1, 0, 0, 0])
+
+        # La siguiente petición vuelve a comprobar
+        with mock.patch.object(db.connections, 'all', return_value=connections):
+            db.check_connections()
+        broken.ensure_connection()
+        self.assertEqual((broken.checks, broken.connects), (2, 2))
+
+class MetricsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        Primo.objects.create(rol=1, mail='ana@primos.cl', name='Ana', nick='ana', schedule='l0')
+
+    def setUp(self):
+        metrics.registry.reset()
+
+    def test_records_every_route(self):
+        self.client.get('/api/primos')
+        self.client.get('/api/primos/ana@primos.cl')
+        self.client.get('/api/primos/nadie@primos.cl')
+        # Bajo ASGI el middleware también debe medir las vistas asíncronas
+        async def fetch():
+            return await self.async_client.get('/api/async/primos/ana@primos.cl')
+        async_to_sync(fetch)()
+
+        body = self.client.get('/api/metrics').content.decode()
+        self.assertIn('tracks_responses_total{method="GET",route="api/primos",status="200"} 1', body)
+        self.assertIn('tracks_responses_total{method="GET",route="api/primos/<str:mail>",status="200"} 1', body)
+        self.assertIn('tracks_responses_total{method="GET",route="api/primos/<str:mail>",status="404"} 1', body)
+        self.assertIn('tracks_request_duration_seconds_count{method="GET",route="api/primos/<str:mail>"} 2', body)
+        self.assertIn('tracks_request_duration_seconds_bucket{method="GET",route="api/primos",le="+Inf"} 1', body)
+        self.assertIn('tracks_db_queries_total{method="GET",route="api/primos"} 1', body)
+        # Las consultas de las vistas asíncronas ocurren en otro hilo
+        self.assertIn('tracks_db_queries_total{method="GET",route="api/async/primos/<str:mail>"} 2', body)
+
+class BatchShiftsTests(TestCase):
+    instant = datetime(2022, 9, 7, 18, 0)
+
+    @classmethod
+    def setUpTestData(cls):
+        Primo.objects.create(rol=1, mail='ana@primos.cl', name='Ana', nick='ana', schedule='x2')
+        Primo.objects.create(rol=2, mail='beto@primos.cl', name='Beto', nick='beto', schedule='l0')
+        carla = Primo.objects.create(rol=3, mail='carla@primos.cl', name='Carla', nick='carla', schedule='x0')
+        cls.forgotten = StampedShift.objects.create(primo_id=1, checkin=datetime(2022, 9, 5, 10, 56))
+        cls.running = StampedShift.objects.create(primo=carla, checkin=datetime(2022, 9, 7, 8, 16))
+
+    def test_applies_events_in_order_with_per_item_results(self):
+        events = [
+            ("checkout", "ana@primos.cl", datetime(2022, 9, 7, 12, 6)),
+            ("checkin", "ana@primos.cl", datetime(2022, 9, 7, 10, 57)),
+            ("checkin", "beto@primos.cl", datetime(2022, 9, 7, 10, 57)),
+            ("checkout", "beto@primos.cl", datetime(2022, 9, 7, 12, 6)),
+            ("checkin", "nadie@primos.cl", datetime(2022, 9, 7, 10, 57)),
+            ("checkin", "ana@primos.cl", datetime(2022, 9, 8, 10, 57)),
+            ("checkout", "ana@primos.cl", datetime(2022, 9, 7, 12, 30)),
+            ("checkout", "carla@primos.cl", datetime(2022, 9, 7, 9, 30)),
+        ]
+        payload = {"events": [{"type": kind, "mail": mail, "at": at.isoformat()} for kind, mail, at in events]}
+        caches.invalidateWeekShifts(date.max)
+        with frozen(self.instant):
+            self.client.get('/api/shifts/week')
+        with frozen(self.instant), self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/shifts/batch', json.dumps(payload), content_type='application/json')
+        results = response.json()
+
+        self.assertEqual([(result["status"], result["detail"]) for result in results], [
+            (200, None),
+            (200, None),
+            (403, "You're not on your shift"),
+            (403, "There is no running shift"),
+            (404, "Not Found"),
+            (403, "The event is in the future"),
+            (403, "The check-in day is already over"),
+            (200, None),
+        ])
+        created = StampedShift.objects.get(primo_id=1, checkin=datetime(2022, 9, 7, 10, 57))
+        self.assertEqual(created.checkout, datetime(2022, 9, 7, 12, 6))
+        self.assertEqual(results[1]["shift"], results[0]["shift"])
+        self.assertEqual(results[1]["shift"]["id"], created.id)
+        self.assertEqual(results[1]["shift"]["block"], parameters.Block[2].name)
+        self.running.refresh_from_db()
+        self.forgotten.refresh_from_db()
+        self.assertEqual((results[7]["shift"]["id"], self.running.checkout), (self.running.id, datetime(2022, 9, 7, 9, 30)))
+        self.assertIsNone(self.forgotten.checkout)
+
+        # Sin señales, el lote igual debe invalidar la semana en caché
+        with frozen(self.instant):
+            week = self.client.get('/api/shifts/week').json()
+        self.assertIn(created.id, [shift["id"] for shift in week[2]])
+
+    def post(self, events: list):
+        payload = {"events": [{"type": kind, "mail": mail, "at": at} for kind, mail, at in events]}
+        with frozen(self.instant), self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/shifts/batch', json.dumps(payload), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        return [(result["status"], result["detail"], result["shift"] and result["shift"]["id"]) for result in response.json()]
+
+    def test_aware_instants_are_local_time(self):
+        local = ZoneInfo('America/Santiago')
+        checkin = datetime(2022, 9, 7, 10, 57, tzinfo=local).astimezone(dt_timezone.utc)
+        results = self.post([
+            ("checkin", "ana@primos.cl", checkin.isoformat().replace('+00:00', 'Z')),
+            ("checkout", "ana@primos.cl", datetime(2022, 9, 7, 12, 6, tzinfo=local).isoformat()),
+            # Un instante del futuro, también con zona horaria
+            ("checkin", "beto@primos.cl", (self.instant + timedelta(hours=1)).replace(tzinfo=local).isoformat()),
+        ])
+        created = StampedShift.objects.get(primo_id=1, checkin=datetime(2022, 9, 7, 10, 57))
+        self.assertEqual(created.checkout, datetime(2022, 9, 7, 12, 6))
+        self.assertEqual(results, [(200, None, created.id), (200, None, created.id), (403, "The event is in the future", None)])
+
+    def test_replayed_events_are_not_repeated(self):
+        events = [
+            ("checkin", "ana@primos.cl", datetime(2022, 9, 7, 10, 57).isoformat()),
+            ("checkout", "ana@primos.cl", datetime(2022, 9, 7, 12, 6).isoformat()),
+            ("checkout", "carla@primos.cl", datetime(2022, 9, 7, 9, 30).isoformat()),
+        ]
+        first = self.post(events)
+        self.assertEqual([status for status, _, _ in first], [200, 200, 200])
+        # El kiosko reenvía el lote, y además otra vez la misma entrada dentro del lote
+        second = self.post(events + events[:1])
+        self.assertEqual(second, [(200, "Already registered", id) for _, _, id in first + first[:1]])
+        self.assertEqual(StampedShift.objects.filter(primo_id=1, checkin=datetime(2022, 9, 7, 10, 57)).count(), 1)
+
+        # Un turno abierto también cuenta como registrado
+        shift = StampedShift.objects.create(primo_id=2, checkin=datetime(2022, 9, 5, 8, 16))
+        self.assertEqual(self.post([("checkin", "beto@primos.cl", shift.checkin.isoformat())]), [(200, "Already registered", shift.id)])
+
+    def test_rejects_oversized_batches(self):
+        payload = {"events": [{"type": "checkin", "mail": "ana@primos.cl", "at": self.instant.isoformat()}]*(api.batchLimit + 1)}
+        with frozen(self.instant):
+            response = self.client.post('/api/shifts/batch', json.dumps(payload), content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(StampedShift.objects.filter(checkin=self.instant).exists())
@@ -1,23 +1,10 @@
-from datetime import date, datetime, timedelta
-from re import findall, fullmatch
-from typing import List, NamedTuple, Callable
-
-from time import perf_counter
-from uuid import uuid4
-from functools import wraps
+from bisect import bisect_left, bisect_right
+from datetime import date, datetime, time, timedelta
+from functools import lru_cache
+from typing import List, NamedTuple, Tuple
 
 from tracks import parameters
 
-# Decorator que imprime un log cuando se haga una llamada a la api
-def logged(api_call: Callable):
-    @wraps(api_call)
-    def wrap(request, *args, **kwargs):
-        print(f'{(key := uuid4())} IN  {request.method} {request.get_full_path()}')
-        time_counter, response_code, response_body = perf_counter(), *api_call(request, *args, **kwargs)
-        print(f'{key} OUT {response_code} {(perf_counter() - time_counter)*1000:03.0f}ms')
-        return response_code, response_body
-    return wrap
-
 # Esta función es importante para el debug, ya que nos
 # permite cambiar fácilmente la hora en toda la app.
 def now():
@@ -28,33 +15,23 @@ def firstWeekday(reference: datetime | None = None) -> date:
         reference = now()
     return reference.date() - timedelta(days=reference.weekday())
 
-# Esta función te retorna el regex que procesa el horario de un primo
-# NOTA: Quiero mover esto a parameters.py
+# Esta función te retorna el regex que procesa el horario de un primo. Ya vive en
+# parameters.py, donde además se compila una sola vez (parameters.schedulePattern).
 def getRegex():
-    lastShift = len(parameters.Block) - 1
-    return f"([{parameters.days['short']}](?:[0-{lastShift}],)*[0-{lastShift}])"
+    return parameters.scheduleRegEx
 
 def verifyRegex(schedule: str) -> bool:
-    return fullmatch(f'{getRegex()}+', schedule) is not None
+    return parameters.fullSchedulePattern.fullmatch(schedule) is not None
 
-class Shift():
-    def __init__(self, day: date, block: parameters.Block):
-        self.day = day
-        self.block = block
+# Un turno (día, bloque). Al ser una tupla es inmutable, no tiene __dict__, se puede
+# usar en sets y se ordena cronológicamente (primero por día y luego por bloque).
+class Shift(NamedTuple):
+    day: date
+    block: parameters.Block
 
     def __repr__(self) -> str:
         return f'{self.day.isoformat()} {self.block.name}'
     
-    def __eq__(self, other):
-        return self.day == other.day and self.block == other.block
-    
-    def __gt__(self, other):
-        if self.day > other.day:
-            return True
-        elif self.day == other.day:
-            return self.block > other.block
-        return False
-    
     @property
     def checkin(self) -> datetime:
         return datetime.combine(self.day, self.block.start)
@@ -76,7 +53,7 @@ def DEPRECATED_parseSchedule(schedule: str, reference: datetime | None = None) -
         reference = now()
     shifts = []
     
-    for daily in findall(getRegex(), schedule):
+    for daily in parameters.schedulePattern.findall(schedule):
         for i in daily[1:].split(','):
             block = parameters.Block[int(i)]
             checkout = datetime.combine(firstWeekday(reference), block.end) + timedelta(days=parameters.days['short'].index(daily[0]))
@@ -89,29 +66,80 @@ def DEPRECATED_parseSchedule(schedule: str, reference: datetime | None = None) -
     shifts.sort(key=lambda s: datetime.combine(s.day, s.block.start))
     return shifts
 
+# Esta función retorna el bloque cuya tolerancia de entrada contiene al instante
+# <instant>, es decir, el bloque que se puede iniciar en ese instante (quien lo
+# tenga en su horario), o None si en ese instante no se puede iniciar ningún bloque.
+def checkinBlock(instant: datetime) -> parameters.Block | None:
+    if instant.weekday() > 4:
+        return None
+    # El único candidato es el primer bloque cuya tolerancia de entrada aún no se cierra
+    moment = parameters.microseconds(instant.time())
+    if (i := bisect_right(parameters.checkinEnds, moment)) < len(parameters.checkinEnds):
+        if parameters.blockStarts[i] - parameters.beforeStartMicroseconds < moment:
+            return parameters.Block[i]
+    return None
+
 # Esta función te retorna un generator que genera tu próximo turno a partir de una
 # referencia <reference>.
 # https://docs.python.org/3/reference/expressions.html#yield-expressions
 # NOTA: Programé esta función pensando en nunca usarla directamente (por eso parte
 # por _), la uso sólo en parseSchedule.
 def _scheduleGenerator(schedule, reference: datetime):
-    i = 0
-    monday = firstWeekday(reference)
-    for weekday, block in schedule:
-        checkout = datetime.combine(monday, block.end) + timedelta(days=weekday)
-        if checkout >= reference:
-            break
-        i += 1
-    else:
-        i = 0
-        monday += timedelta(days=7)
-    
+    monday, i = _scheduleStart(schedule, reference)
     while True:
         weekday, block = schedule[i]
         yield Shift(monday + timedelta(days=weekday), block)
         if not (i := (i + 1)%len(schedule)):
             monday += timedelta(days=7)
 
+dayMicroseconds = 24*60*60*1_000_000
+
+# Esta función retorna el lunes de la semana y la posición en <schedule> (pares día
+# de la semana, bloque, ordenados) del primer turno que aún no termina en
+# <reference>. En lugar de recorrer el horario armando fechas, busca el instante de
+# la semana de <reference> entre los términos de los turnos, todos en microsegundos
+# desde el comienzo del lunes.
+def _scheduleStart(schedule, reference: datetime) -> Tuple[date, int]:
+    monday = firstWeekday(reference)
+    moment = reference.weekday()*dayMicroseconds + parameters.microseconds(reference.time())
+    ends = [weekday*dayMicroseconds + parameters.blockEnds[block.index] for weekday, block in schedule]
+    if (i := bisect_left(ends, moment)) == len(ends):
+        # Ya terminaron todos los turnos de esta semana
+        return monday + timedelta(days=7), 0
+    return monday, i
+
+# Esta función retorna el turno número <k> (partiendo desde 0) del horario <schedule>
+# a partir de <reference>, sin pasar por los anteriores: como el horario se repite
+# cada semana, salta directamente a la semana que corresponde. Por ejemplo, con k=0
+# es el próximo turno (o el actual) y para el primer turno después de cierta fecha
+# basta con pasar esa fecha como <reference>.
+def upcomingShift(schedule: str, reference: datetime | None = None, k: int = 0) -> Shift:
+    if reference is None:
+        reference = now()
+    effectiveSchedule = scheduleBlocks(schedule)
+    monday, i = _scheduleStart(effectiveSchedule, reference)
+    weeks, i = divmod(i + k, len(effectiveSchedule))
+    weekday, block = effectiveSchedule[i]
+    return Shift(monday + timedelta(days=7*weeks + weekday), block)
+
+# Esta función traduce un horario <schedule> en el formato del regex a una tupla de
+# pares (día de la semana, índice del bloque), ordenados cronológicamente y sin
+# repetir. Como los horarios casi no cambian y se repiten en cada petición, el
+# resultado se memoiza; por eso es una tupla, para que nadie lo modifique.
+@lru_cache(maxsize=1024)
+def scheduleShifts(schedule: str) -> Tuple[Tuple[int, int], ...]:
+    shifts = set()
+    for daily in parameters.schedulePattern.findall(schedule):
+        weekday = parameters.days['short'].index(daily[0])
+        for i in daily[1:].split(','):
+            shifts.add((weekday, int(i)))
+    return tuple(sorted(shifts))
+
+# Igual que scheduleShifts, pero con los bloques como objetos parameters.Block
+@lru_cache(maxsize=1024)
+def scheduleBlocks(schedule: str) -> Tuple[tuple, ...]:
+    return tuple((weekday, parameters.Block[block]) for weekday, block in scheduleShifts(schedule))
+
 # Esta función, a partir de un horario <schedule> en el formato del regex, retorna
 # el largo del horario de un Primo (cantidad de turnos por semana) y un generator de
 # los próximos turnos a partir de una referencia <reference>. 
@@ -119,13 +147,7 @@ def parseSchedule(schedule: str, reference: datetime | None = None):
     if reference is None:
         reference = now()
     
-    effectiveSchedule = []
-    for daily in findall(getRegex(), schedule):
-        for i in daily[1:].split(','):
-            block = parameters.Block[int(i)]
-            weekday = parameters.days['short'].index(daily[0])
-            effectiveSchedule.append((weekday, block))
-    
+    effectiveSchedule = scheduleBlocks(schedule)
     return (len(effectiveSchedule), _scheduleGenerator(effectiveSchedule, reference))
 
 # Esta función, dado <instant> (Fecha y hora), retornará el bloque al que
@@ -146,23 +168,52 @@ def aproximateToShift(instant: datetime, strictmode = True) -> Shift:
     if (weekday := firstHour.weekday()) > 4:
         if strictmode:
             raise Exception(f'<instant> ({instant}) is not a weekday, so is not close enough to any block')
-        firstHour += timedelta(days=7 - weekday)
-    
-    for block in parameters.Block:
-        checkin = datetime.combine(firstHour, block.start)
-        checkout = datetime.combine(firstHour, block.end)
-
-        if strictmode:
-            # Aproxima al siguiente bloque más cercano sólo si estamos dentro del
-            # tiempo de tolerancia
-            nextblockCondition = checkin - parameters.beforeStartTolerance < instant < checkin # <=
-        else:
-            # Aproxima directamente al bloque más cercano
-            nextblockCondition = instant < checkin
-
-        if (checkin <= instant <= checkout) or nextblockCondition:
-            return Shift(firstHour, block)
+        # Durante el fin de semana el bloque más cercano siempre es el primero del lunes
+        return Shift(firstHour + timedelta(days=7 - weekday), parameters.Block[0])
+
+    # El primer bloque que aún no termina es el único candidato: los anteriores ya
+    # terminaron y los siguientes comienzan después de que este termine.
+    moment = ((instant.hour*60 + instant.minute)*60 + instant.second)*1_000_000 + instant.microsecond
+    if (i := bisect_left(parameters.blockEnds, moment)) < len(parameters.blockEnds):
+        start = parameters.blockStarts[i]
+        if (
+                not strictmode
+                # Estamos dentro del bloque
+             or start <= moment
+                # Aproxima al siguiente bloque sólo si estamos dentro del tiempo de tolerancia
+             or start - parameters.beforeStartMicroseconds < moment
+        ):
+            return Shift(firstHour, parameters.Block[i])
     if strictmode:
         raise Exception(f'<instant> ({instant}) is not close enough to any block')
     
     return Shift(firstHour + timedelta(days=7), parameters.Block[0])
+
+# Esta función fusiona los turnos consecutivos de un mismo primo: si un primo cerró
+# un turno y abrió otro a menos de <tolerance> (un minuto por defecto), ambos se
+# reemplazan por un único turno con la entrada del primero y la salida del segundo.
+# Los turnos sin cerrar nunca se fusionan con el siguiente.
+# <shifts>: Turnos en el formato de RegisteredShift, ordenados por checkin. Los
+#  turnos fusionados se modifican en el lugar.
+# Retorna los turnos que quedan, en el mismo orden. Como cada turno sólo se compara
+# con el último turno que quedó de su primo, recorre la lista una sola vez.
+def mergeConsecutiveShifts(shifts: List[dict], tolerance: timedelta = timedelta(minutes=1)) -> List[dict]:
+    merged, last = [], {}
+    for shift in shifts:
+        previous = last.get(mail := shift["primo"]["mail"])
+        if previous is not None and previous["checkout"] is not None and shift["checkin"] - previous["checkout"] <= tolerance:
+            previous["checkout"] = shift["checkout"]
+        else:
+            merged.append(shift)
+            last[mail] = shift
+    return merged
+
+# Esta función retorna el siguiente instante después de <instant> en el que cambia
+# el bloque actual o su tolerancia (véase parameters.blockTransitions). Si no quedan
+# cambios en el día retorna la medianoche, que es cuando cambia el día de la semana.
+def nextTransition(instant: datetime) -> datetime:
+    moment = ((instant.hour*60 + instant.minute)*60 + instant.second)*1_000_000 + instant.microsecond
+    midnight = datetime.combine(instant.date(), time())
+    if (i := bisect_right(parameters.blockTransitions, moment)) < len(parameters.blockTransitions):
+        return midnight + timedelta(microseconds=parameters.blockTransitions[i])
+    return midnight + timedelta(days=1)